@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+"""
+Title: Fixed-point Amount round trips and conversion speed against float
+Script Name: bench_amount.py
+
+Checks every amount between -limit and +limit NGN, at each 1/10000 NGN unit,
+reads back the same after each of the ways Amount writes it, and that the
+result line text matches what the float arithmetic printed. Then counts the
+two-decimal input amounts the float conversions got wrong, and times parsing
+and formatting with Amount against the float conversions it replaced.
+
+Usage: python benchmarks/bench_amount.py [limit in NGN] [seconds per case]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from credit_debit import Amount
+
+
+def rate(func, values, seconds):
+    """
+    Calls func on each value in turn for about the given time.
+
+    Returns:
+        float: Calls per second.
+    """
+    calls, started = 0, time.time()
+    while time.time() - started < seconds:
+        for value in values:
+            func(value)
+        calls += len(values)
+    return calls / (time.time() - started)
+
+
+def check_round_trips(limit):
+    """
+    Raises:
+        AssertionError: If an amount does not read back the same.
+    """
+    checked = 0
+    for units in range(-limit * Amount.SCALE, limit * Amount.SCALE + 1):
+        amount = Amount(units)
+        assert Amount.parse(amount.ngn()) == units, amount.ngn()
+        assert Amount.parse(amount.digits()) == units, amount.digits()
+        assert Amount.parse(amount.signed() or "0") == units, amount.signed()
+        assert Amount.from_units(str(amount)) == units, str(amount)
+        assert amount.ngn() == str(float(units) / 10000), (amount.ngn(), str(float(units) / 10000))
+        checked += 1
+    print("%d amounts from -%d to %d NGN read back the same" % (checked, limit, limit))
+
+
+def count_float_errors(limit):
+    """
+    Counts the two-decimal input amounts the float conversions scaled or added up wrongly.
+    """
+    truncated = printed = 0
+    for cents in range(limit * 100 + 1):
+        text = "%d.%02d" % (cents // 100, cents % 100)
+        amount = Amount.parse(text)
+        assert amount == cents * 100, text
+        # Bonus debits were scaled with int(), bonus credits were added to the balance as floats
+        truncated += int(float(text) * 10000) != amount
+        printed += str(1.0 + float(text)) != (Amount(10000) + amount).ngn()
+    print("of %d amounts up to %d NGN, float scaling truncated %d and float addition misprinted %d"
+          % (limit * 100 + 1, limit, truncated, printed))
+
+
+def main():
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    check_round_trips(limit)
+    count_float_errors(limit)
+
+    texts = ["%d.%02d" % (i * 7 % 5000, i % 100) for i in range(1000)]
+    units = [str(i * 7919 % 50000000) for i in range(1000)]
+    amounts = [Amount.from_units(value) for value in units]
+    print("%-28s %14s %14s" % ("conversion", "float/s", "Amount/s"))
+    print("%-28s %14.0f %14.0f" % ("input text to units", rate(lambda text: int(round(float(text) * 10000)), texts, seconds),
+                                   rate(Amount.parse, texts, seconds)))
+    print("%-28s %14.0f %14.0f" % ("gateway units to NGN text", rate(lambda value: str(float(value) / 10000), units, seconds),
+                                   rate(lambda value: Amount.from_units(value).ngn(), units, seconds)))
+    print("%-28s %14.0f %14.0f" % ("balance check", rate(lambda value: float(value) >= 2.5 * 10000, units, seconds),
+                                   rate(lambda amount: amount >= 25000, amounts, seconds)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+"""
+Title: Bonus bucket selection, list filtering vs BucketIndex
+Script Name: bench_buckets.py
+
+Checks BucketIndex against a brute force pick on random subscribers, for
+every selection policy, then times picking a bonus debit bucket for
+subscribers holding more and more bundles: the filter debit_operations ran
+over all bundle rows for each debit, building a BucketIndex per debit, and
+picking from an index already built, as later lines of a cached subscriber do.
+
+Usage: python benchmarks/bench_buckets.py [random cases] [seconds per case]
+"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import credit_debit
+from bench_parser import rate
+
+CURRENT_DATE = "202406150000"
+
+
+def random_buckets(rng, count):
+    """
+    Builds count bonus buckets with random end dates and counters, some expired or without an end date.
+    """
+    buckets = []
+    for n in range(count):
+        end_date = "" if rng.random() < 0.2 else "2024%02d%02d000000" % (rng.randint(1, 12), rng.randint(1, 28))
+        counter = rng.choice((0, rng.randint(1, 10), rng.randint(1, 5000000)))
+        buckets.append(credit_debit.BundleBucket("%d_MA" % n, "ACTIVE", end_date, "1001", "MA%d" % n, counter))
+    return tuple(buckets)
+
+
+def expiry_order(buckets):
+    """
+    The live buckets by end date, those without one last, ties in bundle order.
+    """
+    live = [bucket for bucket in buckets if bucket.end_date == "" or bucket.end_date >= CURRENT_DATE]
+    return sorted(live, key=lambda bucket: (bucket.end_date == "", bucket.end_date))
+
+
+def check(buckets, amount, policy):
+    """
+    Checks one pick against the brute force answer.
+
+    Raises:
+        AssertionError: If the pick is wrong.
+    """
+    debits = credit_debit.BucketIndex(buckets, CURRENT_DATE).pick(amount, policy)
+    live = expiry_order(buckets)
+    picked = [bucket for bucket, debit in debits]
+    assert all(bucket in live for bucket in picked), "picked an expired bucket"
+    assert all(0 < debit <= bucket.counter for bucket, debit in debits), "debit above a bucket counter"
+    if policy == 'earliest':
+        holding = [bucket for bucket in live if bucket.counter >= amount]
+        assert picked == holding[:1], "not the earliest ending bucket holding the amount"
+    elif policy == 'largest':
+        largest = max([bucket.counter for bucket in live] or [0])
+        assert bool(picked and picked[0].counter == largest) == (largest >= amount), "not the largest bucket"
+    else:
+        total = sum(max(bucket.counter, 0) for bucket in live)
+        assert bool(debits) == (total >= amount), "split found %s for a total of %d" % (debits, total)
+        if debits:
+            assert sum(debit for bucket, debit in debits) == amount, "split does not add up to the amount"
+            assert picked == [bucket for bucket in live if bucket.counter > 0][:len(picked)], "split out of expiry order"
+            assert all(debit == bucket.counter for bucket, debit in debits[:-1]), "split left an earlier bucket"
+    if debits and policy != 'split':
+        assert len(debits) == 1 and debits[0][1] == amount, "single bucket policy split the amount"
+
+
+def check_random(cases):
+    rng = random.Random(7)
+    for _ in range(cases):
+        buckets = random_buckets(rng, rng.randint(0, 30))
+        amount = rng.choice((1, rng.randint(1, 20), rng.randint(1, 20000000)))
+        for policy in credit_debit.BucketIndex.POLICIES:
+            check(buckets, amount, policy)
+    print("%d random subscribers checked for %s" % (cases, ", ".join(credit_debit.BucketIndex.POLICIES)))
+
+
+def filter_rows(rows, amount):
+    """
+    The bucket selection debit_operations used before BucketIndex.
+    """
+    return list(filter(lambda x: (x[2] >= CURRENT_DATE or x[2] == "") and (float(x[5]) >= amount), rows))
+
+
+def main():
+    cases = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    check_random(cases)
+
+    print("%-10s %14s %14s %14s" % ("bundles", "filter/s", "index+pick/s", "pick/s"))
+    rng = random.Random(1)
+    for count in (2, 10, 50, 200, 1000):
+        buckets = random_buckets(rng, count)
+        rows = [credit_debit.BundleRow(b.bundle_id, b.state, b.end_date, b.cosp_id, b.bucket_id, str(b.counter))
+                for b in buckets]
+        index = credit_debit.BucketIndex(buckets, CURRENT_DATE)
+        print("%-10d %14.0f %14.0f %14.0f" % (
+            count,
+            rate(lambda: filter_rows(rows, 250000), seconds),
+            rate(lambda: credit_debit.BucketIndex(buckets, CURRENT_DATE).pick(250000), seconds),
+            rate(lambda: index.pick(250000), seconds)))
+
+
+if __name__ == '__main__':
+    main()
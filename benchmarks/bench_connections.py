@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+"""
+Title: Connections opened per input line, per-call requests vs the shared SoapTransport
+Script Name: bench_connections.py
+
+Runs the same bulk file against the local eSM stub twice: once with every SOAP
+call going through a fresh requests.request (the old behaviour) and once through
+the pooled keep-alive SoapTransport, and reports the TCP connections the stub
+accepted per line.
+
+Usage: python benchmarks/bench_connections.py [lines] [workers]
+"""
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import requests
+import credit_debit
+import esm_stub
+
+
+class PerCallTransport(credit_debit.SoapTransport):
+    """
+    Transport reproducing the old behaviour of one requests.request per SOAP call.
+    """
+
+    def post(self, data):
+        return requests.request("POST", self.url, headers=dict(self.session.headers), data=data, timeout=self.timeout)
+
+
+def make_config(port):
+    """
+    Builds a configuration pointing at the stub.
+
+    Args:
+        port (int): Port of the stub gateway.
+
+    Returns:
+        ConfigParser.ConfigParser: The configuration.
+    """
+    cf = ConfigParser.ConfigParser(allow_no_value=True)
+    cf.add_section('parameters')
+    for name, value in [
+            ('soap_url', esm_stub.SOAP_ENV + ',' + esm_stub.ESM_NS),
+            ('eSM_url', '127.0.0.1,%d,esm/services' % port),
+            ('header', 'Content-Type,text/xml,charset=utf-8'),
+            ('key', ''), ('Soap_username', 'bench'), ('Soap_password', 'bench'),
+            ('acct_query_names', 'QueryAccount,MSISDN,Account,Country,Type,State,Lang,Scope,Balance'),
+            ('bundle_query_names', 'QueryBundles,MSISDN,Bundles,' + ','.join(esm_stub.BUNDLE_FIELDS)),
+            ('main_adj_names', 'AdjustBalance,MSISDN,AdjustMethod,Notify,Validity,Amount'),
+            ('bucket_adj_names', 'AddBundle,MSISDN,BundleID,AdjustBucket,BucketID,AdjustMethod,Amount')]:
+        cf.set('parameters', name, value)
+    return cf
+
+
+def write_input(path, lines):
+    """
+    Writes a bulk file mixing main and bonus credits and debits.
+
+    Args:
+        path (str): File to write.
+        lines (int): Number of lines.
+    """
+    operations = ['main -5', 'main +10', 'bonus +2 MAA', 'main +1 bonus +1 MA4']
+    with open(path, 'w') as file:
+        for i in range(lines):
+            file.write('80312%05d %s\n' % (i, operations[i % len(operations)]))
+
+
+def run(transport_class, input_file, lines, workers):
+    """
+    Runs the bulk file once against a fresh stub.
+
+    Args:
+        transport_class (type): Transport used for the SOAP calls.
+        input_file (str): Bulk file.
+        lines (int): Number of lines in the file.
+        workers (int): Bulk worker threads.
+
+    Returns:
+        tuple: Connections opened, SOAP requests sent and elapsed seconds.
+    """
+    server = esm_stub.start_stub()
+    cf = make_config(server.server_address[1])
+    envelopes, pooled, session_id = credit_debit.session_login(['bench'], cf)
+    transport = transport_class(pooled.url, {'Content-Type': 'text/xml; charset=utf-8'}, pool_size=workers)
+    outdir = tempfile.mkdtemp()
+    # A ledger of this run only, so every run sends the whole file
+    cf.set('parameters', 'ledger_file', os.path.join(outdir, 'ledger.sqlite'))
+    now = datetime.datetime.now()
+    before = dict(server.gateway.counters)
+    started = time.time()
+    try:
+        credit_debit.process_bulk_file(session_id, input_file, now.strftime("%Y%m%d%H%M"), cf, envelopes, transport,
+                                       outdir, now, workers)
+        elapsed = time.time() - started
+    finally:
+        transport.close()
+        pooled.close()
+        server.shutdown()
+        shutil.rmtree(outdir)
+    counters = server.gateway.counters
+    return (counters['connections'] - before['connections'], counters['requests'] - before['requests'], elapsed)
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    workdir = tempfile.mkdtemp()
+    input_file = os.path.join(workdir, 'bench_input.txt')
+    write_input(input_file, lines)
+    print("%d lines, %d workers" % (lines, workers))
+    print("%-22s %12s %12s %14s %10s" % ("transport", "connections", "requests", "conns/line", "lines/s"))
+    for name, transport_class in [("requests.request", PerCallTransport), ("SoapTransport", credit_debit.SoapTransport)]:
+        connections, sent, elapsed = run(transport_class, input_file, lines, workers)
+        print("%-22s %12d %12d %14.3f %10.1f" % (name, connections, sent, float(connections) / lines, lines / elapsed))
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+
+"""
+Title: End to end throughput of bulk runs against the local eSM stub
+Script Name: bench_e2e.py
+
+Runs bulk files of each size, 10k, 100k and 1M lines by default, through the
+same login and process_bulk_file steps main() takes, or through the asyncio
+client, against esm_stub.py running in its own process. Each run is a fresh
+process against a fresh stub, so results do not depend on the runs before.
+Reports lines/sec, the p99 latency of the Retrieve and Submit calls and of a
+line's submit stage, and the peak RSS of the run.
+
+--save writes the results to a JSON file; --baseline compares them with such
+a file and exits with status 1 when a run is slower, or holds more memory,
+than the baseline by more than --tolerance.
+
+The stub is a threaded Python server and can itself limit the rate of large
+runs; compare results taken on the same machine with the same stub settings.
+
+Usage: python benchmarks/bench_e2e.py [--sizes 10000,100000,1000000] [--workers 16] [--async]
+                                      [--latency-ms MS] [--jitter-ms MS] [--latency-dist DIST] [--fault-rate RATE]
+                                      [--bundles N] [--bundles-max N] [--save FILE] [--baseline FILE]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, ROOT_DIR)
+
+import credit_debit
+import esm_stub
+from bench_connections import make_config, write_input
+
+
+def free_port():
+    """
+    Returns:
+        int: A TCP port nothing listens on.
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_stub(options):
+    """
+    Starts esm_stub.py in its own process and waits until it accepts connections.
+
+    Returns:
+        tuple: The stub process and its port.
+    """
+    port = free_port()
+    stub = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'esm_stub.py'),
+                             '--latency-ms', str(options.latency_ms), '--jitter-ms', str(options.jitter_ms),
+                             '--latency-dist', options.latency_dist, '--fault-rate', str(options.fault_rate),
+                             '--bundles', str(options.bundles), '--bundles-max', str(options.bundles_max), str(port)],
+                            stdout=subprocess.PIPE)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return stub, port
+        except socket.error:
+            time.sleep(0.1)
+    stub.kill()
+    raise RuntimeError("esm_stub.py did not start on port %d" % port)
+
+
+def run_job(input_file, port, workers, use_async):
+    """
+    Runs one bulk file as main() would, in this process, and prints its results as JSON.
+    """
+    outdir = tempfile.mkdtemp()
+    cf = make_config(port)
+    for name, value in (('bulk_workers', workers), ('quiet', 'yes'), ('metrics_interval', 3600),
+                        ('metrics_file', os.path.join(outdir, 'metrics.json')),
+                        ('ledger_file', os.path.join(outdir, 'ledger.sqlite'))):
+        cf.set('parameters', name, str(value))
+    now = datetime.datetime.now()
+    current_date = now.strftime("%Y%m%d%H%M")
+    stdout = sys.stdout
+    # The run prints its own summaries, only the JSON line goes to the parent
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        if use_async:
+            import esm_async
+            esm_async.main(['bench'], cf, [input_file], current_date, outdir, now)
+        else:
+            envelopes, transport, session_id = credit_debit.session_login(['bench'], cf)
+            credit_debit.process_bulk_file(session_id, input_file, current_date, cf, envelopes, transport, outdir, now,
+                                           workers)
+            transport.close()
+    finally:
+        sys.stdout = stdout
+    with open(os.path.join(outdir, 'metrics.json')) as file:
+        metrics = json.load(file)
+    shutil.rmtree(outdir)
+    print(json.dumps({'metrics': metrics, 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def measure(options, size, workdir):
+    """
+    Runs a bulk file of size lines in a new process against a new stub.
+
+    Returns:
+        dict: lines_per_sec, retrieve_p99_ms, submit_p99_ms, line_submit_p99_ms and peak_rss_mb of the run.
+    """
+    input_file = os.path.join(workdir, 'bench_%d.txt' % size)
+    write_input(input_file, size)
+    stub, port = start_stub(options)
+    try:
+        command = [sys.executable, os.path.abspath(__file__), '--job', input_file, '--port', str(port),
+                   '--workers', str(options.workers)] + (['--async'] if options.use_async else [])
+        output = subprocess.check_output(command).decode('utf-8')
+    finally:
+        stub.kill()
+        stub.wait()
+        os.remove(input_file)
+    job = json.loads(output.strip().splitlines()[-1])
+    metrics = job['metrics']
+    calls, stages = metrics['calls'], metrics['stages']
+    return {'lines_per_sec': metrics['lines'] / metrics['elapsed_seconds'],
+            'retrieve_p99_ms': calls.get('Retrieve', {}).get('p99_ms', 0.0),
+            'submit_p99_ms': calls.get('Submit', {}).get('p99_ms', 0.0),
+            'line_submit_p99_ms': stages.get('submit', {}).get('p99_ms', 0.0),
+            'peak_rss_mb': job['peak_rss_kb'] / 1024.0}
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Compares results with a baseline of the same runs.
+
+    Returns:
+        list: Description of each measure worse than the baseline by more than tolerance.
+    """
+    found = []
+    for run, result in sorted(results.items()):
+        base = baseline.get(run)
+        if base is None:
+            continue
+        if result['lines_per_sec'] < base['lines_per_sec'] * (1 - tolerance):
+            found.append("%s: %.1f lines/sec, baseline %.1f" % (run, result['lines_per_sec'], base['lines_per_sec']))
+        for measure_name in ('submit_p99_ms', 'line_submit_p99_ms', 'peak_rss_mb'):
+            if result[measure_name] > base[measure_name] * (1 + tolerance):
+                found.append("%s: %s %.1f, baseline %.1f" % (run, measure_name, result[measure_name], base[measure_name]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end throughput of bulk runs against the local eSM stub.")
+    parser.add_argument('--sizes', default='10000,100000,1000000', help="comma separated lines per run")
+    parser.add_argument('--workers', type=int, default=16, help="bulk worker threads")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="run on the asyncio client")
+    parser.add_argument('--latency-ms', type=float, default=5.0)
+    parser.add_argument('--jitter-ms', type=float, default=5.0)
+    parser.add_argument('--latency-dist', choices=esm_stub.LATENCY_DISTRIBUTIONS, default='lognormal')
+    parser.add_argument('--fault-rate', type=float, default=0.0)
+    parser.add_argument('--bundles', type=int, default=2)
+    parser.add_argument('--bundles-max', type=int, default=8)
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON file of earlier results to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="share a measure may be worse than the baseline")
+    parser.add_argument('--job', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.job:
+        run_job(options.job, options.port, options.workers, options.use_async)
+        return
+
+    engine = 'async' if options.use_async else 'threads'
+    print("%s engine, %d workers, stub latency %s %.1f ms +%.1f ms, %d-%d bundles, %.1f%% faults"
+          % (engine, options.workers, options.latency_dist, options.latency_ms, options.jitter_ms, options.bundles,
+             max(options.bundles, options.bundles_max), options.fault_rate * 100))
+    print("%10s %12s %14s %14s %16s %14s" % ("lines", "lines/s", "Retrieve p99", "Submit p99", "line submit p99",
+                                            "peak RSS MB"))
+    workdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for size in [int(size) for size in options.sizes.split(',')]:
+            result = results["%s/%d" % (engine, size)] = measure(options, size, workdir)
+            print("%10d %12.1f %14.1f %14.1f %16.1f %14.1f" % (size, result['lines_per_sec'], result['retrieve_p99_ms'],
+                                                              result['submit_p99_ms'], result['line_submit_p99_ms'],
+                                                              result['peak_rss_mb']))
+    finally:
+        shutil.rmtree(workdir)
+    if options.save:
+        with open(options.save, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as file:
+            baseline = json.load(file)
+        if not set(results) & set(baseline):
+            print("%s holds none of these runs to compare with" % options.baseline)
+            return
+        found = regressions(results, baseline, options.tolerance)
+        for line in found:
+            print("REGRESSION " + line)
+        if found:
+            sys.exit(1)
+        print("No regression against %s" % options.baseline)
+
+
+if __name__ == '__main__':
+    main()
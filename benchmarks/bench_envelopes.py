@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+"""
+Title: Envelopes per second, per-call str.format vs the pre-rendered EnvelopeBuilder
+Script Name: bench_envelopes.py
+
+The per-call path reproduces what get_sub_info, balance_adjustment and
+bucket_adjustment did before the builder: read and split the XML names from
+ConfigParser, then str.format the full template, on every call.
+
+Usage: python benchmarks/bench_envelopes.py [iterations]
+"""
+
+import os
+import re
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import credit_debit
+from bench_connections import make_config
+
+SESSION_ID = "3f2a9c1e7d5b4a60b1c2d3e4f5a6b7c8"
+MSISDN = "2348031234567"
+REQ_ID = "a1b2c3d4e5f60718"
+
+
+def per_call_retrieve(cf, soap_url):
+    sub_xml_names = cf.get('parameters', 'acct_query_names').split(',')
+    bid_xml_names = cf.get('parameters', 'bundle_query_names').split(',')
+    return credit_debit.RETRIEVE_TEMPLATE.format(session_id=SESSION_ID, msisdn=MSISDN, soap_url=soap_url,
+                                                 sub_xml_names=sub_xml_names, bid_xml_names=bid_xml_names)
+
+
+def per_call_balance(cf, soap_url):
+    bal_xml_names = cf.get('parameters', 'main_adj_names').split(',')
+    return credit_debit.BALANCE_ADJUST_TEMPLATE.format(session_id=SESSION_ID, msisdn=MSISDN, amount=150.0,
+                                                       adjust_method='INCR', req_id=REQ_ID, soap_url=soap_url,
+                                                       bal_xml_names=bal_xml_names)
+
+
+def per_call_bucket(cf, soap_url):
+    buc_xml_names = cf.get('parameters', 'bucket_adj_names').split(',')
+    return credit_debit.BUCKET_ADJUST_TEMPLATE.format(session_id=SESSION_ID, msisdn=MSISDN, amount=20000,
+                                                      bucket_id='MAA', adjust_method='INCR', req_id=REQ_ID,
+                                                      soap_url=soap_url,
+                                                      buc_xml_names=buc_xml_names)
+
+
+def canonical(envelope):
+    """
+    Reduces an envelope to its elements and non-blank text, for comparing the two paths.
+    """
+    if isinstance(envelope, bytes):
+        envelope = envelope.decode('utf-8')
+    envelope = re.sub(r"<!--.*?-->", "", envelope, flags=re.DOTALL)
+    return [(e.tag, (e.text or "").strip()) for e in ET.fromstring(envelope.strip()).iter()]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    cf = make_config(8080)
+    soap_url = cf.get('parameters', 'soap_url').split(',')
+    envelopes = credit_debit.EnvelopeBuilder(cf, soap_url)
+    cases = [
+        ("retrieve", lambda: per_call_retrieve(cf, soap_url), lambda: envelopes.retrieve(SESSION_ID, MSISDN)),
+        ("balance adjust", lambda: per_call_balance(cf, soap_url),
+         lambda: envelopes.balance_adjustment(SESSION_ID, MSISDN, 150.0, 'INCR', REQ_ID)),
+        ("bucket adjust", lambda: per_call_bucket(cf, soap_url),
+         lambda: envelopes.bucket_adjustment(SESSION_ID, MSISDN, 20000, 'MAA', 'INCR', REQ_ID)),
+    ]
+    print("%-16s %14s %14s %9s %14s %14s" % ("envelope", "format/s", "builder/s", "speedup", "format bytes", "builder bytes"))
+    for name, per_call, built in cases:
+        assert canonical(per_call()) == canonical(built()), name
+        old = iterations / min(timeit.repeat(per_call, number=iterations, repeat=3))
+        new = iterations / min(timeit.repeat(built, number=iterations, repeat=3))
+        print("%-16s %14.0f %14.0f %8.1fx %14d %14d" % (name, old, new, new / old, len(per_call()), len(built())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+"""
+Title: Memory held by cached subscribers, positional tuples vs SubscriberState records
+Script Name: bench_memory.py
+
+Builds the same subscribers, each with a few bonus bundles and the always-on
+bundle, once in the nested tuple and list layout get_sub_info returned before
+SubscriberState and once as SubscriberState records, keeps them all in a dict
+as the subscriber cache does, and reports the memory each layout holds.
+
+The strings of each subscriber are built apart, as parse_response builds them
+from every response, so equal values are not shared unless the layout shares
+them itself.
+
+Usage: python3 benchmarks/bench_memory.py [subscribers] [bundles per subscriber]
+"""
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import credit_debit
+
+
+def fresh(*parts):
+    """
+    Joins parts into a new string object, as a value read from a response would be.
+    """
+    return "".join(parts)
+
+
+def tasks(i, bundles):
+    """
+    Builds the account and bundle task results of subscriber i.
+
+    Returns:
+        tuple: MSISDN, account TaskResult and bundle TaskResult.
+    """
+    msisdn = "23480%08d" % i
+    account = credit_debit.TaskResult(fresh("SUCC", "ESS"), fresh("SUCC", "ESS"))
+    account.attributes = [("MSISDN", fresh(msisdn)), ("Country", fresh("NG", "A")), ("Type", fresh("PRE", "PAID")),
+                          ("State", fresh("ACT", "_ACTIVE")), ("Language", fresh("E", "N")), ("Zone", fresh("AL", "L")),
+                          ("Balance", "%d" % (1000000 + i))]
+    bundle_task = credit_debit.TaskResult(fresh("Bundle", "Query"), fresh("SUCC", "ESS"))
+    for n in range(bundles):
+        bundle_task.bundles.append(credit_debit.BundleRow(
+            "%d_MA" % n, fresh("ACT", "IVE"), "2030%02d01000000" % (1 + (i + n) % 12), fresh("10", "01"),
+            fresh("MA", "A" if n % 2 else "4"), "%d" % (250000 + n)))
+    bundle_task.bundles.append(credit_debit.BundleRow(
+        fresh(credit_debit.ALWAYSON_BUNDLE_ID), fresh("ACT", "IVE"), fresh(""), fresh("10", "01"), fresh("DA", "1"),
+        "0"))
+    return msisdn, account, bundle_task
+
+
+def legacy_sub_info(msisdn, account, bundle_task):
+    """
+    The get_sub_info result before SubscriberState.
+    """
+    main_status = account.status if account.status else 'FAILURE'
+    result = [value for name, value in account.attributes[:7]] if main_status == 'SUCCESS' else [msisdn]
+    bundles = bundle_task.bundles
+    return (main_status, result, bundle_task.status,
+            [row for row in bundles if credit_debit.BONUS_BUNDLE_ID.match(row.bundle_id)],
+            [row for row in bundles if row.bundle_id == credit_debit.ALWAYSON_BUNDLE_ID])
+
+
+def measure(build, count, bundles):
+    """
+    Caches count subscribers built by build.
+
+    Returns:
+        tuple: Bytes held by the cache and the seconds taken to fill it.
+    """
+    gc.collect()
+    tracemalloc.start()
+    started = time.time()
+    cache = {}
+    for i in range(count):
+        msisdn, account, bundle_task = tasks(i, bundles)
+        cache[msisdn] = build(msisdn, account, bundle_task)
+    elapsed = time.time() - started
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del cache
+    return held, elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    bundles = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    print("%d subscribers, %d bonus bundles each" % (count, bundles))
+    print("%-18s %10s %14s %10s" % ("layout", "MB", "bytes/sub", "seconds"))
+    for name, build in (("tuples", legacy_sub_info), ("SubscriberState", credit_debit.sub_info_from_tasks)):
+        held, elapsed = measure(build, count, bundles)
+        print("%-18s %10.1f %14.1f %10.1f" % (name, held / 1048576.0, float(held) / count, elapsed))
+
+
+if __name__ == '__main__':
+    main()
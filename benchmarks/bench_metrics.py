@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+"""
+Title: Accuracy and cost of the run metrics histograms
+Script Name: bench_metrics.py
+
+Checks the p50/p95/p99 LatencyHistogram reports against the exact
+quantiles of random latency samples, then times recording a call and a
+stage in RunMetrics from several threads at once, the cost the bulk
+workers pay for each SOAP call and stage.
+
+Usage: python benchmarks/bench_metrics.py [samples per check] [threads]
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from credit_debit import LatencyHistogram, RunMetrics
+
+# A bucket spans a factor of 10 ** (1 / 20.0), about 12%
+TOLERANCE = 10 ** (1 / 20.0)
+
+
+def check_quantiles(samples):
+    """
+    Raises:
+        AssertionError: If a quantile is not within a bucket of the exact one.
+    """
+    rng = random.Random(3)
+    for name, draw in (("lognormal", lambda: rng.lognormvariate(-3, 1)),
+                       ("uniform", lambda: rng.uniform(0.001, 2.0)),
+                       ("bimodal", lambda: rng.choice((0.005, 0.8)) * rng.uniform(0.9, 1.1))):
+        values = sorted(draw() for _ in range(samples))
+        histogram = LatencyHistogram()
+        for value in values:
+            histogram.add(value)
+        for q in (0.5, 0.95, 0.99):
+            exact = values[max(int(q * samples + 0.5) - 1, 0)]
+            reported = histogram.quantile(q)
+            assert exact / TOLERANCE <= reported <= exact * TOLERANCE, (name, q, exact, reported)
+    print("p50, p95 and p99 of %d samples within %.0f%% for lognormal, uniform and bimodal latencies"
+          % (samples, (TOLERANCE - 1) * 100))
+
+
+def time_recording(threads, calls=200000):
+    """
+    Returns:
+        float: Microseconds per recorded call and stage, with all threads recording.
+    """
+    metrics = RunMetrics()
+
+    def record():
+        for i in range(calls):
+            metrics.call('Submit', 0.01 + i % 100 / 10000.0, True, 1500, 600)
+            metrics.stage('submit', 0.012)
+
+    workers = [threading.Thread(target=record) for _ in range(threads)]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.time() - started) / (calls * threads) * 1000000
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    check_quantiles(samples)
+    for count in (1, threads):
+        print("%d threads: %.2f us to record a call and a stage" % (count, time_recording(count)))
+
+
+if __name__ == '__main__':
+    main()
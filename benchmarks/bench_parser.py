@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+"""
+Title: Retrieve response parsing throughput, regex scraping vs the single-pass parser
+Script Name: bench_parser.py
+
+Builds RetrieveRequest responses with the local stub for subscribers holding
+more and more bundles and times the old get_sub_info scraping (DOTALL regex over
+the payload, join, re-scan with the bundle patterns) against parse_response.
+
+Usage: python benchmarks/bench_parser.py [seconds per case]
+"""
+
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import credit_debit
+import esm_stub
+from bench_connections import make_config
+
+PATTERN = r"<Name>(.*?)</Name>.*?<[V|R].*?>(.*?)</[V|R].*?>"
+PATTERN1 = (r'Bundle\sID\s(bdl\w+|\d+_\w\w|\d\d{1})\sBundle\sState\s(\S*)\sEnd\sDate\sTime\s(\S*)\sTariff\sPlan'
+            r'\sCOSP\sID\s(\S*)\sBucket/Discount\sID\s1\s(\S*)\sBucket/UBD\sCounter\s1\s(\S*)')
+PATTERN2 = (r'Bundle\sID\s(sbcALWAYSON)\sBundle\sState\s(\S*)\sEnd\sDate\sTime\s(\S*)\sTariff\sPlan'
+            r'\sCOSP\sID\s(\S*)\sBucket/Discount\sID\s1\s(\S*)\sBucket/UBD\sCounter\s1\s(\S*)')
+
+
+def scrape(payload, msisdn):
+    """
+    The response handling get_sub_info used before parse_response.
+    """
+    xml_data = payload.decode('utf-8')
+    ET.fromstring(payload)
+    match_list = re.findall(PATTERN, xml_data, re.DOTALL)
+    result = [value[1] if match_list[0][1] == 'SUCCESS' else msisdn for value in match_list[1:8]]
+    match_str = " ".join([" ".join([match[0], match[1]]) for match in match_list[9:]])
+    main_status = match_list[0][1] if match_list[0][1] else 'FAILURE'
+    bonus_status = match_list[8][1] if main_status == 'SUCCESS' else 'FAILURE'
+    return main_status, result, bonus_status, re.findall(PATTERN1, match_str), re.findall(PATTERN2, match_str)
+
+
+def parse(payload, task_names):
+    tasks = credit_debit.parse_response(payload, task_names).tasks
+    bundles = tasks[1].bundles
+    return (tasks[0].status, [value for name, value in tasks[0].attributes[:7]], tasks[1].status,
+            [row for row in bundles if credit_debit.BONUS_BUNDLE_ID.match(row.bundle_id)],
+            [row for row in bundles if row.bundle_id == credit_debit.ALWAYSON_BUNDLE_ID])
+
+
+def rate(func, seconds):
+    """
+    Calls func repeatedly for about the given time.
+
+    Returns:
+        float: Calls per second.
+    """
+    calls, started = 0, time.time()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.time() - started
+        if elapsed >= seconds:
+            return calls / elapsed
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    cf = make_config(8080)
+    envelopes = credit_debit.EnvelopeBuilder(cf, cf.get('parameters', 'soap_url').split(','))
+    msisdn = "2348031234567"
+    print("%8s %10s %14s %14s %14s %9s" % ("bundles", "bytes", "regex/s", "parser/s", "parser MB/s", "speedup"))
+    for bundles in (2, 10, 50, 200, 1000):
+        gateway = esm_stub.StubGateway(bundles_per_sub=bundles)
+        gateway.sessions['bench'] = 0
+        payload = gateway.handle(envelopes.retrieve('bench', msisdn)).encode('utf-8')
+        old, new = scrape(payload, msisdn), parse(payload, envelopes.task_names)
+        assert old[:3] == new[:3] and [tuple(r) for r in new[3]] == old[3], bundles
+        old_rate = rate(lambda: scrape(payload, msisdn), seconds)
+        new_rate = rate(lambda: parse(payload, envelopes.task_names), seconds)
+        print("%8d %10d %14.0f %14.0f %14.1f %8.1fx" % (bundles, len(payload), old_rate, new_rate,
+                                                         new_rate * len(payload) / 1e6, new_rate / old_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+"""
+Title: Throttling faults with and without the adaptive rate limiter
+Script Name: bench_rate_limit.py
+
+Runs the same bulk file against a local eSM stub that throttles above a fixed
+number of requests per second, once with no rate limit and once with a
+rate_limit ceiling well above the stub's capacity, and reports the throttling
+faults, failed lines and the rate the limiter settled at.
+
+Usage: python benchmarks/bench_rate_limit.py [lines] [workers] [capacity] [ceiling]
+"""
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import credit_debit
+import esm_stub
+from bench_connections import make_config, write_input
+
+
+def run(input_file, lines, workers, capacity, ceiling):
+    """
+    Runs the bulk file once against a fresh throttling stub.
+
+    Args:
+        input_file (str): Bulk file.
+        lines (int): Number of lines in the file.
+        workers (int): Bulk worker threads.
+        capacity (int): Requests per second the stub serves before throttling.
+        ceiling (float): rate_limit setting, 0 for no limiter.
+
+    Returns:
+        tuple: Requests sent, throttling faults, failed lines, elapsed seconds and the final rate.
+    """
+    server = esm_stub.start_stub(latency=0.005, capacity=capacity)
+    cf = make_config(server.server_address[1])
+    cf.set('parameters', 'bulk_workers', str(workers))
+    cf.set('parameters', 'rate_limit', str(ceiling))
+    # Every run sends the whole file
+    cf.set('parameters', 'ledger_file', 'off')
+    # Let the login through before the throttling window starts counting
+    time.sleep(1)
+    envelopes, transport, session_id = credit_debit.session_login(['bench'], cf)
+    outdir = tempfile.mkdtemp()
+    now = datetime.datetime.now()
+    started = time.time()
+    try:
+        credit_debit.process_bulk_file(session_id, input_file, now.strftime("%Y%m%d%H%M"), cf, envelopes, transport,
+                                       outdir, now, workers)
+        elapsed = time.time() - started
+        written = 0
+        for name in [name for name in os.listdir(outdir) if name.startswith('debit_credit_')]:
+            with open(os.path.join(outdir, name)) as file:
+                written += sum(1 for line in file if 'SUCCESS' in line)
+    finally:
+        transport.close()
+        server.shutdown()
+        shutil.rmtree(outdir)
+    counters = server.gateway.counters
+    rate = transport.limiter.rate if transport.limiter is not None else 0.0
+    return counters['requests'], counters['throttled'], lines - written, elapsed, rate
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    capacity = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+    ceiling = float(sys.argv[4]) if len(sys.argv) > 4 else 2000.0
+    workdir = tempfile.mkdtemp()
+    input_file = os.path.join(workdir, 'bench_input.txt')
+    write_input(input_file, lines)
+    print("%d lines, %d workers, stub capacity %d requests/s" % (lines, workers, capacity))
+    print("%-16s %10s %10s %10s %10s %12s" % ("rate_limit", "requests", "throttled", "failed", "lines/s", "final rate"))
+    for limit in (0, ceiling):
+        sent, throttled, failed, elapsed, rate = run(input_file, lines, workers, capacity, limit)
+        print("%-16s %10d %10d %10d %10.1f %12.1f" % (limit or "none", sent, throttled, failed, lines / elapsed, rate))
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+"""
+Title: Load test of the HTTP/JSON service, with and without request coalescing
+Script Name: bench_service.py
+
+Starts esm_stub.py and the esm_service.py service, each in its own process,
+and has concurrent clients post credits and debits, with a balance query
+every few requests, over keep-alive connections. Each client works on its
+own subscribers. Runs once for each coalescing window, 0 ms sending every
+lookup and adjustment on its own, and reports requests/sec, the p50 and p99
+request latency, and the Retrieve and Submit calls the service made per
+request.
+
+Usage: python benchmarks/bench_service.py [--clients 50] [--requests 2000] [--windows 0,5]
+                                          [--batch 100] [--latency-ms MS] [--jitter-ms MS]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import esm_stub
+from bench_connections import make_config
+from bench_e2e import free_port, start_stub
+
+OPERATIONS = [('debit', {'main': '5'}), ('credit', {'main': '10'}), ('credit', {'bonus': '2', 'bucket': 'MAA'}),
+              ('debit', {'bonus': '1'}), ('credit', {'main': '1', 'bonus': '1', 'bucket': 'MA4'})]
+
+
+def serve(stub_port, port, window, batch):
+    """
+    Runs the service against the stub until killed.
+    """
+    import tempfile
+    import esm_service
+    cf = make_config(stub_port)
+    outdir = tempfile.mkdtemp()
+    for name, value in (('service_window_ms', window), ('service_batch_size', batch), ('http_pool_size', 20),
+                        ('ledger_file', 'off'), ('quiet', 'yes')):
+        cf.set('parameters', name, str(value))
+    server = esm_service.ServiceServer(('127.0.0.1', port), esm_service.AdjustmentService(['bench'], cf, outdir))
+    server.serve_forever()
+
+
+def client(port, k, count, latencies, errors):
+    """
+    Sends count requests on one keep-alive connection, for subscribers of its own.
+    """
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    for i in range(count):
+        msisdn = '2348031%03d%03d' % (k, i % 20)
+        if i % 5 == 4:
+            method, path, body = 'GET', '/balance/' + msisdn, None
+        else:
+            kind, fields = OPERATIONS[i % len(OPERATIONS)]
+            fields = dict(fields, msisdn=msisdn)
+            method, path, body = 'POST', '/' + kind, json.dumps(fields)
+        started = time.time()
+        conn.request(method, path, body, {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.time() - started)
+        if response.status != 200:
+            errors.append(response.status)
+
+
+def get_json(port, path):
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', path)
+    return json.loads(conn.getresponse().read().decode('utf-8'))
+
+
+def measure(options, stub_port, window):
+    """
+    Runs the clients against a service with the given coalescing window.
+
+    Returns:
+        dict: requests_per_sec, p50_ms, p99_ms, retrieves and submits per request, and errors.
+    """
+    port = free_port()
+    service = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(stub_port), str(port),
+                                str(window), str(options.batch)], stdout=subprocess.PIPE)
+    try:
+        for _ in range(100):
+            try:
+                get_json(port, '/stats')
+                break
+            except (IOError, OSError):
+                time.sleep(0.1)
+        latencies, errors = [], []
+        per_client = max(options.requests // options.clients, 1)
+        clients = [threading.Thread(target=client, args=(port, k, per_client, latencies, errors))
+                   for k in range(options.clients)]
+        started = time.time()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.time() - started
+        stats = get_json(port, '/stats')
+    finally:
+        service.kill()
+        service.wait()
+    latencies.sort()
+    requests = len(latencies)
+    return {'requests_per_sec': requests / elapsed, 'p50_ms': latencies[requests // 2] * 1000,
+            'p99_ms': latencies[min(int(requests * 0.99), requests - 1)] * 1000,
+            'retrieves_per_request': stats['lookups']['retrieves'] / float(requests),
+            'submits_per_request': stats['adjustments']['submits'] / float(requests), 'errors': len(errors)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the HTTP/JSON service against the local eSM stub.")
+    parser.add_argument('--clients', type=int, default=50, help="concurrent clients")
+    parser.add_argument('--requests', type=int, default=2000, help="requests over all clients")
+    parser.add_argument('--windows', default='0,5', help="comma separated coalescing windows in ms")
+    parser.add_argument('--batch', type=int, default=100, help="lookups or adjustments per batched call")
+    parser.add_argument('--latency-ms', type=float, default=5.0)
+    parser.add_argument('--jitter-ms', type=float, default=5.0)
+    parser.add_argument('--latency-dist', choices=esm_stub.LATENCY_DISTRIBUTIONS, default='lognormal')
+    parser.add_argument('--serve', nargs=4, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.serve:
+        stub_port, port, window, batch = options.serve
+        serve(int(stub_port), int(port), float(window), int(batch))
+        return
+
+    # Stub options bench_e2e.start_stub takes, with the bundles and faults of its defaults
+    options.fault_rate, options.bundles, options.bundles_max = 0.0, 2, 8
+    print("%d clients, %d requests, stub latency %s %.1f ms +%.1f ms"
+          % (options.clients, options.requests, options.latency_dist, options.latency_ms, options.jitter_ms))
+    print("%10s %12s %10s %10s %14s %14s %8s" % ("window ms", "requests/s", "p50 ms", "p99 ms", "Retrieve/req",
+                                                 "Submit/req", "errors"))
+    for window in [float(window) for window in options.windows.split(',')]:
+        stub, stub_port = start_stub(options)
+        try:
+            result = measure(options, stub_port, window)
+        finally:
+            stub.kill()
+            stub.wait()
+        print("%10.1f %12.1f %10.1f %10.1f %14.3f %14.3f %8d"
+              % (window, result['requests_per_sec'], result['p50_ms'], result['p99_ms'],
+                 result['retrieves_per_request'], result['submits_per_request'], result['errors']))
+
+
+if __name__ == '__main__':
+    main()
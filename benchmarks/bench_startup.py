@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+"""
+Title: Latency of single-MSISDN invocations, with a login, a cached session or the daemon
+Script Name: bench_startup.py
+
+Runs one single-MSISDN command per process, the way ops run the script from
+shell loops, against the local eSM stub: logging in and out on every run, on
+a session cached by the previous run, and handed to a daemon started with
+--daemon. Reports the milliseconds per invocation, from starting the process
+to its exit, the time spent importing credit_debit, and the logins the stub
+saw.
+
+Usage: python benchmarks/bench_startup.py [runs per mode] [stub latency ms]
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+
+COMMAND = "8031200001 main +1"
+
+
+def run_job(mode, config_path, workdir):
+    """
+    Runs the command once as a fresh invocation would, and prints what it cost as JSON.
+    """
+    started = time.time()
+    import credit_debit
+    imported = time.time()
+    if mode == 'daemon':
+        credit_debit.daemon_command(os.path.join(workdir, 'bench.sock'), COMMAND, quiet=True)
+    else:
+        import datetime
+        cf, a = credit_debit.load_config(config_path)
+        if mode == 'cached':
+            cf.set('parameters', 'session_cache', os.path.join(workdir, 'sessions.json'))
+        now = datetime.datetime.now()
+        envelopes, transport, session_id = credit_debit.session_login(a, cf)
+        try:
+            credit_debit.single_subscriber(session_id, COMMAND, now.strftime("%Y%m%d%H%M"), cf, envelopes, transport,
+                                           workdir, now, quiet=True)
+        finally:
+            transport.sessions.close()
+            transport.close()
+    print(json.dumps({'import_ms': (imported - started) * 1000}))
+
+
+def serve(config_path, workdir):
+    """
+    Runs the daemon the daemon mode hands its commands to.
+    """
+    import credit_debit
+    daemon = credit_debit.CommandDaemon(config_path, credit_debit.parse_cli([]), workdir)
+    credit_debit.serve_commands(daemon, os.path.join(workdir, 'bench.sock'))
+
+
+def invoke(mode, config_path, workdir):
+    """
+    Returns:
+        tuple: Milliseconds the invocation took, and the JSON its job printed.
+    """
+    started = time.time()
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--job', mode, config_path, workdir])
+    elapsed = (time.time() - started) * 1000
+    return elapsed, json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    if sys.argv[1:2] == ['--job']:
+        run_job(*sys.argv[2:5])
+        return
+    if sys.argv[1:2] == ['--serve']:
+        serve(*sys.argv[2:4])
+        return
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+
+    import credit_debit
+    import esm_stub
+    from bench_connections import make_config
+    stub = esm_stub.start_stub(latency=latency_ms / 1000.0)
+    workdir = tempfile.mkdtemp()
+    config_path = os.path.join(workdir, 'config1.ini')
+    cf = make_config(stub.server_address[1])
+    cf.set('parameters', 'ledger_file', 'off')
+    cf.set('parameters', 'metrics', 'no')
+    with open(config_path, 'w') as file:
+        cf.write(file)
+    daemon = None
+    print("%d runs per mode, stub latency %.0f ms" % (runs, latency_ms))
+    print("%-8s %10s %10s %10s %12s %8s" % ("mode", "mean ms", "p50 ms", "p95 ms", "import ms", "logins"))
+    try:
+        for mode in ('login', 'cached', 'daemon'):
+            if mode == 'daemon':
+                daemon = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', config_path, workdir])
+                while not credit_debit.daemon_listening(os.path.join(workdir, 'bench.sock')):
+                    time.sleep(0.05)
+            logins = stub.gateway.counters['logins']
+            results = [invoke(mode, config_path, workdir) for _ in range(runs)]
+            times = sorted(elapsed for elapsed, _ in results)
+            print("%-8s %10.1f %10.1f %10.1f %12.1f %8d"
+                  % (mode, sum(times) / runs, times[runs // 2], times[min(int(runs * 0.95), runs - 1)],
+                     sum(job['import_ms'] for _, job in results) / runs, stub.gateway.counters['logins'] - logins))
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        stub.shutdown()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
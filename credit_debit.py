@@ -8,807 +8,5174 @@ Script Name: credit_debit.py
 
 # Importing required modules and functions
 import datetime  # For handling date and time
-import requests  # For making HTTP requests
-import xml.etree.ElementTree as ET  # For parsing XML
+import collections  # For the parsed response records
 import os  # For interacting with the operating system
 import sys  # For interacting with the Python interpreter
 import re  # For regular expressions
-import ConfigParser  # For parsing configuration files
+try:
+    import ConfigParser  # For parsing configuration files
+except ImportError:
+    import configparser as ConfigParser
 import logging  # For logging messages
+import atexit  # For draining the log queue at exit
 import time  # For handling time-related operations
+import threading  # For the bulk worker pool
+try:
+    import Queue  # For handing lines and results between bulk workers
+except ImportError:
+    import queue as Queue
+import argparse  # For parsing command line options
+import zlib  # For gzip compressing request bodies
+import json  # For the on-disk session cache
+import hashlib  # For the request ids of the adjustment ledger
+import csv  # For CSV input files
+import gzip  # For gzip compressed input files
+import bz2  # For bzip2 compressed input files
+import bisect  # For picking bonus buckets
+# requests, ElementTree, sqlite3, multiprocessing and logging.handlers take most of the start-up time;
+# they are imported where first used, so single-MSISDN runs handed to a daemon never load them
+
+class SoapTransport(object):
+    """
+    Shared HTTP transport for all SOAP calls.
+
+    Keeps a pool of keep-alive connections to the eSM gateway so consecutive
+    calls reuse the same TCP connection instead of opening a new one each time.
+
+    Args:
+        url (str): URL for the SOAP service.
+        headers (dict): HTTP headers for the request.
+        pool_size (int): Maximum connections kept open to the gateway.
+        timeout (tuple): Connect and read timeouts in seconds.
+        compress (bool): Gzip the request bodies.
+        max_inflight (int): Maximum concurrent SOAP calls, 0 for no limit.
+        limiter (RateLimiter): Paces the calls, None for no rate limit.
+        metrics (RunMetrics): Records the latency and size of each call, None for no metrics.
+    """
+
+    def __init__(self, url, headers, pool_size=1, timeout=(5, 30), compress=False, max_inflight=0, limiter=None,
+                 metrics=None):
+        self.url = url
+        self.timeout = timeout
+        self.metrics = metrics
+        self.compress = compress
+        self.limiter = limiter
+        self.sessions = None  # SessionPool renewing expired sessions, set once logged in
+        self.slots = threading.BoundedSemaphore(max_inflight) if max_inflight else None
+        import requests.adapters  # For making HTTP requests over pooled connections
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(headers)
+        self.session.headers['Connection'] = 'keep-alive'
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        if compress:
+            self.session.headers['Content-Encoding'] = 'gzip'
+
+    def post(self, data):
+        """
+        Sends a SOAP request over a pooled connection.
+
+        Args:
+            data (str): SOAP envelope to send.
+
+        Returns:
+            requests.Response: The HTTP response.
+        """
+        if isinstance(data, type(u"")):
+            data = data.encode('utf-8')
+        if self.sessions is None:
+            return self.paced(data)
+        data = self.sessions.refresh(data)
+        response = self.paced(data)
+        if response.status_code >= 500 and SESSION_FAULT.search(response.content):
+            # The gateway dropped the session, log in again and retry the call once
+            data = self.sessions.renew_in(data)
+            if data is not None:
+                response = self.paced(data)
+        return response
+
+    def paced(self, data):
+        """
+        Compresses a request body and sends it at the pace of the rate limiter.
+
+        Args:
+            data (bytes): Request body.
+
+        Returns:
+            requests.Response: The HTTP response.
+        """
+        operation = soap_operation(data) if self.metrics is not None else None
+        if self.compress:
+            packer = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes the gzip format
+            data = packer.compress(data) + packer.flush()
+        if self.limiter is None and self.metrics is None:
+            return self.send(data)
+        if self.limiter is not None:
+            wait = self.limiter.reserve()
+            if wait:
+                time.sleep(wait)
+        started = time.time()
+        try:
+            response = self.send(data)
+        except Exception:
+            self.record(operation, time.time() - started, False, len(data), 0)
+            raise
+        # SOAP faults, throttling included, come back as server errors
+        self.record(operation, time.time() - started, response.status_code < 500, len(data), len(response.content))
+        return response
+
+    def record(self, operation, latency, ok, sent, received):
+        """
+        Reports a call to the rate limiter and the run metrics.
+
+        Args:
+            operation (str): SOAP operation of the call, see soap_operation.
+            latency (float): Seconds the call took.
+            ok (bool): Whether the call succeeded.
+            sent (int): Bytes of the request body.
+            received (int): Bytes of the response body.
+        """
+        if self.limiter is not None:
+            self.limiter.record(latency, ok)
+        if self.metrics is not None:
+            self.metrics.call(operation, latency, ok, sent, received)
+
+    def send(self, data):
+        """
+        Posts a request body, within the max_inflight limit.
+
+        Args:
+            data (bytes): Request body.
+
+        Returns:
+            requests.Response: The HTTP response.
+        """
+        if self.slots is None:
+            return self.session.post(self.url, data=data, timeout=self.timeout)
+        with self.slots:
+            return self.session.post(self.url, data=data, timeout=self.timeout)
+
+    def close(self):
+        """
+        Closes the pooled connections.
+        """
+        self.session.close()
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all SOAP calls, with an AIMD-adjusted rate.
+
+    The rate starts at the configured ceiling. Every window the latency and
+    failures of the calls made are checked: when the average latency is over
+    the target or too many calls failed, the rate is cut to the backoff factor
+    times the rate actually reached, otherwise, while the callers use most of
+    the rate, it climbs back towards the ceiling by a twentieth of the ceiling
+    per window.
+
+    Args:
+        ceiling (float): Maximum calls per second.
+        floor (float): Rate the backoff never goes below.
+        target_latency (float): Average call latency in seconds considered healthy.
+        max_error_rate (float): Share of failed calls considered healthy.
+        backoff (float): Factor applied to the rate on backoff.
+        window (float): Seconds between rate adjustments.
+    """
+
+    def __init__(self, ceiling, floor=1.0, target_latency=1.0, max_error_rate=0.05, backoff=0.5, window=1.0):
+        self.ceiling = float(ceiling)
+        self.floor = min(float(floor), self.ceiling)
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.backoff = backoff
+        self.window = window
+        self.rate = self.ceiling
+        self.state = 'steady'
+        self.settled = True
+        self.lock = threading.Lock()
+        self.tokens = 1.0
+        self.stamp = time.time()
+        self.window_start = self.stamp
+        self.calls = self.errors = 0
+        self.latency = 0.0
+
+    def reserve(self):
+        """
+        Takes a token for one call.
+
+        Returns:
+            float: Seconds the caller must wait before making the call.
+        """
+        with self.lock:
+            now = time.time()
+            # Allow a burst of up to one second's worth of calls
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def record(self, latency, ok):
+        """
+        Records the outcome of a call and adjusts the rate once per window.
+
+        Args:
+            latency (float): Seconds the call took.
+            ok (bool): Whether the call succeeded.
+        """
+        with self.lock:
+            self.calls += 1
+            self.errors += 0 if ok else 1
+            self.latency += latency
+            now = time.time()
+            if now - self.window_start < self.window:
+                return
+            average, error_rate = self.latency / self.calls, float(self.errors) / self.calls
+            reached = self.calls / (now - self.window_start)
+            self.window_start, self.calls, self.errors, self.latency = now, 0, 0, 0.0
+            if self.state == 'backoff' and not self.settled:
+                # Calls of the window after a backoff were mostly paced at the old rate
+                self.settled = True
+                return
+            if average > self.target_latency or error_rate > self.max_error_rate:
+                self.rate, self.state = max(self.floor, min(self.rate, reached) * self.backoff), 'backoff'
+                self.settled = False
+            elif self.rate < self.ceiling:
+                if reached < self.rate * 0.8:
+                    # The callers are not using the rate there is, raising it would prove nothing
+                    return
+                self.rate, self.state = min(self.ceiling, self.rate + self.ceiling / 20.0), 'recovering'
+            elif self.state != 'steady':
+                self.state = 'steady'
+            else:
+                return
+            logging.info("Rate limiter %s at %.1f calls/sec (latency %.0f ms, errors %.1f%%)",
+                         self.state, self.rate, average * 1000, error_rate * 100)
+
+
+def get_option(cf, name, default, cast=str):
+    """
+    Reads an optional setting from the parameters section of the configuration.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+        name (str): Option name.
+        default: Value returned when the option is missing or empty.
+        cast (callable): Conversion applied to the configured value.
+
+    Returns:
+        The configured value converted with cast, or default.
+    """
+    if cf.has_option('parameters', name):
+        value = cf.get('parameters', name)
+        if value:
+            return cast(value.strip())
+    return default
+
+
+# Configuration files read by load_config: path -> (mtime and size read at, parser, files read)
+CONFIGS = {}
+CONFIGS_LOCK = threading.Lock()
+
+
+def load_config(path):
+    """
+    Reads a configuration file, parsing it again only once it has changed.
+
+    The parsed settings are kept by path with the mtime and size of the file,
+    so a long-running daemon can call this for every command and be given the
+    same parser until the file is edited.
+
+    Args:
+        path (str): Configuration file.
+
+    Returns:
+        tuple: The ConfigParser.ConfigParser, and the list of files read, as ConfigParser.read returns it.
+    """
+    try:
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+    except OSError:
+        key = None
+    with CONFIGS_LOCK:
+        cached = CONFIGS.get(path)
+        if cached is None or key is None or cached[0] != key:
+            cf = ConfigParser.ConfigParser(allow_no_value=True)
+            cached = CONFIGS[path] = (key, cf, cf.read(path))
+        return cached[1], cached[2]
+
+
+def gateway_address(cf):
+    """
+    Reads where and how to reach the eSM gateway from the configuration.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+
+    Returns:
+        tuple: The SOAP namespaces, the URL of the SOAP service and the HTTP headers.
+    """
+    soap_url = cf.get('parameters', 'soap_url').split(',')
+    url_info = cf.get('parameters', 'eSM_url').split(',')  # Default url for the SOAP service
+    url = "http://{}:{}/{}".format(url_info[0], url_info[1], url_info[2])
+    header = cf.get('parameters', 'header').split(',')
+    headers = {header[0]: "; ".join(header[1:])}  # headers for the HTTP request
+    return soap_url, url, headers
+
+
+def rate_limiter(cf):
+    """
+    Builds the rate limiter configured for the SOAP calls.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+
+    Returns:
+        RateLimiter: The limiter, or None when rate_limit is not set.
+    """
+    ceiling = get_option(cf, 'rate_limit', 0.0, float)
+    if ceiling <= 0:
+        return None
+    return RateLimiter(ceiling, floor=get_option(cf, 'rate_limit_min', 1.0, float),
+                       target_latency=get_option(cf, 'rate_target_latency_ms', 1000.0, float) / 1000.0,
+                       max_error_rate=get_option(cf, 'rate_max_error_pct', 5.0, float) / 100.0)
+
+
+class LatencyHistogram(object):
+    """
+    Latencies of one kind of call or stage, counted in log-spaced buckets.
+
+    Buckets are 20 per decade from 0.1 ms to 1000 s, so a quantile is known
+    to within about 12% whatever the number of calls, in constant memory.
+    Not thread safe, RunMetrics adds to it under its lock.
+    """
+
+    BOUNDS = tuple(10 ** (i / 20.0 - 4) for i in range(141))
+
+    __slots__ = ('counts', 'count', 'errors', 'total', 'peak', 'sent', 'received')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = self.errors = self.sent = self.received = 0
+        self.total = self.peak = 0.0
+
+    def add(self, seconds, ok=True, sent=0, received=0):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.errors += not ok
+        self.total += seconds
+        self.peak = max(self.peak, seconds)
+        self.sent += sent
+        self.received += received
+
+    def quantile(self, q):
+        """
+        Returns:
+            float: Upper bound in seconds of the bucket holding the q quantile, at most the slowest latency seen.
+        """
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.BOUNDS[i], self.peak) if i < len(self.BOUNDS) else self.peak
+        return 0.0
+
+
+class RunMetrics(object):
+    """
+    Latency, error and size metrics of the SOAP calls and pipeline stages of a run.
+
+    Calls are keyed by SOAP operation (Login, Logout, Retrieve, Submit) and
+    stages by name: parse (reading and parsing a line), lookup (subscriber
+    state, from the gateway or the cache), decide (working out the
+    adjustments), submit (sending them) and write (writing the result).
+    While started, a background thread rewrites the metrics file and the
+    progress line every interval seconds.
+
+    Args:
+        path (str): Metrics file, JSON if it ends in .json, else Prometheus text; empty for none.
+        interval (float): Seconds between updates of the metrics file and progress line.
+        progress (bool): Show a progress line on stderr.
+    """
+
+    STAGES = ('parse', 'lookup', 'decide', 'submit', 'write')
+
+    def __init__(self, path='', interval=5.0, progress=False):
+        self.path = path
+        self.interval = interval
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.calls = collections.OrderedDict()
+        self.stages = collections.OrderedDict((name, LatencyHistogram()) for name in self.STAGES)
+        self.lines = 0
+        self.started = time.time()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def call(self, operation, seconds, ok=True, sent=0, received=0):
+        """
+        Records one SOAP call.
+        """
+        with self.lock:
+            histogram = self.calls.get(operation)
+            if histogram is None:
+                histogram = self.calls[operation] = LatencyHistogram()
+            histogram.add(seconds, ok, sent, received)
+
+    def stage(self, name, seconds, ok=True):
+        """
+        Records the time one line spent in a stage; the write stage also counts the line.
+        """
+        with self.lock:
+            self.stages[name].add(seconds, ok)
+            if name == 'write':
+                self.lines += 1
+
+    def start(self):
+        """
+        Starts updating the metrics file and progress line, if either is wanted.
+        """
+        self.started = time.time()
+        if (self.path or self.progress) and self.thread is None:
+            self.thread = threading.Thread(target=self.updates)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def updates(self):
+        while not self.stopping.wait(self.interval):
+            self.update()
+
+    def update(self):
+        if self.path:
+            try:
+                self.write_file()
+            except (IOError, OSError) as e:
+                log_error("while writing the metrics file", e)
+        if self.progress:
+            sys.stderr.write("\r" + self.progress_line())
+            sys.stderr.flush()
+
+    def stop(self):
+        """
+        Stops the updates, writing the metrics file and progress line a last time.
+        """
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        self.update()
+        if self.progress:
+            sys.stderr.write("\n")
+
+    def progress_line(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            calls = sum(histogram.count for histogram in self.calls.values())
+            errors = sum(histogram.errors for histogram in self.calls.values())
+            submit = self.calls.get('Submit')
+            p99 = submit.quantile(0.99) if submit is not None else 0.0
+            return ("%d lines in %.0fs (%.1f lines/sec), %d calls, %.1f%% failed, Submit p99 %.0f ms"
+                    % (self.lines, elapsed, self.lines / elapsed if elapsed else 0.0, calls,
+                       100.0 * errors / calls if calls else 0.0, p99 * 1000))
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: The metrics as plain values, latencies in milliseconds.
+        """
+        def entry(histogram, sizes):
+            values = {'count': histogram.count, 'errors': histogram.errors,
+                      'p50_ms': round(histogram.quantile(0.5) * 1000, 2),
+                      'p95_ms': round(histogram.quantile(0.95) * 1000, 2),
+                      'p99_ms': round(histogram.quantile(0.99) * 1000, 2),
+                      'total_ms': round(histogram.total * 1000, 2)}
+            if sizes:
+                values.update(bytes_sent=histogram.sent, bytes_received=histogram.received)
+            return values
+        with self.lock:
+            # Stages send nothing themselves, their calls are counted by operation
+            return {'elapsed_seconds': round(time.time() - self.started, 3), 'lines': self.lines,
+                    'calls': dict((name, entry(histogram, True)) for name, histogram in self.calls.items()),
+                    'stages': dict((name, entry(histogram, False)) for name, histogram in self.stages.items()
+                                   if histogram.count)}
+
+    def prometheus(self):
+        """
+        Returns:
+            str: The metrics in the Prometheus text format.
+        """
+        snapshot = self.snapshot()
+        lines = ["# TYPE credit_debit_lines_total counter", "credit_debit_lines_total %d" % snapshot['lines']]
+        for kind in ('call', 'stage'):
+            entries = snapshot[kind + 's']
+            lines.append("# TYPE credit_debit_%s_seconds summary" % kind)
+            for name in sorted(entries):
+                entry = entries[name]
+                for q in ('50', '95', '99'):
+                    lines.append('credit_debit_%s_seconds{%s="%s",quantile="0.%s"} %g'
+                                 % (kind, kind, name, q, entry['p' + q + '_ms'] / 1000.0))
+                lines.append('credit_debit_%s_seconds_sum{%s="%s"} %g' % (kind, kind, name, entry['total_ms'] / 1000.0))
+                lines.append('credit_debit_%s_seconds_count{%s="%s"} %d' % (kind, kind, name, entry['count']))
+            for metric in ('errors', 'bytes_sent', 'bytes_received') if kind == 'call' else ('errors',):
+                lines.append("# TYPE credit_debit_%s_%s_total counter" % (kind, metric))
+                for name in sorted(entries):
+                    lines.append('credit_debit_%s_%s_total{%s="%s"} %d' % (kind, metric, kind, name, entries[name][metric]))
+        return "\n".join(lines) + "\n"
+
+    def write_file(self):
+        """
+        Replaces the metrics file, so a scraper never reads it half written.
+        """
+        text = json.dumps(self.snapshot(), sort_keys=True) if self.path.endswith('.json') else self.prometheus()
+        with open(self.path + '.tmp', 'w') as file:
+            file.write(text)
+        os.rename(self.path + '.tmp', self.path)
+
+    def summary(self):
+        """
+        Returns:
+            list: Lines of the end of run summary, one per call and stage.
+        """
+        snapshot = self.snapshot()
+        lines = ["%-10s %-7s %9s %8s %9s %9s %9s %12s %12s" % ('name', 'kind', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                               'bytes sent', 'bytes recv')]
+        for kind in ('call', 'stage'):
+            for name, entry in sorted(snapshot[kind + 's'].items()):
+                lines.append("%-10s %-7s %9d %7.1f%% %9.1f %9.1f %9.1f %12s %12s"
+                             % (name, kind, entry['count'], 100.0 * entry['errors'] / entry['count'] if entry['count']
+                                else 0.0, entry['p50_ms'], entry['p95_ms'], entry['p99_ms'], entry.get('bytes_sent', ''),
+                                entry.get('bytes_received', '')))
+        return lines
+
+    def report(self):
+        """
+        Logs and prints the summary.
+        """
+        for line in self.summary():
+            logging.info(line)
+            print(line)
+
+
+def run_metrics(cf):
+    """
+    Builds the run metrics configured for the SOAP calls and stages.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+
+    Returns:
+        RunMetrics: The metrics, or None when metrics is off.
+    """
+    if get_option(cf, 'metrics', 'yes').lower() not in ('1', 'yes', 'true', 'on'):
+        return None
+    return RunMetrics(get_option(cf, 'metrics_file', ''), get_option(cf, 'metrics_interval', 5.0, float),
+                      get_option(cf, 'progress', 'no').lower() in ('1', 'yes', 'true', 'on'))
+
+
+# SOAP operation of a request, e.g. Submit for a SubmitRequest
+SOAP_OPERATION = re.compile(br"<(?:[\w-]+:)?(\w+)Request[\s>]")
+
+
+def soap_operation(data):
+    """
+    Names the SOAP operation of a request body.
+
+    Args:
+        data (bytes): Request body, before compression.
+
+    Returns:
+        str: The operation, e.g. Login, Retrieve or Submit; other if it has none.
+    """
+    match = SOAP_OPERATION.search(data)
+    return match.group(1).decode('ascii') if match is not None else 'other'
+
+
+# Session ID of a request, and the faults of a session the gateway no longer knows
+SESSION_ID = re.compile(br"(sessionId>)([^<]+)(<)")
+SESSION_FAULT = re.compile(br"<(?:\w+:)?faultstring>[^<]*session", re.IGNORECASE)
+
+
+def with_session(payload, session_id):
+    """
+    Puts another session ID into a request.
+
+    Args:
+        payload (bytes): Request envelope.
+        session_id (str): Session ID to use.
+
+    Returns:
+        bytes: The request with the new session ID.
+    """
+    session_id = session_id.encode('utf-8') if isinstance(session_id, type(u"")) else session_id
+    return SESSION_ID.sub(lambda m: m.group(1) + session_id + m.group(3), payload, 1)
+
+
+class SessionPool(object):
+    """
+    Sessions opened on the eSM gateway, renewed when the gateway drops them.
+
+    Several sessions can be held so parallel workers do not share one. When a
+    call fails on an unknown or expired session, the session is replaced by a
+    new login, once for all the workers using it, and requests still carrying
+    the old session ID are given the new one. With a cache file, the sessions
+    are kept open at the end of a run and reused by the next run started
+    within the TTL instead of logging in again; a later run logs them out.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        soap_url (list): List containing SOAP URLs.
+        size (int): Number of sessions to hold.
+        cache_file (str): File keeping the sessions between runs, empty for none.
+        ttl (float): Seconds a cached session is trusted after the run that left it.
+    """
+
+    def __init__(self, cf, transport, soap_url, size=1, cache_file='', ttl=600.0):
+        self.cf = cf
+        self.transport = transport
+        self.soap_url = soap_url
+        self.size = max(size, 1)
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.ids = []
+        self.renewed = {}
+        self.lock = threading.Lock()
+
+    def open(self):
+        """
+        Logs in the sessions, reusing the cached ones when still fresh.
+
+        Returns:
+            str: The first session ID.
+        """
+        self.ids, stale = load_session_cache(self.cf, self.cache_file, self.ttl) if self.cache_file else ([], [])
+        # Cached sessions past the TTL, or beyond the pool size, would otherwise stay open on the gateway
+        for session_id in stale + self.ids[self.size:]:
+            self.logout(session_id)
+        self.ids = self.ids[:self.size]
+        if self.ids:
+            logging.info("Reusing %d cached session(s) from %s", len(self.ids), self.cache_file)
+        while len(self.ids) < self.size:
+            self.ids.append(get_session_id(self.cf, self.transport, self.soap_url))
+        return self.ids[0]
+
+    def logout(self, session_id):
+        """
+        Logs out a cached session no longer used, without renewing it should the gateway have dropped it.
+
+        Args:
+            session_id (str): Session ID to log out.
+        """
+        try:
+            self.transport.paced(LOGOUT_TEMPLATE.format(session_id=session_id, soap_url=self.soap_url).encode('utf-8'))
+            logging.info("Logged out a cached session past its TTL")
+        except Exception as e:
+            log_error("while logging out a cached session", e)
+
+    def current(self, session_id):
+        """
+        Follows the renewals of a session.
+
+        Args:
+            session_id (str): Session ID, possibly dropped by the gateway.
+
+        Returns:
+            str: The session ID now replacing it.
+        """
+        while session_id in self.renewed:
+            session_id = self.renewed[session_id]
+        return session_id
+
+    def refresh(self, payload):
+        """
+        Gives a request the current ID of its session, if that was renewed.
+
+        Args:
+            payload (bytes): Request envelope.
+
+        Returns:
+            bytes: The request to send.
+        """
+        if not self.renewed:
+            return payload
+        match = SESSION_ID.search(payload)
+        if match is None:
+            return payload
+        stale = match.group(2).decode('utf-8')
+        return with_session(payload, self.current(stale)) if stale in self.renewed else payload
+
+    def renew_in(self, payload):
+        """
+        Renews the session of a request that failed on it.
+
+        Args:
+            payload (bytes): Request envelope.
+
+        Returns:
+            bytes: The request with the new session ID, None if it holds no session.
+        """
+        match = SESSION_ID.search(payload)
+        if match is None:
+            return None
+        return with_session(payload, self.renew(match.group(2).decode('utf-8')))
+
+    def renew(self, stale):
+        """
+        Replaces a session the gateway dropped with a new login.
+
+        Args:
+            stale (str): Session ID that failed.
+
+        Returns:
+            str: The new session ID.
+        """
+        with self.lock:
+            if stale in self.renewed:
+                # Another worker already logged in again
+                return self.current(stale)
+            session_id = get_session_id(self.cf, self.transport, self.soap_url)
+            self.renewed[stale] = session_id
+            self.ids = [session_id if i == stale else i for i in self.ids]
+            logging.warning("Session expired or invalid, logged in again")
+            return session_id
+
+    def close(self):
+        """
+        Caches the sessions for the next run, or logs them out.
+        """
+        if self.cache_file:
+            save_session_cache(self.cf, self.cache_file, self.ids)
+            return
+        for session_id in self.ids:
+            close_session(session_id, self.transport, self.soap_url)
+
+
+def load_session_cache(cf, cache_file, ttl):
+    """
+    Reads the sessions left open by a previous run.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+        cache_file (str): Session cache file.
+        ttl (float): Seconds a cached session is trusted.
+
+    Returns:
+        tuple: The cached session IDs still within the TTL, and those past it, to be logged out; both
+        empty if the cache is missing or of another gateway or user.
+    """
+    try:
+        with open(cache_file) as file:
+            cache = json.load(file)
+        if (cache.get('url') == cf.get('parameters', 'eSM_url') and
+                cache.get('user') == cf.get('parameters', 'Soap_username')):
+            sessions = [str(session_id) for session_id in cache.get('sessions', [])]
+            if time.time() - cache.get('saved', 0) < ttl:
+                return sessions, []
+            return [], sessions
+    except (IOError, OSError, ValueError) as e:
+        logging.info("Session cache %s not used: %s", cache_file, e)
+    return [], []
+
+
+def save_session_cache(cf, cache_file, session_ids):
+    """
+    Keeps the sessions for the next run, readable by the owner only.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+        cache_file (str): Session cache file.
+        session_ids (list): Session IDs still open.
+    """
+    import tempfile  # For a temporary file of this process
+    try:
+        # Runs ending together each write a file of their own, the last rename wins
+        fd, temp_file = tempfile.mkstemp(prefix=os.path.basename(cache_file) + '.',
+                                         dir=os.path.dirname(os.path.abspath(cache_file)))
+        with os.fdopen(fd, 'w') as file:
+            json.dump({'url': cf.get('parameters', 'eSM_url'), 'user': cf.get('parameters', 'Soap_username'),
+                       'sessions': session_ids, 'saved': time.time()}, file)
+        os.rename(temp_file, cache_file)
+    except (IOError, OSError) as e:
+        log_error("while saving the session cache", e)
+
 
 def session_login(a, cf):
     """
-    Establishes a session with the SOAP service for login.
+    Establishes a session with the SOAP service for login.
+
+    Args:
+        a (list): List of filenames.
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+
+    Returns:
+        tuple: A tuple containing essential session information.
+    """
+    workdir = os.getcwd()  # Getting current working directory
+    if len(a) == 0:
+        logging.error("Configuration file config.ini not found in current directory :%s" ,workdir)
+        sys.exit()    
+    try:
+        soap_url, url, headers = gateway_address(cf)
+        # One transport, and its pool of connections, is shared by every SOAP call
+        transport = SoapTransport(url, headers,
+                                  pool_size=get_option(cf, 'http_pool_size', get_option(cf, 'bulk_workers', 1, int), int),
+                                  timeout=(get_option(cf, 'connect_timeout', 5.0, float), get_option(cf, 'read_timeout', 30.0, float)),
+                                  compress=get_option(cf, 'gzip', 'no').lower() in ('1', 'yes', 'true', 'on'),
+                                  max_inflight=get_option(cf, 'max_inflight', 0, int),
+                                  limiter=rate_limiter(cf), metrics=run_metrics(cf))
+        # Open the sessions; the transport renews any the gateway drops
+        transport.sessions = SessionPool(cf, transport, soap_url, size=get_option(cf, 'session_pool_size', 1, int),
+                                         cache_file=get_option(cf, 'session_cache', ''),
+                                         ttl=get_option(cf, 'session_ttl', 600.0, float))
+        session_id = transport.sessions.open()
+        # Config names are parsed once and the static envelope parts rendered up front
+        envelopes = EnvelopeBuilder(cf, soap_url)
+        return envelopes, transport, session_id
+        
+    except Exception as e:
+        log_error("at session_login", e)
+        sys.exit() 
+
+		
+
+# Session requests, sent once per run
+LOGIN_TEMPLATE = """
+    <soapenv:Envelope xmlns:soapenv=\"{soap_url[0]}\" xmlns:v2=\"{soap_url[1]}\">
+       <soapenv:Header/>
+       <soapenv:Body>
+          <v2:LoginRequest>
+             <v2:loginId>{soap_username}</v2:loginId>
+             <v2:passwd>{soap_password}</v2:passwd>
+             <v2:wsdlVersion>V_1</v2:wsdlVersion>
+          </v2:LoginRequest>
+       </soapenv:Body>
+    </soapenv:Envelope>
+    """
+
+LOGOUT_TEMPLATE = """
+    <soapenv:Envelope xmlns:soapenv=\"{soap_url[0]}\" xmlns:v2=\"{soap_url[1]}\">
+       <soapenv:Header/>
+       <soapenv:Body>
+          <v2:LogoutRequest>
+             <v2:SessionInfo>
+                <v2:sessionId>{session_id}</v2:sessionId>
+             </v2:SessionInfo>
+          </v2:LogoutRequest>
+       </soapenv:Body>
+    </soapenv:Envelope>
+    """
+
+
+def get_session_id(cf, transport, soap_url):
+    """
+    Retrieves the session ID after successful login.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        soap_url (list): List containing SOAP URLs.
+
+    Returns:
+        str: The session ID.
+    """
+    soap_username = cf.get('parameters', 'Soap_username')  # Getting the SOAP username
+    logging.info('Logged in using :%s', soap_username)  # Logging the login username
+    
+    soap_password = cf.get('parameters', 'Soap_password')  # Getting the SOAP password
+    session_id_request = LOGIN_TEMPLATE.format(soap_username=soap_username, soap_password=soap_password, soap_url=soap_url)
+    response = transport.post(session_id_request)  # Making a POST request
+    return session_id_from_response(response.content, soap_url)  # Returning the session ID
+
+
+def session_id_from_response(payload, soap_url):
+    """
+    Extracts the session ID from a LoginResponse.
+
+    Args:
+        payload (bytes): Body of the login response.
+        soap_url (list): List containing SOAP URLs.
+
+    Returns:
+        str: The session ID.
+    """
+    import xml.etree.ElementTree as ET  # For parsing XML, once per login
+    root = ET.fromstring(payload)  # Parsing the XML response
+    return root.find(".//{" + soap_url[1] + "}sessionId").text  # Extracting the session ID
+
+def close_session(session_id, transport, soap_url):
+    """
+    Closes the session.
+
+    Args:
+        session_id (str): The session ID.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        soap_url (list): List containing SOAP URLs.
+    """
+    transport.post(LOGOUT_TEMPLATE.format(session_id=session_id, soap_url=soap_url))  # Making a POST request to logout
+
+
+
+
+	
+# SOAP request templates; {name} fields are filled per call, the rest once at startup
+RETRIEVE_TEMPLATE = """
+<soap-env:Envelope xmlns:soap-env="{soap_url[0]}">
+    <soap-env:Body>
+        <ns0:RetrieveRequest xmlns:ns0="{soap_url[1]}">
+            <ns0:SessionInfo>
+                <ns0:sessionId>{session_id}</ns0:sessionId>
+            </ns0:SessionInfo>
+            <ns0:RequestInfo>
+                <ns0:ReqID></ns0:ReqID>
+            </ns0:RequestInfo>
+            <ns0:TaskList>
+                <ns0:Task>
+                    <ns0:Name>{sub_xml_names[0]}</ns0:Name>
+                    <ns0:QueryCriteria>
+                        <ns0:Param>
+                            <ns0:Name>{sub_xml_names[1]}</ns0:Name>
+                            <ns0:Value>{msisdn}</ns0:Value>
+                        </ns0:Param>
+                    </ns0:QueryCriteria>
+                    <ns0:QueryData>
+                        <ns0:Collection>
+                            <ns0:CollectionName>{sub_xml_names[2]}</ns0:CollectionName>
+                            <ns0:Attributes>
+                                <ns0:item>{sub_xml_names[1]}</ns0:item>
+                                <ns0:item>{sub_xml_names[3]}</ns0:item>
+                                <ns0:item>{sub_xml_names[4]}</ns0:item>
+                                <ns0:item>{sub_xml_names[5]}</ns0:item>
+                                <ns0:item>{sub_xml_names[6]}</ns0:item>
+                                <ns0:item>{sub_xml_names[7]}</ns0:item>
+                                <ns0:item>{sub_xml_names[8]}</ns0:item>
+                            </ns0:Attributes>
+                        </ns0:Collection>
+                    </ns0:QueryData>
+                </ns0:Task>
+                <ns0:Task>
+                    <ns0:Name>{bid_xml_names[0]}</ns0:Name>
+                    <ns0:QueryCriteria>
+                        <ns0:Param>
+                            <ns0:Name>{bid_xml_names[1]}</ns0:Name>
+                            <ns0:Value>{msisdn}</ns0:Value>
+                        </ns0:Param>
+                    </ns0:QueryCriteria>
+                    <ns0:QueryData>
+                        <ns0:Collection>
+                            <ns0:CollectionName>{bid_xml_names[2]}</ns0:CollectionName>
+                            <ns0:Attributes>
+                                <ns0:item>{bid_xml_names[3]}</ns0:item>
+                                <ns0:item>{bid_xml_names[4]}</ns0:item>
+                                <ns0:item>{bid_xml_names[5]}</ns0:item>
+                                <ns0:item>{bid_xml_names[6]}</ns0:item>
+                                <ns0:item>{bid_xml_names[7]}</ns0:item>
+                                <ns0:item>{bid_xml_names[8]}</ns0:item>
+                            </ns0:Attributes>
+                        </ns0:Collection>
+                    </ns0:QueryData>
+                </ns0:Task>
+            </ns0:TaskList>
+        </ns0:RetrieveRequest>
+    </soap-env:Body>
+</soap-env:Envelope>
+"""
+
+BALANCE_ADJUST_TEMPLATE = """
+<S:Envelope xmlns:S="{soap_url[0]}">
+    <S:Body>
+        <SubmitRequest xmlns="{soap_url[1]}">
+            <SessionInfo>
+                <sessionId>{session_id}</sessionId>
+            </SessionInfo>
+            <RequestInfo>
+                <ReqID>{req_id}</ReqID>
+            </RequestInfo>
+            <TaskList>
+                <Task>
+                    <Name>{bal_xml_names[0]}</Name>
+                    <ParamList>
+                        <Param>
+                            <Name>{bal_xml_names[1]}</Name>
+                            <!-- Required -->
+                            <Value>{msisdn}</Value>
+                        </Param>
+                        <Param>
+                            <Name>{bal_xml_names[2]}</Name>
+                            <Value>{adjust_method}</Value>
+                        </Param>
+                        <Param>
+                            <Name>{bal_xml_names[3]}</Name>
+                            <Value>N</Value>
+                        </Param>
+                        <Param>
+                            <Name>{bal_xml_names[4]}</Name>
+                            <Value>N</Value>
+                        </Param>
+                        <Param>
+                            <Name>{bal_xml_names[5]}</Name>
+                            <Value>{amount}</Value>
+                        </Param>
+                    </ParamList>
+                    <ContinueOnFailure>True</ContinueOnFailure>
+                </Task>
+            </TaskList>
+        </SubmitRequest>
+    </S:Body>
+</S:Envelope>
+"""
+
+BUCKET_ADJUST_TEMPLATE = """
+<S:Envelope xmlns:S="{soap_url[0]}">
+    <S:Body>
+        <SubmitRequest xmlns="{soap_url[1]}">
+            <SessionInfo>
+                <sessionId>{session_id}</sessionId>
+            </SessionInfo>
+            <RequestInfo>
+                <ReqID>{req_id}</ReqID>
+            </RequestInfo>
+            <TaskList>
+                <Task>
+                    <Name>{buc_xml_names[0]}</Name>
+                    <ParamList>
+                        <Param>
+                            <Name>{buc_xml_names[1]}</Name>
+                            <!-- Required -->
+                            <Value>{msisdn}</Value>
+                        </Param>
+                        <Param>
+                            <Name>{buc_xml_names[2]}</Name>
+                            <!-- Required -->
+                            <Value>bdlBERVOBM_{bucket_id}</Value>
+                        </Param>
+                    </ParamList>
+                    <ContinueOnFailure>True</ContinueOnFailure>
+                </Task>
+                <Task>
+                    <Name>{buc_xml_names[3]}</Name>
+                    <ParamList>
+                        <Param>
+                            <Name>{buc_xml_names[1]}</Name>
+                            <!-- Required -->
+                            <Value>{msisdn}</Value>
+                        </Param>
+                        <Param>
+                            <Name>{buc_xml_names[4]}</Name>
+                            <!-- Required -->
+                            <Value>{bucket_id}</Value>
+                        </Param>
+                        <Param>
+                            <Name>{buc_xml_names[5]}</Name>
+                            <!-- Required -->
+                            <Value>{adjust_method}</Value>
+                        </Param>
+                        <Param>
+                            <Name>{buc_xml_names[6]}</Name>
+                            <!-- Required -->
+                            <Value>{amount}</Value>
+                        </Param>
+                    </ParamList>
+                </Task>
+            </TaskList>
+        </SubmitRequest>
+    </S:Body>
+</S:Envelope>
+"""
+
+
+def xml_text(value):
+    """
+    Converts a value to text escaped for use inside an XML element.
+
+    Args:
+        value: Value to convert.
+
+    Returns:
+        str: The escaped value.
+    """
+    if not isinstance(value, str):
+        value = str(value)
+    if '&' in value or '<' in value or '>' in value:
+        value = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return value
+
+
+class EnvelopeBuilder(object):
+    """
+    Builds the per-subscriber SOAP envelopes from templates compiled once.
+
+    The XML names are read from the configuration a single time, the static
+    parts of every envelope are rendered with their whitespace and comments
+    stripped, and each call only splices the per-call values into the
+    pre-rendered text before sending it as UTF-8 bytes.
+
+    Args:
+        cf (ConfigParser): Configuration parser object containing parameter details.
+        soap_url (list): List containing SOAP URL information.
+    """
+
+    def __init__(self, cf, soap_url):
+        self.soap_url = soap_url
+        self.sub_xml_names = cf.get('parameters', 'acct_query_names').split(',')
+        self.bid_xml_names = cf.get('parameters', 'bundle_query_names').split(',')
+        self.bal_xml_names = cf.get('parameters', 'main_adj_names').split(',')
+        self.buc_xml_names = cf.get('parameters', 'bucket_adj_names').split(',')
+        self.task_names = frozenset([self.sub_xml_names[0], self.bid_xml_names[0], self.bal_xml_names[0],
+                                     self.buc_xml_names[0], self.buc_xml_names[3]])
+        self.retrieve_template = self.compile(RETRIEVE_TEMPLATE, ('session_id', 'msisdn'))
+        # The task list is cut out so several subscribers can share one envelope
+        self.retrieve_head, self.retrieve_tasks, self.retrieve_tail = self.split_tasks(self.retrieve_template)
+        self.balance_template = self.compile(BALANCE_ADJUST_TEMPLATE, ('session_id', 'req_id', 'msisdn', 'adjust_method', 'amount'))
+        self.bucket_template = self.compile(BUCKET_ADJUST_TEMPLATE, ('session_id', 'req_id', 'msisdn', 'bucket_id', 'adjust_method',
+                                                                     'amount'))
+        # Batched submits share the balance envelope around the tasks of both adjustments
+        self.submit_head, self.balance_tasks, self.submit_tail = self.split_tasks(self.balance_template)
+        self.bucket_tasks = self.split_tasks(self.bucket_template)[1]
+
+    def compile(self, template, fields):
+        """
+        Renders the static parts of a template into a %-template.
+
+        Args:
+            template (str): Envelope template in str.format syntax.
+            fields (tuple): Names of the fields filled on each call.
+
+        Returns:
+            str: Template with a %(name)s slot for each per-call field.
+        """
+        markers = dict((name, '\x00' + name + '\x00') for name in fields)
+        static = template.format(soap_url=self.soap_url, sub_xml_names=self.sub_xml_names,
+                                 bid_xml_names=self.bid_xml_names, bal_xml_names=self.bal_xml_names,
+                                 buc_xml_names=self.buc_xml_names, **markers)
+        static = re.sub(r"<!--.*?-->", "", static, flags=re.DOTALL)
+        static = re.sub(r">\s+<", "><", static.strip())
+        parts = static.replace('%', '%%').split('\x00')
+        parts[1::2] = ['%(' + name + ')s' for name in parts[1::2]]
+        return "".join(parts)
+
+    def split_tasks(self, template):
+        """
+        Cuts a compiled template around the contents of its TaskList.
+
+        Args:
+            template (str): Template returned by compile.
+
+        Returns:
+            tuple: The head, task and tail templates; the tail is pre-rendered.
+        """
+        start = template.index('TaskList>') + len('TaskList>')
+        end = template.rindex('</', 0, template.rindex('TaskList>'))
+        return template[:start], template[start:end], template[end:] % {}
+
+    def render(self, template, values):
+        """
+        Splices the per-call values into a compiled template.
+
+        Args:
+            template (str): Template returned by compile.
+            values (dict): Per-call values by field name, already escaped.
+
+        Returns:
+            bytes: The complete envelope, UTF-8 encoded.
+        """
+        envelope = template % values
+        return envelope if isinstance(envelope, bytes) else envelope.encode('utf-8')
+
+    def retrieve(self, session_id, msisdn):
+        """
+        Builds the RetrieveRequest querying a subscriber's account and bundles.
+
+        Args:
+            session_id (str): Session ID for authentication.
+            msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+
+        Returns:
+            bytes: The envelope.
+        """
+        return self.render(self.retrieve_template, {'session_id': xml_text(session_id), 'msisdn': xml_text(msisdn)})
+
+    def retrieve_batch(self, session_id, msisdns):
+        """
+        Builds one RetrieveRequest querying the account and bundles of several subscribers.
+
+        Args:
+            session_id (str): Session ID for authentication.
+            msisdns (list): MSISDNs to query, in the order of the task pairs.
+
+        Returns:
+            bytes: The envelope.
+        """
+        tasks = self.retrieve_tasks
+        envelope = (self.retrieve_head % {'session_id': xml_text(session_id)} +
+                    "".join([tasks % {'msisdn': xml_text(msisdn)} for msisdn in msisdns]) + self.retrieve_tail)
+        return envelope if isinstance(envelope, bytes) else envelope.encode('utf-8')
+
+    def balance_adjustment(self, session_id, msisdn, amount, adjust_method, req_id=''):
+        """
+        Builds the SubmitRequest adjusting a main balance.
+
+        Args:
+            session_id (str): Session ID for authentication.
+            msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+            amount (float): Amount to adjust the balance.
+            adjust_method (str): Method to adjust the balance.
+            req_id (str): ReqID of the request, empty for none.
+
+        Returns:
+            bytes: The envelope.
+        """
+        return self.render(self.balance_template, {'session_id': xml_text(session_id), 'req_id': xml_text(req_id),
+                                                   'msisdn': xml_text(msisdn), 'amount': xml_text(amount),
+                                                   'adjust_method': xml_text(adjust_method)})
+
+    def bucket_adjustment(self, session_id, msisdn, amount, bucket_id, adjust_method, req_id=''):
+        """
+        Builds the SubmitRequest adjusting a bonus bucket.
+
+        Args:
+            session_id (str): Session ID for authentication.
+            msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+            amount (float): Amount to adjust the bucket.
+            bucket_id (str): Identifier for the bucket to be adjusted.
+            adjust_method (str): Method to adjust the bucket.
+            req_id (str): ReqID of the request, empty for none.
+
+        Returns:
+            bytes: The envelope.
+        """
+        return self.render(self.bucket_template, {'session_id': xml_text(session_id), 'req_id': xml_text(req_id),
+                                                  'msisdn': xml_text(msisdn), 'amount': xml_text(amount),
+                                                  'bucket_id': xml_text(bucket_id), 'adjust_method': xml_text(adjust_method)})
+
+    def submit_batch(self, session_id, adjustments, req_id=''):
+        """
+        Builds one SubmitRequest carrying the tasks of several adjustments.
+
+        Args:
+            session_id (str): Session ID for authentication.
+            adjustments (list): ('balance', msisdn, amount, adjust_method) and
+                ('bucket', msisdn, amount, bucket_id, adjust_method) tuples.
+            req_id (str): ReqID of the request, empty for none.
+
+        Returns:
+            bytes: The envelope.
+        """
+        tasks = []
+        for adjustment in adjustments:
+            if adjustment[0] == 'balance':
+                tasks.append(self.balance_tasks % {'msisdn': xml_text(adjustment[1]), 'amount': xml_text(adjustment[2]),
+                                                   'adjust_method': xml_text(adjustment[3])})
+            else:
+                tasks.append(self.bucket_tasks % {'msisdn': xml_text(adjustment[1]), 'amount': xml_text(adjustment[2]),
+                                                  'bucket_id': xml_text(adjustment[3]),
+                                                  'adjust_method': xml_text(adjustment[4])})
+        envelope = (self.submit_head % {'session_id': xml_text(session_id), 'req_id': xml_text(req_id)} +
+                    "".join(tasks) + self.submit_tail)
+        return envelope if isinstance(envelope, bytes) else envelope.encode('utf-8')
+
+
+# Bundle attributes returned by the bundle query, in BundleRow field order
+BUNDLE_FIELDS = ("Bundle ID", "Bundle State", "End Date Time", "Tariff Plan COSP ID",
+                 "Bucket/Discount ID 1", "Bucket/UBD Counter 1")
+BUNDLE_FIELD_INDEX = dict((name, i) for i, name in enumerate(BUNDLE_FIELDS))
+
+# Bundle ids reported as bonus buckets, and the always-on bundle
+BONUS_BUNDLE_ID = re.compile(r"(?:bdl\w+|\d+_\w\w|\d\d)$")
+ALWAYSON_BUNDLE_ID = "sbcALWAYSON"
+
+BundleRow = collections.namedtuple('BundleRow', 'bundle_id state end_date cosp_id bucket_id counter')
+
+# The few distinct states, IDs and statuses the gateway answers with, shared by all subscribers
+SHARED_TEXT = {}
+
+
+def shared_text(value):
+    """
+    Returns the one shared copy of a short, often repeated string.
+
+    Args:
+        value (str): Text read from a response.
+
+    Returns:
+        str: An equal string, the same object for every equal value.
+    """
+    return SHARED_TEXT.setdefault(value, value)
+
+
+class Amount(int):
+    """
+    A fixed-point NGN amount, held as an integer number of 1/10000 NGN units.
+
+    This is the scale the gateway counts balances and bucket counters in, so
+    amounts read from input lines, balances and counters compare and add up
+    exactly. Adding, subtracting or negating amounts gives an Amount; str()
+    gives the number of units, as bucket adjustments send it.
+    """
+
+    __slots__ = ()
+
+    SCALE = 10000
+    DIGITS = 4
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Reads an amount written in NGN.
+
+        Args:
+            text (str): The amount, with an optional sign and up to four decimals.
+
+        Returns:
+            Amount: The amount.
+
+        Raises:
+            ValueError: If the text is not an amount or has more decimals than the gateway counts.
+        """
+        body = text.strip()
+        sign = body[:1]
+        if sign in ("-", "+"):
+            body = body[1:]
+        whole, _, fraction = body.partition(".")
+        if not (whole or fraction) or (whole and not whole.isdigit()) or (fraction and not fraction.isdigit()):
+            raise ValueError("invalid amount " + repr(text))
+        fraction = fraction.rstrip("0")
+        if len(fraction) > cls.DIGITS:
+            raise ValueError("amount " + repr(text) + " has more than " + str(cls.DIGITS) + " decimals")
+        units = int(whole or "0") * cls.SCALE + (int(fraction.ljust(cls.DIGITS, "0")) if fraction else 0)
+        return cls(-units if sign == "-" else units)
+
+    @classmethod
+    def from_units(cls, value):
+        """
+        Reads a balance or counter returned by the gateway.
+
+        Args:
+            value (str): Amount in 1/10000 NGN units, empty for none.
+
+        Returns:
+            Amount: The amount, 0 when empty.
+
+        Raises:
+            ValueError: If the value is not a whole number.
+        """
+        return cls(int(value) if value else 0)
+
+    def __add__(self, other):
+        return Amount(int(self) + other)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return Amount(int(self) - other)
+
+    def __rsub__(self, other):
+        return Amount(other - int(self))
+
+    def __neg__(self):
+        return Amount(-int(self))
+
+    def __abs__(self):
+        return Amount(abs(int(self)))
+
+    def __str__(self):
+        return int.__repr__(self)
+
+    def __repr__(self):
+        return "Amount(%r)" % self.ngn()
+
+    def digits(self):
+        """
+        Writes the amount in NGN with its significant decimals.
+
+        Returns:
+            str: Sign, naira and decimals, e.g. -5 or 2.5.
+        """
+        whole, fraction = divmod(abs(int(self)), self.SCALE)
+        text = "%s%d" % ("-" if self < 0 else "", whole)
+        return text + ("." + ("%04d" % fraction).rstrip("0") if fraction else "")
+
+    def ngn(self):
+        """
+        Writes the amount in NGN as result lines and the gateway show it.
+
+        Returns:
+            str: The amount with at least one decimal, e.g. 1856.57 or 5.0.
+        """
+        whole, fraction = divmod(abs(int(self)), self.SCALE)
+        return "%s%d.%s" % ("-" if self < 0 else "", whole, ("%04d" % fraction).rstrip("0") or "0")
+
+    def signed(self):
+        """
+        Writes the amount as the signed amount of an input line.
+
+        Returns:
+            str: The amount, e.g. -5 or +2.5, empty for zero.
+        """
+        if not self:
+            return ""
+        text = self.digits()
+        return text if self < 0 else "+" + text
+
+
+class BundleBucket(object):
+    """
+    A bundle held by a subscriber.
+
+    Attributes:
+        bundle_id (str): Bundle ID.
+        state (str): Bundle state.
+        end_date (str): End date and time, empty when it does not expire.
+        cosp_id (str): Tariff plan COSP ID.
+        bucket_id (str): ID of the bucket or discount of the bundle.
+        counter (Amount): Bucket counter.
+    """
+
+    __slots__ = ('bundle_id', 'state', 'end_date', 'cosp_id', 'bucket_id', 'counter')
+
+    def __init__(self, bundle_id, state, end_date, cosp_id, bucket_id, counter):
+        self.bundle_id = bundle_id
+        self.state = state
+        self.end_date = end_date
+        self.cosp_id = cosp_id
+        self.bucket_id = bucket_id
+        self.counter = counter
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Builds the bucket of a parsed bundle row.
+
+        Args:
+            row (BundleRow): Bundle as read by parse_response.
+
+        Returns:
+            BundleBucket: The bucket.
+        """
+        return cls(shared_text(row.bundle_id), shared_text(row.state), row.end_date, shared_text(row.cosp_id),
+                   shared_text(row.bucket_id), Amount.from_units(row.counter))
+
+    def with_counter(self, counter):
+        """
+        Returns a copy of the bucket holding another counter.
+
+        Args:
+            counter (Amount): The new counter.
+
+        Returns:
+            BundleBucket: The updated copy.
+        """
+        return BundleBucket(self.bundle_id, self.state, self.end_date, self.cosp_id, self.bucket_id, counter)
+
+
+class SubscriberState(object):
+    """
+    The state of a subscriber as returned by the account and bundle queries.
+
+    Records are not changed once built, so lines and caches can share them;
+    the with_ methods return updated copies.
+
+    Attributes:
+        msisdn (str): MSISDN as named by the gateway, or as looked up when the query failed.
+        status (str): Status of the account query, e.g. SUCCESS.
+        state (str): Account state, empty when the query failed.
+        balance (Amount): Main balance, None when the subscriber is not on IN.
+        bonus_status (str): Status of the bundle query, FAILURE when the account query failed.
+        buckets (tuple): BundleBucket of each bonus bundle.
+        alwayson (tuple): BundleBucket of the always-on bundle, if any.
+    """
+
+    __slots__ = ('msisdn', 'status', 'state', 'balance', 'bonus_status', 'buckets', 'alwayson', 'index')
+
+    def __init__(self, msisdn, status, state='', balance=None, bonus_status='FAILURE', buckets=(), alwayson=()):
+        self.msisdn = msisdn
+        self.status = status
+        self.state = state
+        self.balance = balance
+        self.bonus_status = bonus_status
+        self.buckets = buckets
+        self.alwayson = alwayson
+        self.index = None
+
+    @property
+    def on_in(self):
+        """
+        bool: The account query found the subscriber on the IN.
+        """
+        return self.balance is not None
+
+    def with_balance(self, balance):
+        """
+        Returns a copy of the state holding another main balance.
+
+        Args:
+            balance (Amount): The new main balance.
+
+        Returns:
+            SubscriberState: The updated copy.
+        """
+        return SubscriberState(self.msisdn, self.status, self.state, balance, self.bonus_status, self.buckets,
+                               self.alwayson)
+
+    def with_bucket_counter(self, bucket_id, amount):
+        """
+        Returns a copy of the state with a bucket counter moved by an adjustment.
+
+        Args:
+            bucket_id (str): ID of the adjusted bucket.
+            amount (Amount): Signed adjustment.
+
+        Returns:
+            SubscriberState: The updated copy, None when no bonus bundle holds the bucket.
+        """
+        for i, bucket in enumerate(self.buckets):
+            if bucket.bucket_id == bucket_id:
+                buckets = self.buckets[:i] + (bucket.with_counter(bucket.counter + amount),) + self.buckets[i + 1:]
+                return SubscriberState(self.msisdn, self.status, self.state, self.balance, self.bonus_status, buckets,
+                                       self.alwayson)
+        return None
+
+    def bucket_index(self, current_date):
+        """
+        Returns the index of the bonus buckets, building it on first use.
+
+        Args:
+            current_date (str): Date of the run.
+
+        Returns:
+            BucketIndex: The buckets of the subscriber that can be debited on that date.
+        """
+        index = self.index
+        if index is None or index.current_date != current_date:
+            index = self.index = BucketIndex(self.buckets, current_date)
+        return index
+
+
+class BucketIndex(object):
+    """
+    The bonus buckets of a subscriber that can be debited, ready for picking.
+
+    The buckets not expired by the run date are sorted by end date, those
+    without one last, alongside the running maximum and running total of
+    their counters, so that each policy picks with one bisection at most:
+
+    - earliest: the earliest ending bucket holding the whole amount
+    - largest: the bucket with the largest counter, when it holds the amount
+    - split: the earliest ending buckets, each emptied in turn until the amount is met
+
+    Args:
+        buckets (tuple): BundleBucket of each bonus bundle.
+        current_date (str): Date of the run, buckets ending before it are left out.
+    """
+
+    POLICIES = ('earliest', 'largest', 'split')
+
+    __slots__ = ('current_date', 'by_expiry', 'peaks', 'totals', 'largest')
+
+    def __init__(self, buckets, current_date):
+        self.current_date = current_date
+        live = [bucket for bucket in buckets if bucket.end_date >= current_date or bucket.end_date == ""]
+        self.by_expiry = sorted(live, key=lambda bucket: (bucket.end_date == "", bucket.end_date))
+        self.peaks, self.totals = [], []
+        peak = total = 0
+        for bucket in self.by_expiry:
+            peak = max(peak, bucket.counter)
+            total += max(bucket.counter, 0)
+            self.peaks.append(peak)
+            self.totals.append(total)
+        # max keeps the first of equal counters, i.e. the earliest ending one
+        self.largest = max(self.by_expiry, key=lambda bucket: bucket.counter) if self.by_expiry else None
+
+    def pick(self, amount, policy='earliest'):
+        """
+        Picks the buckets to debit an amount from.
+
+        Args:
+            amount (Amount): Amount to debit, above 0.
+            policy (str): One of POLICIES.
+
+        Returns:
+            list: (BundleBucket, amount) of each debit, empty when the buckets do not hold the amount.
+
+        Raises:
+            ValueError: If the policy is unknown.
+        """
+        if policy == 'earliest':
+            # The running maximum first reaches the amount at the first bucket holding it
+            i = bisect.bisect_left(self.peaks, amount)
+            return [(self.by_expiry[i], amount)] if i < len(self.peaks) else []
+        if policy == 'largest':
+            return [(self.largest, amount)] if self.largest is not None and self.largest.counter >= amount else []
+        if policy == 'split':
+            i = bisect.bisect_left(self.totals, amount)
+            if i == len(self.totals):
+                return []
+            debits = [(bucket, bucket.counter) for bucket in self.by_expiry[:i] if bucket.counter > 0]
+            debits.append((self.by_expiry[i], amount - (self.totals[i - 1] if i else 0)))
+            return debits
+        raise ValueError("unknown bonus debit policy " + repr(policy))
+
+
+def bonus_debit_policy(cf):
+    """
+    Reads the policy bonus debits pick their buckets with.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+
+    Returns:
+        str: One of BucketIndex.POLICIES.
+
+    Raises:
+        ValueError: If the configured policy is unknown.
+    """
+    policy = get_option(cf, 'bonus_debit_policy', 'earliest').lower()
+    if policy not in BucketIndex.POLICIES:
+        raise ValueError("bonus_debit_policy must be one of " + ", ".join(BucketIndex.POLICIES) + ", not " + repr(policy))
+    return policy
+
+
+class TaskResult(object):
+    """
+    Result of one Task of a RetrieveRequest or SubmitRequest response.
+
+    Attributes:
+        name (str): Task name.
+        status (str): Task status, e.g. SUCCESS.
+        attributes (list): (name, value) pairs returned by the task.
+        bundles (list): BundleRow records returned by the task.
+    """
+
+    __slots__ = ('name', 'status', 'attributes', 'bundles')
+
+    def __init__(self, name, status):
+        self.name = name
+        self.status = status
+        self.attributes = []
+        self.bundles = []
+
+
+# One scan of a response pairs every <Name> with the text of the next element
+# whose name starts with V or R (Value, Result, ResultCode...), and picks up
+# SOAP faults and gateway error messages on the way
+RESPONSE_TOKEN = re.compile(r"<(?:\w+:)?Name>([^<]*)</(?:\w+:)?Name>[^<]*(?:<(?!(?:\w+:)?[VR])[^>]*>[^<]*)*"
+                            r"<(?:\w+:)?[VR][^>]*>([^<]*)<"
+                            r"|<(?:\w+:)?faultstring>([^<]*)<|<(?:\w+:)?ErrorMsg>([^<]*)<")
+
+
+def xml_unescape(value):
+    """
+    Resolves the predefined XML entities in element text.
+
+    Args:
+        value (str): Raw element text.
+
+    Returns:
+        str: The text with entities resolved.
+    """
+    if '&' not in value:
+        return value
+    return (value.replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"')
+            .replace('&apos;', "'").replace('&amp;', '&'))
+
+
+class SoapResponse(object):
+    """
+    A SOAP response read into typed records.
+
+    Attributes:
+        tasks (list): TaskResult records in response order.
+        fault (str): SOAP fault string, or None.
+        error (str): Gateway error message, or None.
+    """
+
+    __slots__ = ('tasks', 'fault', 'error')
+
+    def __init__(self):
+        self.tasks = []
+        self.fault = None
+        self.error = None
+
+
+def parse_response(payload, task_names):
+    """
+    Parses a SOAP response into TaskResult records in a single pass.
+
+    A pair named after one of the request's tasks starts a new TaskResult,
+    bundle attribute pairs fill BundleRow records and any other pair is kept
+    as an attribute of the current task.
+
+    Args:
+        payload (bytes): Response body.
+        task_names (frozenset): Task names used in the request.
+
+    Returns:
+        SoapResponse: The parsed response.
+
+    Raises:
+        ValueError: If the response holds no task result.
+    """
+    if not isinstance(payload, str):
+        payload = payload.decode('utf-8')
+    parsed = SoapResponse()
+    tasks = parsed.tasks
+    task = row = None
+    rows = []
+    bundle_id, field_index = BUNDLE_FIELDS[0], BUNDLE_FIELD_INDEX
+    for name, value, fault, error in RESPONSE_TOKEN.findall(payload):
+        if fault:
+            parsed.fault = xml_unescape(fault)
+            continue
+        if error:
+            parsed.error = xml_unescape(error)
+            continue
+        value = xml_unescape(value)
+        if task is None or name in task_names:
+            task = TaskResult(name, value)
+            tasks.append(task)
+            row = None
+        elif name == bundle_id:
+            row = [value, "", "", "", "", ""]
+            rows.append((task, row))
+        elif row is not None and name in field_index:
+            row[field_index[name]] = value
+        else:
+            task.attributes.append((name, value))
+    for task, row in rows:
+        task.bundles.append(BundleRow(*row))
+    if not tasks:
+        raise ValueError("no task result in response: " + str(parsed.fault or parsed.error or payload[:200]))
+    return parsed
+
+
+def sub_info_from_tasks(msisdn, account, bundle_task):
+    """
+    Builds the get_sub_info result of one subscriber from its task results.
+
+    Args:
+        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+        account (TaskResult): Result of the account query task.
+        bundle_task (TaskResult): Result of the bundle query task, or None.
+
+    Returns:
+        SubscriberState: The state of the subscriber.
+
+    Raises:
+        ValueError: If the main balance returned is not a number.
+    """
+    # Extract main and bonus status
+    main_status = shared_text(account.status) if account.status else 'FAILURE'
+    if bundle_task is not None:
+        bonus_status, bundles = bundle_task.status, bundle_task.bundles
+    else:
+        # Responses without task names carry the bundle status as the eighth attribute
+        bonus_status = account.attributes[7][1] if len(account.attributes) > 7 else 'FAILURE'
+        bundles = account.bundles
+    bonus_status = shared_text(bonus_status) if main_status == 'SUCCESS' else 'FAILURE'
+
+    # MSISDN, account state and main balance are the first, fourth and seventh account attributes
+    values = [value for name, value in account.attributes[:7]]
+    if main_status != 'SUCCESS' or len(values) < 7:
+        return SubscriberState(values[0] if main_status == 'SUCCESS' and values else msisdn, main_status,
+                               bonus_status=bonus_status)
+
+    # Split the bonus buckets from the always-on bundle
+    buckets = tuple(BundleBucket.from_row(row) for row in bundles if BONUS_BUNDLE_ID.match(row.bundle_id))
+    alwayson = tuple(BundleBucket.from_row(row) for row in bundles if row.bundle_id == ALWAYSON_BUNDLE_ID)
+    return SubscriberState(values[0], main_status, shared_text(values[3]), Amount.from_units(values[6]), bonus_status,
+                           buckets, alwayson)
+
+
+def get_sub_info(session_id, envelopes, msisdn, transport):
+    """
+    Get subscriber information using SOAP request.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+
+    Returns:
+        SubscriberState: The state of the subscriber, None if the lookup failed.
+
+    Raises:
+        Exception: If an error occurs during the process.
+
+    """
+
+    try:
+        # Splice the subscriber into the pre-rendered envelope
+        retrieve_request = envelopes.retrieve(session_id, msisdn)
+
+        # Send the SOAP request to get bucket information
+        started = time.time()
+        response = transport.post(retrieve_request)
+       
+        # Parse the response in a single pass
+        tasks = parse_response(response.content, envelopes.task_names).tasks
+        log_event(logging.DEBUG, "Subscriber lookup", msisdn=msisdn, operation='lookup',
+                  latency_ms=int((time.time() - started) * 1000), status=tasks[0].status)
+
+        # Return the collected information
+        return sub_info_from_tasks(msisdn, tasks[0], tasks[1] if len(tasks) > 1 else None)
+
+    except Exception as e:
+        # Log and print any errors that occur
+        log_error("while getting sub information", e, msisdn=msisdn, operation='lookup')
+        print("Error in get_sub_info: {}".format(e)) 
+		
+		
+		
+
+
+def get_sub_info_batch(session_id, envelopes, msisdns, transport):
+    """
+    Get the information of several subscribers with a single RetrieveRequest.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        msisdns (list): Distinct MSISDNs to look up.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+
+    Returns:
+        dict: SubscriberState of each MSISDN, empty if the lookup failed.
+    """
+    try:
+        started = time.time()
+        response = transport.post(envelopes.retrieve_batch(session_id, msisdns))
+        tasks = parse_response(response.content, envelopes.task_names).tasks
+        log_event(logging.DEBUG, "Subscriber lookup batch", operation='lookup batch', subscribers=len(msisdns),
+                  latency_ms=int((time.time() - started) * 1000))
+
+        # Each subscriber answers with its account task followed by its bundle task
+        account_name, bundle_name = envelopes.sub_xml_names[0], envelopes.bid_xml_names[0]
+        pairs = []
+        for task in tasks:
+            if task.name == account_name:
+                pairs.append([task, None])
+            elif task.name == bundle_name and pairs and pairs[-1][1] is None:
+                pairs[-1][1] = task
+        if len(pairs) != len(msisdns):
+            raise ValueError("%d account results for %d subscribers" % (len(pairs), len(msisdns)))
+        return dict((msisdn, sub_info_from_tasks(msisdn, account, bundle_task))
+                    for msisdn, (account, bundle_task) in zip(msisdns, pairs))
+
+    except Exception as e:
+        log_error("while getting sub information in batch", e)
+        return {}
+
+
+class SubscriberCache(object):
+    """
+    Bounded LRU cache of subscriber states, each used for a limited time.
+
+    A later line of the same subscriber takes its state from the cache
+    instead of another lookup. The entry is kept current with the outcome
+    of each adjustment: a main balance adjustment stores the new balance it
+    returns and a bucket adjustment moves the counter of the bucket. An
+    adjustment that fails, or credits a bucket the entry does not hold, drops
+    the entry, so the next line looks the subscriber up again. In strict mode
+    lines that debit always look the subscriber up.
+
+    Args:
+        size (int): Subscribers kept, the least recently used being dropped first.
+        ttl (float): Seconds an entry is used after its lookup.
+        strict (bool): Never serve debits from the cache.
+    """
+
+    def __init__(self, size, ttl, strict=False):
+        self.size = max(size, 1)
+        self.ttl = ttl
+        self.strict = strict
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, msisdn, debit=False):
+        """
+        Looks a subscriber up in the cache.
+
+        Args:
+            msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+            debit (bool): The line debits the subscriber.
+
+        Returns:
+            SubscriberState: The cached state, None on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(msisdn)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[msisdn]
+                entry = None
+            if entry is None or (debit and self.strict):
+                self.misses += 1
+                return None
+            # Move the entry to the most recently used end
+            del self.entries[msisdn]
+            self.entries[msisdn] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, msisdn, subscriber):
+        """
+        Stores the state of a subscriber just looked up.
+
+        Args:
+            msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+            subscriber (SubscriberState): The state looked up, None when the lookup failed.
+        """
+        # Adjustments name the subscriber as the gateway does, so only those it names alike are kept
+        if subscriber is None or subscriber.msisdn != msisdn:
+            return
+        with self.lock:
+            self.entries.pop(msisdn, None)
+            self.entries[msisdn] = (time.time(), subscriber)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def adjusted(self, adjustment, result):
+        """
+        Updates the state of a subscriber with the outcome of an adjustment.
+
+        Args:
+            adjustment (tuple): Adjustment tuple as yielded by debit_steps and credit_steps.
+            result: Result of balance_adjustment or bucket_adjustment, None when it could not be applied.
+        """
+        msisdn = adjustment[1]
+        with self.lock:
+            entry = self.entries.get(msisdn)
+            if entry is None:
+                return
+            stamp, subscriber = entry
+            status = result[0] if isinstance(result, tuple) else result
+            updated = None
+            if status == 'SUCCESS' and adjustment[0] == 'balance':
+                updated = subscriber.with_balance(Amount.from_units(result[1]))
+            elif status == 'SUCCESS':
+                amount = Amount(adjustment[2]) if adjustment[4] == 'INCR' else -Amount(adjustment[2])
+                updated = subscriber.with_bucket_counter(adjustment[3], amount)
+            if updated is None:
+                del self.entries[msisdn]
+            else:
+                self.entries[msisdn] = (stamp, updated)
+
+    def report(self):
+        """
+        Logs and prints the hit rate of the run.
+        """
+        if not self.hits + self.misses:
+            return
+        message = ("Subscriber cache: %d hits, %d lookups (%.1f%% hit rate)"
+                   % (self.hits, self.misses, 100.0 * self.hits / (self.hits + self.misses)))
+        logging.info(message)
+        print(message)
+
+
+def subscriber_cache(cf):
+    """
+    Builds the subscriber cache configured for bulk runs.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+
+    Returns:
+        SubscriberCache: The cache, or None when sub_cache_size is 0.
+    """
+    size = get_option(cf, 'sub_cache_size', 10000, int)
+    if size <= 0:
+        return None
+    return SubscriberCache(size, get_option(cf, 'sub_cache_ttl', 60.0, float),
+                           strict=get_option(cf, 'sub_cache_strict', 'no').lower() in ('1', 'yes', 'true', 'on'))
+
+
+def balance_from_tasks(tasks):
+    """
+    Reads the result of a main balance adjustment from its task results.
+
+    Args:
+        tasks (list): TaskResults of the adjustment.
+
+    Returns:
+        tuple: adj_status (adjustment status) and balance after adjustment.
+
+    Raises:
+        IndexError: If the response holds no balance.
+    """
+    # Extract adjustment status and balance, the last value returned
+    balance = re.findall(r"\d+", tasks[-1].attributes[-1][1] if tasks[-1].attributes else tasks[-1].status)
+    return tasks[0].status, balance[0]
+
+
+def bucket_status_from_tasks(tasks):
+    """
+    Reads the status of a bucket adjustment from its task results.
+
+    Args:
+        tasks (list): TaskResults of the adjustment.
+
+    Returns:
+        str: The status of the bucket adjustment task.
+    """
+    return tasks[1].status if len(tasks) > 1 else tasks[0].attributes[0][1]
+
+
+def balance_adjustment(session_id, msisdn, amount, adjust_method, envelopes, transport, req_id=''):
+    """
+    Adjusts the balance of a subscriber.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+        amount (float): Amount to adjust the balance.
+        adjust_method (str): Method to adjust the balance.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        req_id (str): ReqID identifying the adjustment, empty for none.
+
+    Returns:
+        tuple: A tuple containing adj_status (adjustment status) and balance after adjustment.
+
+    Raises:
+        Exception: If an error occurs during the process.
+
+    """
+
+    try:
+        # Splice the adjustment into the pre-rendered envelope
+        submit_request = envelopes.balance_adjustment(session_id, msisdn, amount, adjust_method, req_id)
+
+        # Send the SOAP request to increase the balance
+        started = time.time()
+        response = transport.post(submit_request)
+        
+        # Parse the response in a single pass
+        tasks = parse_response(response.content, envelopes.task_names).tasks
+        result = balance_from_tasks(tasks)
+        log_event(logging.DEBUG, "Balance adjustment", msisdn=msisdn, operation='balance ' + adjust_method,
+                  latency_ms=int((time.time() - started) * 1000), status=result[0], req_id=req_id)
+
+        # Return the adjustment status and balance
+        return result
+        
+    except Exception as e:
+        # Log and print any errors that occur
+        log_error("while adjusting balance", e, msisdn=msisdn, operation='balance ' + adjust_method, req_id=req_id)
+        print("Error in balance_adjustment: {}".format(e))
+		
+		
+		
+		
+		
+
+		
+		
+def bucket_adjustment(session_id, msisdn, amount, bucket_id, adjust_method, envelopes, transport, req_id=''):
+    """
+    Adjusts a specific bucket associated with a subscriber.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+        amount (float): Amount to adjust the bucket.
+        bucket_id (str): Identifier for the bucket to be adjusted.
+        adjust_method (str): Method to adjust the bucket.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        req_id (str): ReqID identifying the adjustment, empty for none.
+
+    Returns:
+        str: The main status indicating the success or failure of the bucket adjustment.
+
+    Raises:
+        Exception: If an error occurs during the process.
+
+    """
+
+    try:
+        # Splice the adjustment into the pre-rendered envelope
+        submit_request = envelopes.bucket_adjustment(session_id, msisdn, amount, bucket_id, adjust_method, req_id)
+
+        # Send the SOAP request to adjust the bucket
+        started = time.time()
+        response = transport.post(submit_request)
+
+        # Parse the response and take the status of the bucket adjustment task
+        tasks = parse_response(response.content, envelopes.task_names).tasks
+        status = bucket_status_from_tasks(tasks)
+        log_event(logging.DEBUG, "Bucket adjustment", msisdn=msisdn, operation='bucket ' + adjust_method,
+                  bucket_id=bucket_id, latency_ms=int((time.time() - started) * 1000), status=status, req_id=req_id)
+
+        # Return the main status indicating success or failure
+        return status
+
+    except Exception as e:
+        # Log and print any errors that occur
+        log_error("while adjusting bucket", e, msisdn=msisdn, operation='bucket ' + adjust_method,
+                  bucket_id=bucket_id, req_id=req_id)
+        print("Error in bucket_adjustment: {}".format(e))
+		
+		
+		
+	
+def submit_adjustments_batch(session_id, envelopes, adjustments, transport, req_id=''):
+    """
+    Applies several balance and bucket adjustments with a single SubmitRequest.
+
+    The tasks run with ContinueOnFailure, so the result of each adjustment is
+    taken from its own tasks and a failed adjustment does not fail the others.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        adjustments (list): Adjustment tuples as taken by EnvelopeBuilder.submit_batch.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        req_id (str): ReqID of the request, empty for none.
+
+    Returns:
+        list: For each adjustment, the balance_adjustment or bucket_adjustment
+        result, or None when it could not be applied.
+    """
+    results = [None] * len(adjustments)
+    try:
+        started = time.time()
+        response = transport.post(envelopes.submit_batch(session_id, adjustments, req_id))
+        tasks = parse_response(response.content, envelopes.task_names).tasks
+        log_event(logging.DEBUG, "Adjustment batch", operation='submit batch', adjustments=len(adjustments),
+                  latency_ms=int((time.time() - started) * 1000), req_id=req_id)
+
+        # Walk the results in task order: a main adjustment has one task, a
+        # bucket adjustment its bundle task followed by the bucket task
+        balance_name = envelopes.bal_xml_names[0]
+        bundle_name, bucket_name = envelopes.buc_xml_names[0], envelopes.buc_xml_names[3]
+        pos = 0
+        for i, adjustment in enumerate(adjustments):
+            if adjustment[0] == 'balance':
+                if pos >= len(tasks) or tasks[pos].name != balance_name:
+                    break
+                task = tasks[pos]
+                pos += 1
+                try:
+                    results[i] = balance_from_tasks([task])
+                except IndexError:
+                    log_error("while adjusting balance in batch:", task.status, msisdn=adjustment[1],
+                              operation='balance ' + adjustment[-1], status=task.status, req_id=req_id)
+            else:
+                if pos < len(tasks) and tasks[pos].name == bundle_name:
+                    pos += 1
+                if pos >= len(tasks) or tasks[pos].name != bucket_name:
+                    break
+                results[i] = tasks[pos].status
+                pos += 1
+        else:
+            if pos == len(tasks):
+                return results
+        raise ValueError("%d task results do not match %d adjustments" % (len(tasks), len(adjustments)))
+
+    except Exception as e:
+        # Adjustments matched before the mismatch keep their results
+        log_error("while submitting adjustments in batch", e)
+        print("Error in submit_adjustments_batch: {}".format(e))
+        return results
+
+
+class SubmitBatcher(object):
+    """
+    Groups the adjustments of concurrent workers into batched SubmitRequests.
+
+    Each call blocks until its adjustment has been submitted. The first call of
+    a batch waits up to the linger time for other workers to add theirs; the
+    batch is sent as soon as it is full or the linger time has passed.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        batch_size (int): Adjustments per SubmitRequest, 1 to submit each on its own.
+        linger (float): Seconds a batch waits to fill up.
+    """
+
+    def __init__(self, session_id, envelopes, transport, batch_size, linger):
+        self.session_id = session_id
+        self.envelopes = envelopes
+        self.transport = transport
+        self.batch_size = max(batch_size, 1)
+        self.linger = linger
+        self.lock = threading.Lock()
+        self.pending = []
+        self.adjustments = 0
+        self.submits = 0
+
+    def balance_adjustment(self, session_id, msisdn, amount, adjust_method, envelopes, transport, req_id=''):
+        """
+        Adjusts the balance of a subscriber, taking the arguments of balance_adjustment.
+        """
+        if self.batch_size == 1:
+            self.count(1)
+            return balance_adjustment(session_id, msisdn, amount, adjust_method, envelopes, transport, req_id)
+        return self.submit(('balance', msisdn, amount, adjust_method), req_id)
+
+    def bucket_adjustment(self, session_id, msisdn, amount, bucket_id, adjust_method, envelopes, transport, req_id=''):
+        """
+        Adjusts a bonus bucket of a subscriber, taking the arguments of bucket_adjustment.
+        """
+        if self.batch_size == 1:
+            self.count(1)
+            return bucket_adjustment(session_id, msisdn, amount, bucket_id, adjust_method, envelopes, transport, req_id)
+        return self.submit(('bucket', msisdn, amount, bucket_id, adjust_method), req_id)
+
+    def count(self, adjustments):
+        """
+        Records one SubmitRequest in the run statistics.
+
+        Args:
+            adjustments (int): Adjustments carried by the request.
+        """
+        with self.lock:
+            self.adjustments += adjustments
+            self.submits += 1
+
+    def submit(self, adjustment, req_id=''):
+        """
+        Adds an adjustment to the current batch and waits for its result.
+
+        Args:
+            adjustment (tuple): Adjustment tuple as taken by EnvelopeBuilder.submit_batch.
+            req_id (str): Request id of the adjustment, empty for none.
+
+        Returns:
+            The result of the adjustment, None when it could not be applied.
+        """
+        entry = [adjustment, threading.Event(), None, req_id]
+        batch = None
+        with self.lock:
+            self.pending.append(entry)
+            leader = len(self.pending) == 1
+            if len(self.pending) >= self.batch_size:
+                batch, self.pending = self.pending, []
+        if batch is None and leader and not entry[1].wait(self.linger):
+            with self.lock:
+                # Still unsent after the linger time, send whatever has gathered
+                if self.pending and self.pending[0] is entry:
+                    batch, self.pending = self.pending, []
+        if batch is not None:
+            self.flush(batch)
+        entry[1].wait()
+        return entry[2]
+
+    def flush(self, batch):
+        """
+        Sends a batch and hands each waiting call its result.
+
+        Args:
+            batch (list): Pending [adjustment, event, result, request id] entries.
+        """
+        try:
+            self.count(len(batch))
+            results = submit_adjustments_batch(self.session_id, self.envelopes, [e[0] for e in batch], self.transport,
+                                               batch_request_id([e[3] for e in batch]))
+            for entry, result in zip(batch, results):
+                entry[2] = result
+        finally:
+            for entry in batch:
+                entry[1].set()
+
+
+def file_digest(file_name):
+    """
+    Computes the SHA-1 digest of a file.
+
+    Args:
+        file_name (str): File to digest.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def batch_request_id(req_ids):
+    """
+    Derives the ReqID of a batched SubmitRequest from the request ids of its adjustments.
+
+    Args:
+        req_ids (list): Request ids of the adjustments in the batch.
+
+    Returns:
+        str: The ReqID, empty when the adjustments have none.
+    """
+    req_ids = [req_id for req_id in req_ids if req_id]
+    if len(req_ids) < 2:
+        return req_ids[0] if req_ids else ''
+    return hashlib.sha1(",".join(req_ids).encode('utf-8')).hexdigest()[:32]
+
+
+class AdjustmentLedger(object):
+    """
+    Local ledger of the adjustments sent for the lines of an input file.
+
+    Each adjustment of a line gets a request id derived from the SHA-1 of the
+    file, the line number and the adjustment itself (MSISDN, amount, bucket
+    and method), which is sent as the ReqID of its SubmitRequest. The id and
+    outcome are kept in an sqlite table keyed on the id, and consulted before
+    every submit: an adjustment that already succeeded, in this run or an
+    earlier run of the same file, is answered from the ledger and not sent
+    again. Adjustments that failed or whose outcome never came back are sent
+    again under the same ReqID.
+
+    A batched SubmitRequest carries one ReqID derived from all the adjustments
+    it happened to group, which a later run does not reproduce. Batched
+    adjustments that come back without a result, or whose run stopped before
+    their result was recorded, are therefore held back instead of being sent
+    again, until they are checked on the gateway and released with
+    resend_unknown.
+
+    Args:
+        path (str): sqlite database file, shared by all input files.
+        input_file (str): Input file of the run.
+        resend_unknown (bool): Send the held back batched adjustments again.
+    """
+
+    def __init__(self, path, input_file, resend_unknown=False):
+        self.path = path
+        self.digest = file_digest(input_file)
+        self.resend_unknown = resend_unknown
+        self.lock = threading.Lock()
+        self.skipped = 0
+        self.held = 0
+        import sqlite3  # For the ledger database
+        # The shard processes of a sharded run write to the same ledger, waiting on each other's commits
+        self.db = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self.db.execute("PRAGMA busy_timeout = 30000")
+        # Commits survive the process being killed without a sync to disk each
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS adjustments (req_id TEXT PRIMARY KEY, msisdn TEXT, "
+                        "adjustment TEXT, state TEXT, result TEXT, updated REAL)")
+        self.db.commit()
+
+    def request_id(self, line_no, adjustment):
+        """
+        Builds the request id of an adjustment.
+
+        Args:
+            line_no (int): Line number of the adjustment in the input file, from 0.
+            adjustment (tuple): Adjustment tuple as yielded by debit_steps and credit_steps.
+
+        Returns:
+            str: The request id, 32 hex digits.
+        """
+        key = "\t".join([self.digest, str(line_no)] + [str(field) for field in adjustment])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:32]
+
+    def lookup(self, req_id):
+        """
+        Looks up an adjustment that already succeeded.
+
+        Args:
+            req_id (str): Request id of the adjustment.
+
+        Returns:
+            The result of the adjustment, None when it has not succeeded before.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT result FROM adjustments WHERE req_id = ? AND state = 'done'",
+                                  (req_id,)).fetchone()
+            if row is None:
+                return None
+            self.skipped += 1
+        result = json.loads(row[0])
+        return tuple(str(value) for value in result) if isinstance(result, list) else str(result)
+
+    def held_back(self, req_id, line_no):
+        """
+        Tells whether an adjustment is held back, having been sent in a batch that left its outcome unknown.
+
+        That is a batch that got no result for it, or one the run stopped in
+        before recording its result, which leaves the adjustment as sent.
+
+        Args:
+            req_id (str): Request id of the adjustment.
+            line_no (int): Line number of the adjustment in the input file, from 0.
+
+        Returns:
+            bool: True if the adjustment is not to be sent.
+        """
+        if self.resend_unknown:
+            return False
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM adjustments WHERE req_id = ? AND state IN ('unknown', 'sent_batch')",
+                                  (req_id,)).fetchone()
+            if row is None:
+                return False
+            self.held += 1
+        logging.warning("Adjustment %s of line %d was sent in a batch that left no result for it, held back",
+                        req_id, line_no + 1)
+        return True
+
+    def begin(self, req_id, adjustment, batched=False):
+        """
+        Records an adjustment as sent, before it is submitted.
+
+        Args:
+            req_id (str): Request id of the adjustment.
+            adjustment (tuple): Adjustment tuple as yielded by debit_steps and credit_steps.
+            batched (bool): The adjustment goes in a batched SubmitRequest, under the ReqID of the batch.
+        """
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO adjustments VALUES (?, ?, ?, ?, NULL, ?)",
+                            (req_id, str(adjustment[1]), " ".join(str(field) for field in adjustment),
+                             'sent_batch' if batched else 'sent', time.time()))
+            self.db.commit()
+
+    def finish(self, req_id, result, batched=False):
+        """
+        Records the outcome of a submitted adjustment.
+
+        Args:
+            req_id (str): Request id of the adjustment.
+            result: Result of balance_adjustment or bucket_adjustment, None when it could not be applied.
+            batched (bool): The adjustment was sent in a batched SubmitRequest, under the ReqID of the batch.
+        """
+        status = result[0] if isinstance(result, tuple) else result
+        if status == 'SUCCESS':
+            state = 'done'
+        else:
+            # Resending under the ReqID of another batch could apply a batched adjustment twice
+            state = 'unknown' if batched and result is None else 'failed'
+        with self.lock:
+            self.db.execute("UPDATE adjustments SET state = ?, result = ?, updated = ? WHERE req_id = ?",
+                            (state, json.dumps(result), time.time(), req_id))
+            self.db.commit()
+
+    def prepare(self, line_no, adjustment, batched=False):
+        """
+        Decides whether an adjustment is to be sent, recording it as sent when it is.
+
+        Args:
+            line_no (int): Line number of the adjustment in the input file, from 0.
+            adjustment (tuple): Adjustment tuple as yielded by debit_steps and credit_steps.
+            batched (bool): The adjustment goes in a batched SubmitRequest.
+
+        Returns:
+            tuple: The request id, whether to send the adjustment, and otherwise its result: from the ledger
+            when it was applied before, None when it is held back. A sent adjustment is then recorded with finish.
+        """
+        req_id = self.request_id(line_no, adjustment)
+        result = self.lookup(req_id)
+        if result is not None:
+            logging.info("Adjustment %s of line %d already applied, not sent again", req_id, line_no + 1)
+            return req_id, False, result
+        if self.held_back(req_id, line_no):
+            return req_id, False, None
+        self.begin(req_id, adjustment, batched)
+        return req_id, True, None
+
+    def apply(self, line_no, adjustment, submit, batched=False):
+        """
+        Applies an adjustment unless the ledger holds it as already applied, or as held back.
+
+        Args:
+            line_no (int): Line number of the adjustment in the input file, from 0.
+            adjustment (tuple): Adjustment tuple as yielded by debit_steps and credit_steps.
+            submit (callable): Sends the adjustment under the request id passed to it and returns its result.
+            batched (bool): submit sends the adjustment in a batched SubmitRequest.
+
+        Returns:
+            The result of the adjustment, from the ledger when it was applied before, None when it is held back.
+        """
+        req_id, send, result = self.prepare(line_no, adjustment, batched)
+        if send:
+            result = submit(req_id)
+            self.finish(req_id, result, batched)
+        return result
+
+    def report(self):
+        """
+        Logs and prints the adjustments of the run the ledger did not send.
+        """
+        if self.skipped:
+            message = "%d adjustments already applied by an earlier run were not sent again" % self.skipped
+            logging.info(message)
+            print(message)
+        if self.held:
+            message = ("%d adjustments sent in batches that left no result for them were held back; check them on "
+                       "the gateway, then run again with ledger_resend_unknown = yes to send them" % self.held)
+            logging.warning(message)
+            print(message)
+
+    def close(self):
+        """
+        Closes the ledger database.
+        """
+        with self.lock:
+            self.db.close()
+
+
+def setup_logging(now, logdirname, cf=None):
+    """
+    Sets up logging configuration to log operations.
+
+    Records are put on a queue by the thread logging them and written to the
+    log file by a listener thread, so the bulk workers do not wait on the
+    disk. Python 2 has no log queue and writes them directly.
+
+    Args:
+        now (datetime.datetime): Current date and time.
+        logdirname (str): Directory path for storing log files.
+        cf (ConfigParser.ConfigParser): Configuration parser object, None for the default settings.
+
+    Returns:
+        logging.handlers.QueueListener: The listener writing the log file, None without a log queue.
+
+    Raises:
+        ValueError: If log_level or log_format is not valid.
+    """
+    import logging.handlers  # For the log queue and log file rotation
+    # Define log file name based on current date and time
+    logfilename = logdirname + '/' + now.strftime('Credit_Debit_Ops_Tool_%d%m%Y_%H%M.log')
+
+    # Create the log directory if it doesn't exist
+    if not os.path.exists(logdirname):
+        os.makedirs(logdirname)
+
+    if cf is None:
+        cf = ConfigParser.ConfigParser()
+    level = get_option(cf, 'log_level', 'INFO').upper()
+    if not isinstance(logging.getLevelName(level), int):
+        raise ValueError("log_level must be DEBUG, INFO, WARNING or ERROR, not " + repr(level))
+    log_format = get_option(cf, 'log_format', 'text').lower()
+    if log_format not in ('text', 'json'):
+        raise ValueError("log_format must be text or json, not " + repr(log_format))
+
+    # Rotate by size, or at a time, or keep the one file of the run
+    max_bytes = get_option(cf, 'log_max_bytes', 0, int)
+    rotate_when = get_option(cf, 'log_rotate_when', '')
+    backups = get_option(cf, 'log_backup_count', 5, int)
+    if max_bytes > 0:
+        handler = logging.handlers.RotatingFileHandler(logfilename, maxBytes=max_bytes, backupCount=backups)
+    elif rotate_when:
+        handler = logging.handlers.TimedRotatingFileHandler(logfilename, when=rotate_when, backupCount=backups)
+    else:
+        handler = logging.FileHandler(logfilename, mode='w')
+    handler.setFormatter(StructuredFormatter(log_format == 'json'))
+
+    root = logging.getLogger()
+    root.setLevel(logging.getLevelName(level))
+    if not hasattr(logging.handlers, 'QueueListener'):
+        root.addHandler(handler)
+        return None
+    log_queue = Queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    # Write out the records still queued when the script ends
+    atexit.register(listener.stop)
+    return listener
+
+
+def stop_logging(listener):
+    """
+    Writes out the queued log records and stops the listener of setup_logging.
+
+    Args:
+        listener (logging.handlers.QueueListener): The listener, None without a log queue.
+    """
+    if listener is not None:
+        atexit.unregister(listener.stop)
+        listener.stop()
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats log records with the fields given to log_event.
+
+    Text lines keep the usual layout with the fields appended as key=value
+    pairs; JSON lines hold time, level, message and the fields, one object
+    per line.
+
+    Args:
+        as_json (bool): Write JSON lines.
+    """
+
+    def __init__(self, as_json=False):
+        logging.Formatter.__init__(self, '%(asctime)s %(levelname)-8s %(message)s', '%Y-%m-%d %H:%M:%S')
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        if self.as_json:
+            entry = {'time': self.formatTime(record, self.datefmt), 'level': record.levelname,
+                     'message': record.getMessage()}
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            entry.update(fields)
+            return json.dumps(entry, sort_keys=True, default=str)
+        line = logging.Formatter.format(self, record)
+        if fields:
+            # Values holding spaces are quoted so each pair still splits on spaces
+            line += " " + " ".join("%s=%s" % (name, json.dumps(str(fields[name])) if " " in str(fields[name])
+                                              else fields[name]) for name in sorted(fields))
+        return line
+
+
+def log_event(level, message, **fields):
+    """
+    Logs a message with structured fields, e.g. msisdn, operation, latency_ms, status and req_id.
+
+    Args:
+        level (int): Logging level.
+        message (str): The message.
+        **fields: Fields written apart from the message.
+    """
+    logging.log(level, message, extra={'fields': fields})
+
+
+def log_error(message, e, **fields):
+    """
+    Logs an error at ERROR level.
+
+    Args:
+        message (str): What was being done, e.g. "while adjusting balance".
+        e: The exception, or the status that failed.
+        **fields: Structured fields of the error, see log_event.
+    """
+    logging.error("Error occurred " + message + " " + str(e), extra={'fields': fields})
+
+	
+	
+	
+
+# Field separators of an input line, and the amounts and states read from it
+FIELD_SEPARATOR = re.compile(r"[\t\s;,:]")
+FIELD_SEPARATORS = re.compile(r"[\t\s;,:]{1,10}")
+MAIN_DEBIT = re.compile(r"MAIN|main\s\-(\d+\.?\d?\d?)")
+BONUS_DEBIT = re.compile(r"BONUS|bonus\s\-(\d+\.?\d?\d?)")
+MAIN_CREDIT = re.compile(r"MAIN|main\s\+(\d+\.?\d?\d?)")
+BONUS_CREDIT = re.compile(r"BONUS|bonus\s\+(\d+\.?\d?\d?)")
+DEACTIVATED_STATE = re.compile(r"\w{3}_DE\w{4,6}\d*")
+VALID_STATE = re.compile(r"\w{3}_VA\w{3}\d*")
+VALID_MSISDN = re.compile(r"234\d{10}$")
+AMOUNT_FIELD = re.compile(r"\b(main|bonus)\b\s*(\S*)", re.IGNORECASE)
+VALID_AMOUNT = re.compile(r"[-+]\d+(?:\.\d\d?)?$")
+
+# Adjustment of one input row: signed Amounts, None when the balance is not adjusted
+AdjustmentRecord = collections.namedtuple('AdjustmentRecord', 'msisdn main_delta bonus_delta bucket_id details')
+
+# Line of an execution plan: its adjustment record and the subscriber state it was planned on
+PlannedRecord = collections.namedtuple('PlannedRecord', AdjustmentRecord._fields + ('subscriber',))
+
+
+class AdjustmentRequest(object):
+    """
+    The operation of one input line on the state of its subscriber.
+
+    Attributes:
+        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+        main_debit (Amount): Main balance debit, 0 for none.
+        bonus_debit (int): Bonus balance debit, as main_debit.
+        main_credit (int): Main balance credit, as main_debit.
+        bonus_credit (int): Bonus balance credit, as main_debit.
+        deactivated (bool): The line is in a deactivated state.
+        valid_state (bool): The line is in a valid (not yet active) state.
+        subscriber (SubscriberState): The state of the subscriber.
+    """
+
+    __slots__ = ('msisdn', 'main_debit', 'bonus_debit', 'main_credit', 'bonus_credit', 'deactivated', 'valid_state',
+                 'subscriber')
+
+    def __init__(self, msisdn, main_debit, bonus_debit, main_credit, bonus_credit, deactivated, valid_state, subscriber):
+        self.msisdn = msisdn
+        self.main_debit = main_debit
+        self.bonus_debit = bonus_debit
+        self.main_credit = main_credit
+        self.bonus_credit = bonus_credit
+        self.deactivated = deactivated
+        self.valid_state = valid_state
+        self.subscriber = subscriber
+
+
+def normalize_msisdn(msisdn):
+    """
+    Puts an MSISDN in international form, with the 234 country code.
+
+    Args:
+        msisdn (str): MSISDN as written in the input, with or without +234 or the leading 0.
+
+    Returns:
+        str: The MSISDN with the 234 prefix.
+    """
+    if msisdn.startswith("+"):
+        msisdn = msisdn[1:]
+    if msisdn.startswith("234"):
+        return msisdn
+    return "234" + (msisdn[1:] if msisdn.startswith("0") and len(msisdn) == 11 else msisdn)
+
+
+def extract_msisdn(details):
+    """
+    Extracts the MSISDN from an input line, prefixing the country code when missing.
+
+    Args:
+        details (str): Input line, the MSISDN being its first field.
+
+    Returns:
+        str: The MSISDN with the 234 prefix.
+
+    Raises:
+        ValueError: If the line is empty.
+    """
+    msisdn = FIELD_SEPARATOR.split(details.strip(), 1)[0]
+    if not msisdn:
+        raise ValueError("no MSISDN in input line")
+    return normalize_msisdn(msisdn)
+
+
+def parse_amount(pattern, args):
+    """
+    Reads one amount from a normalized input line.
+
+    Args:
+        pattern (re.RegexObject): One of the MAIN_DEBIT, BONUS_DEBIT, MAIN_CREDIT and BONUS_CREDIT patterns.
+        args (str): Input line with its separators normalized to single spaces.
+
+    Returns:
+        Amount: The amount, None when the line holds none.
+
+    Raises:
+        ValueError: If the line holds the amount more than once.
+    """
+    amount = " ".join(pattern.findall(args))
+    return Amount.parse(amount) if amount else None
+
+
+def parse_details(details):
+    """
+    Parses an input line into an adjustment record.
+
+    Args:
+        details (str): Input line, the MSISDN followed by the operation.
+
+    Returns:
+        AdjustmentRecord: The adjustments of the line.
+
+    Raises:
+        ValueError: If the line holds no MSISDN, or an amount that cannot be read.
+    """
+    # Normalize the input details
+    args = FIELD_SEPARATORS.sub(" ", details)
+    msisdn = extract_msisdn(args)
+
+    deltas = []
+    for debit, credit, name in ((MAIN_DEBIT, MAIN_CREDIT, "main"), (BONUS_DEBIT, BONUS_CREDIT, "bonus")):
+        debit, credit = parse_amount(debit, args), parse_amount(credit, args)
+        if debit is not None and credit is not None:
+            raise ValueError("both a debit and a credit of the " + name + " balance in input line")
+        deltas.append(-debit if debit is not None else credit)
+    bucket_id = "MAA" if "MAA" in details else "MA4" if "MA4" in details else None
+    return AdjustmentRecord(msisdn, deltas[0], deltas[1], bucket_id, details)
+
+
+def parse_argument(session_id, envelopes, transport, details, subscriber=None, record=None, cache=None):
+    """
+    Parses the command line arguments to extract necessary information.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        details (str): Details extracted from command line arguments.
+        subscriber (SubscriberState): Prefetched subscriber state, None to look it up.
+        record (AdjustmentRecord): The line already parsed by the input reader, None to parse details.
+        cache (SubscriberCache): Subscribers looked up by earlier lines, None to look each one up.
+
+    Returns:
+        AdjustmentRequest: The operation of the line, None if it could not be parsed or looked up.
+
+    Raises:
+        Exception: If an error occurs during parsing.
+
+    """
+    try:
+        if record is None:
+            record = parse_details(details)
+        msisdn = record.msisdn
+
+        # Split the signed amounts into debit and credit amounts for main and bonus
+        main, bonus = record.main_delta or Amount(0), record.bonus_delta or Amount(0)
+
+        # Retrieve subscriber information, unless it was prefetched or is cached
+        cached = None
+        if subscriber is None and cache is not None:
+            subscriber = cached = cache.get(msisdn, debit=main < 0 or bonus < 0)
+        if subscriber is None:
+            subscriber = get_sub_info(session_id, envelopes, msisdn, transport)
+        if subscriber is None:
+            return None
+        if cache is not None and subscriber is not cached:
+            cache.put(msisdn, subscriber)
+
+        # Extract relevant status information
+        return AdjustmentRequest(msisdn, max(-main, Amount(0)), max(-bonus, Amount(0)), max(main, Amount(0)),
+                                 max(bonus, Amount(0)),
+                                 bool(DEACTIVATED_STATE.match(subscriber.state)),
+                                 bool(VALID_STATE.match(subscriber.state)), subscriber)
+
+    except Exception as e:
+        log_error("while parsing argument", e)
+        print("Error in parse_argument: {}".format(e))	
+		
+		
+		
+		
+
+	
+
+def debit_steps(args, current_date, policy='earliest'):
+    """
+    Steps through the debit operations for a subscriber.
+
+    Each adjustment is yielded as an adjustment tuple and its result is sent
+    back into the generator by the driver running it, see run_steps.
+
+    Args:
+        args (AdjustmentRequest): The debit operation of the line.
+        current_date (str): Current date for comparison.
+        policy (str): How bonus debits pick their buckets, see BucketIndex.
+
+    Yields:
+        tuple: The adjustments to apply, then a str representing the result of the debit operations.
+    """
+    try:
+        # Extracting relevant information from the request and subscriber state
+        debit_amt_main, debit_amt_bonus = args.main_debit, args.bonus_debit
+        deactivated, valid_state, subscriber = args.deactivated, args.valid_state, args.subscriber
+        msisdn, balance = subscriber.msisdn, subscriber.balance
+
+        # Main balance debit operation
+        if debit_amt_main:
+            if subscriber.status == 'SUCCESS' and not deactivated and not valid_state:
+                if balance >= debit_amt_main:
+                    # Perform main balance adjustment, the gateway takes main amounts in NGN
+                    adj_status, adj_balance = (yield ('balance', msisdn, debit_amt_main.ngn(), 'DECR'))
+                    main_debit = "main debiting " + adj_status + ", current main balance -> NGN" + Amount.from_units(adj_balance).ngn()
+                else:
+                    main_debit = "Current main balance of NGN" + balance.ngn() + " not sufficient for debiting NGN" + debit_amt_main.ngn()
+            elif deactivated:
+                main_debit = "The line is deactive, can't debit"
+            elif valid_state:
+                main_debit = "The line is in valid state, can't debit"
+        else:
+            main_debit = ""
+
+        # Bonus balance debit operation
+        if debit_amt_bonus:
+            if subscriber.bonus_status == "SUCCESS" and not deactivated and not valid_state:
+                debits = subscriber.bucket_index(current_date).pick(debit_amt_bonus, policy)
+                if debits:
+                    # Perform the bonus balance adjustments, stopping at the first that fails
+                    adj_status, debited = "SUCCESS", 0
+                    for bucket, amount in debits:
+                        adj_status = (yield ('bucket', msisdn, amount, bucket.bucket_id, 'DECR'))
+                        if adj_status != "SUCCESS":
+                            break
+                        debited += amount
+                    left = sum(bucket.counter for bucket, amount in debits) - debited
+                    bonus_debit = "bonus debiting " + adj_status + ", current bonus balance -> NGN" + left.ngn()
+                else:
+                    bonus_debit = "Current bonus balance not sufficient for debiting NGN" + debit_amt_bonus.ngn()
+            elif deactivated:
+                bonus_debit = "The line is deactive, can't debit bonus"
+            elif valid_state:
+                bonus_debit = "The line is in valid state, can't debit bonus"
+            else:
+                bonus_debit = "Insufficient bonus balance for debiting"
+        else:
+            bonus_debit = ""
+
+        # Concatenate main and bonus debit results
+        demarcate = " | " if main_debit and bonus_debit else ""
+        yield "{}: {}{}{}".format(msisdn, main_debit or "", demarcate, bonus_debit or "")
+
+    except Exception as e:
+        # Log and print any errors that occur
+        log_error("while carrying out debit operations", e)
+        print("Error in debit_operations: {}".format(e))
+		
+		
+		
+		
+		
+		
+		
+def credit_steps(args, details):
+    """
+    Steps through the credit operations on the main and bonus balances of a subscriber.
+
+    Each adjustment is yielded as an adjustment tuple and its result is sent
+    back into the generator by the driver running it, see run_steps.
+
+    Args:
+        args (AdjustmentRequest): The credit operation of the line.
+        details (str): Details of the credit operation.
+
+    Yields:
+        tuple: The adjustments to apply, then a str with information about the result of the credit operations.
+
+    """
+
+    try:
+        # Extracting credit amounts, subscriber status, and balance information
+        credit_amt_main, credit_amt_bonus = args.main_credit, args.bonus_credit
+        deactivated, valid_state, subscriber = args.deactivated, args.valid_state, args.subscriber
+        msisdn, bonus_status, bonus_info1 = subscriber.msisdn, subscriber.bonus_status, subscriber.buckets
+
+        # Credit operation for main balance
+        if credit_amt_main:
+            if subscriber.status == 'SUCCESS':
+                if not deactivated and not valid_state:
+                    # Perform balance adjustment for main balance, the gateway takes main amounts in NGN
+                    adj_status, adj_balance = (yield ('balance', msisdn, credit_amt_main.ngn(), 'INCR'))
+                    main_credit = "main crediting " + adj_status + ", current main balance -> NGN" + Amount.from_units(adj_balance).ngn()
+                elif valid_state:
+                    main_credit = "The line is in valid state, can't credit main."
+                elif deactivated:
+                    main_credit = "The line is deactive, can't credit main"
+                else:
+                    main_credit = "call the script_writer attention"
+            else:
+                main_credit = "not on IN"
+        else:
+            main_credit = ""    
+        
+        # Credit operation for bonus balance
+        if credit_amt_bonus:
+            if bonus_status == 'SUCCESS' and not deactivated and not valid_state:
+                bonus_balance = bonus_info1[0].counter if bonus_info1 else Amount(0)
+                credit_bucket_id = "MAA" if "MAA" in details else "MA4" if "MA4" in details else None
+                
+                # Perform bucket adjustment for bonus balance
+                if credit_bucket_id:
+                    adj_status = (yield ('bucket', msisdn, credit_amt_bonus, credit_bucket_id, 'INCR'))
+                    total_bal = (bonus_balance + credit_amt_bonus if adj_status == 'SUCCESS' else bonus_balance).ngn()
+                    bonus_credit = "bonus crediting " + adj_status + ", current bonus balance -> " + total_bal
+                else:
+                    bonus_credit = "Bucket id was not inputted, bonus credit was not executed"               
+            elif valid_state:
+                bonus_credit = "can't be credit in valid state"
+            elif deactivated:
+                bonus_credit = "can't be credited in deactivate state"
+            else:
+               bonus_credit = "call the script_writer attention"
+        else:
+            bonus_credit = ""
+            
+        # Formatting the result of credit operations
+        demarcate = " | " if main_credit and bonus_credit else ""
+        yield "{}: {}{}{}".format(msisdn, main_credit or "", demarcate, bonus_credit or "" )
+    
+    except Exception as e:
+        # Logging and printing any errors that occur
+        log_error("while carrying out credit operations", e)
+        print("Error in credit_operations: {}".format(e))   
+		
+		
+		
+		
+		
+		
+		
+		
+def debit_operations(args, session_id, current_date, envelopes, transport, batcher=None, policy='earliest'):
+    """
+    Perform debit operations for a subscriber.
+
+    Args:
+        args (AdjustmentRequest): The debit operation of the line.
+        session_id (str): Session ID for authentication.
+        current_date (str): Current date for comparison.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        batcher (SubmitBatcher): Batches the adjustments of a bulk run, None to submit them directly.
+        policy (str): How bonus debits pick their buckets, see BucketIndex.
+
+    Returns:
+        str: A formatted string representing the result of the debit operations.
+    """
+    return run_steps(debit_steps(args, current_date, policy), session_id, envelopes, transport, batcher)
+
+
+def credit_operations(args, details, session_id, envelopes, transport, batcher=None):
+    """
+    Perform credit operations on the main and bonus balances of a subscriber.
+
+    Args:
+        args (AdjustmentRequest): The credit operation of the line.
+        details (str): Details of the credit operation.
+        session_id (str): Session ID for authentication.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        batcher (SubmitBatcher): Batches the adjustments of a bulk run, None to submit them directly.
+
+    Returns:
+        str: Information about the result of the credit operations.
+    """
+    return run_steps(credit_steps(args, details), session_id, envelopes, transport, batcher)
+
+
+def line_steps(msisdn, details, current_date, args, policy='earliest'):
+    """
+    Picks the debit or credit operation of one input line.
+
+    Args:
+        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+        details (str): Details of the operation.
+        current_date (str): Current date and time.
+        args (AdjustmentRequest): The operation of the line.
+        policy (str): How bonus debits pick their buckets, see BucketIndex.
+
+    Returns:
+        The debit_steps or credit_steps generator of the line, its result line
+        when it needs no adjustment, or None when it holds no operation to run.
+    """
+    on_in = args.subscriber.on_in
+    # Go by the parsed amounts, the MSISDN may be written with a leading +
+    debit = bool(args.main_debit or args.bonus_debit)
+    credit = bool(args.main_credit or args.bonus_credit)
+
+    # Check if the operation is a debit
+    if debit and not credit and on_in:
+        return debit_steps(args, current_date, policy)
+
+    # Check if the operation is a credit
+    if credit and not debit and on_in:
+        return credit_steps(args, details)
+
+    # Handle scenario where subscriber is not on IN
+    elif not on_in:
+        return msisdn + ": " + 'not on IN'
+
+
+def run_steps(steps, session_id, envelopes, transport, batcher=None, ledger=None, line_no=0, cache=None):
+    """
+    Runs an operation generator, applying each adjustment it yields.
+
+    Args:
+        steps: Generator from line_steps, or the result line it returned.
+        session_id (str): Session ID for authentication.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        batcher (SubmitBatcher): Batches the adjustments of a bulk run, None to submit them directly.
+        ledger (AdjustmentLedger): Skips the adjustments already applied, None to submit every one.
+        line_no (int): Line number of the operation in the input file, from 0.
+        cache (SubscriberCache): Updated with the outcome of each adjustment sent, None for no cache.
+
+    Returns:
+        LineResult: The result line, None when the operation failed or holds nothing to run.
+    """
+    if not hasattr(steps, 'send'):
+        return line_result(steps, [])
+    # Adjustments go through the bulk submit batcher when there is one
+    adjust_balance = batcher.balance_adjustment if batcher is not None else balance_adjustment
+    adjust_bucket = batcher.bucket_adjustment if batcher is not None else bucket_adjustment
+    batched = batcher is not None and batcher.batch_size > 1
+
+    def submit(req_id):
+        if step[0] == 'balance':
+            result = adjust_balance(session_id, step[1], step[2], step[3], envelopes, transport, req_id)
+        else:
+            result = adjust_bucket(session_id, step[1], step[2], step[3], step[4], envelopes, transport, req_id)
+        if cache is not None:
+            cache.adjusted(step, result)
+        return result
+
+    metrics = getattr(transport, 'metrics', None)
+    applied = []
+    started = time.time()
+    submitting = 0.0
+    try:
+        step = next(steps)
+        while isinstance(step, tuple):
+            sent = time.time()
+            result = ledger.apply(line_no, step, submit, batched) if ledger is not None else submit('')
+            submitting += time.time() - sent
+            applied.append((step, result))
+            step = steps.send(result)
+        return line_result(step, applied)
+    except StopIteration:
+        # The operation logged its own error
+        return None
+    finally:
+        if metrics is not None:
+            # Time spent in the generator decides, the rest waits on the adjustments
+            metrics.stage('decide', time.time() - started - submitting)
+            if applied:
+                metrics.stage('submit', submitting, all(applied_ok(result) for step, result in applied))
+
+
+def applied_ok(result):
+    """
+    Tells whether an adjustment result is a success.
+
+    Args:
+        result: balance_adjustment or bucket_adjustment result.
+
+    Returns:
+        bool: True if the adjustment succeeded.
+    """
+    return (result[0] if isinstance(result, tuple) else result) == 'SUCCESS'
+
+
+class LineResult(str):
+    """
+    Result line of one input line, with what its adjustments did.
+
+    Attributes:
+        outcome (str): success when all its adjustments succeeded, partial when
+            some failed, failed when all failed, rejected when it needed none
+            or none could be made (not on IN, line state, insufficient balance).
+        debited (Amount): Total debited by the adjustments that succeeded.
+        credited (Amount): Total credited by the adjustments that succeeded.
+    """
+
+    def __new__(cls, text, outcome='rejected', debited=Amount(0), credited=Amount(0)):
+        result = str.__new__(cls, text)
+        result.outcome = outcome
+        result.debited = debited
+        result.credited = credited
+        return result
+
+
+def line_result(text, applied):
+    """
+    Builds the result of a line from its result line and the adjustments run for it.
+
+    Args:
+        text (str): Result line from debit_steps or credit_steps, None if there is none.
+        applied (list): (adjustment tuple, adjustment result) of each adjustment run.
+
+    Returns:
+        LineResult: The result, None when text is None.
+    """
+    if text is None:
+        return None
+    debited = credited = Amount(0)
+    succeeded = failed = 0
+    for step, result in applied:
+        if not applied_ok(result):
+            failed += 1
+            continue
+        succeeded += 1
+        # Main balance adjustments carry the amount in NGN, bucket adjustments in units
+        amount = Amount.parse(step[2]) if step[0] == 'balance' else Amount(step[2])
+        if step[-1] == 'INCR':
+            credited += amount
+        else:
+            debited += amount
+    if succeeded:
+        outcome = 'partial' if failed else 'success'
+    else:
+        outcome = 'failed' if failed else 'rejected'
+    return LineResult(text, outcome, debited, credited)
+
+
+def debit_credit_result(session_id, msisdn, details, current_date, envelopes, transport, args, batcher=None, ledger=None,
+                        line_no=0, cache=None, policy='earliest'):
+    """
+    Runs the debit or credit operation for one input line and returns its result line.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+        details (str): Details of the operation.
+        current_date (str): Current date and time.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        args (AdjustmentRequest): The operation of the line.
+        batcher (SubmitBatcher): Batches the adjustments of a bulk run, None to submit them directly.
+        ledger (AdjustmentLedger): Skips the adjustments already applied, None to submit every one.
+        line_no (int): Line number of the operation in the input file, from 0.
+        cache (SubscriberCache): Updated with the outcome of each adjustment sent, None for no cache.
+        policy (str): How bonus debits pick their buckets, see BucketIndex.
+
+    Returns:
+        LineResult: The result line, or None when the line holds no operation to run.
+    """
+    return run_steps(line_steps(msisdn, details, current_date, args, policy), session_id, envelopes, transport, batcher,
+                     ledger, line_no, cache)
+
+
+# Extension of the output file in each output format
+OUTPUT_FORMATS = {'text': '.txt', 'csv': '.csv', 'jsonl': '.jsonl'}
+
+
+def result_file_path(logdirname, now, filename, output_format='text'):
+    """
+    Builds the path of the output file holding the operation results.
+
+    Args:
+        logdirname (str): Directory for logging files.
+        now (datetime): Current date and time object.
+        filename (str): Name of the file (or MSISDN) being processed.
+        output_format (str): text, csv or jsonl.
+
+    Returns:
+        str: Path of the debit_credit output file.
+    """
+    return logdirname + '/' + now.strftime('debit_credit_' + os.path.basename(filename) + '_%d%m%Y_%H%M' +
+                                           OUTPUT_FORMATS[output_format])
+
+
+class ResultWriter(object):
+    """
+    Sink for the result lines of a run, kept open and buffered for the whole run.
+
+    Lines are written as text, or as CSV or JSONL rows with the MSISDN,
+    outcome and amounts apart, and flushed to disk every flush_seconds and
+    on close. Each line is also counted by outcome, with the amounts
+    credited and debited, for the summary of the run.
+
+    Args:
+        path (str): Output file, created with the first line written to it.
+        output_format (str): text, csv or jsonl.
+        quiet (bool): Do not print each line to the console.
+        flush_seconds (float): Longest time a written line stays in the buffer.
+    """
+
+    OUTCOMES = ('success', 'partial', 'failed', 'rejected')
+
+    def __init__(self, path, output_format='text', quiet=False, flush_seconds=1.0):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("output_format must be one of " + ", ".join(sorted(OUTPUT_FORMATS)) + ", not " +
+                             repr(output_format))
+        self.path = path
+        self.output_format = output_format
+        self.quiet = quiet
+        self.flush_seconds = flush_seconds
+        self.file = None
+        self.csv = None
+        self.counts = dict.fromkeys(self.OUTCOMES, 0)
+        self.missing = 0
+        self.debited = self.credited = Amount(0)
+        self.started = self.flushed = time.time()
+
+    def open(self):
+        self.file = open(self.path, 'a', 1 << 16)
+        if self.output_format == 'csv':
+            self.csv = csv.writer(self.file, lineterminator='\n')
+            if not self.file.tell():
+                self.csv.writerow(('msisdn', 'outcome', 'debited', 'credited', 'result'))
+
+    def write(self, result):
+        """
+        Writes the result of one line.
+
+        Args:
+            result (LineResult): The result line, None when the line has none.
+        """
+        result = self.count(result)
+        if result is None:
+            return
+        if self.file is None:
+            self.open()
+        if self.output_format == 'text':
+            self.file.write(result + '\n')
+        else:
+            msisdn, _, text = result.partition(': ')
+            row = (msisdn, result.outcome, result.debited.digits(), result.credited.digits(), text)
+            if self.csv is not None:
+                self.csv.writerow(row)
+            else:
+                self.file.write(json.dumps(dict(zip(('msisdn', 'outcome', 'debited', 'credited', 'result'), row)),
+                                           sort_keys=True) + '\n')
+        if not self.quiet:
+            print(result)
+        self.flush_due()
+
+    def count(self, result):
+        """
+        Counts the result of one line for the summary.
+
+        Args:
+            result (LineResult): The result line, None when the line has none.
+
+        Returns:
+            LineResult: The result, None when the line has none.
+        """
+        if not result:
+            # Blank lines, and lines that failed before an operation could run
+            self.missing += 1
+            return None
+        if not isinstance(result, LineResult):
+            result = LineResult(result)
+        self.counts[result.outcome] += 1
+        self.debited += result.debited
+        self.credited += result.credited
+        return result
+
+    def flush_due(self):
+        now = time.time()
+        if now - self.flushed >= self.flush_seconds:
+            self.file.flush()
+            self.flushed = now
+
+    def close(self):
+        """
+        Flushes and closes the output file.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def summary(self):
+        """
+        Builds the summary of the run.
+
+        Returns:
+            list: Lines of the summary.
+        """
+        elapsed = time.time() - self.started
+        lines = sum(self.counts.values()) + self.missing
+        outcomes = ", ".join("%d %s" % (self.counts[outcome], outcome) for outcome in self.OUTCOMES)
+        return ["Results: %d lines in %.1fs (%.1f lines/sec): %s, %d without result"
+                % (lines, elapsed, lines / elapsed if elapsed else 0.0, outcomes, self.missing),
+                "Debited NGN%s, credited NGN%s" % (self.debited.ngn(), self.credited.ngn())]
+
+    def report(self):
+        """
+        Logs and prints the summary of the run.
+        """
+        for line in self.summary():
+            logging.info(line)
+            print(line)
+
+
+def result_writer(cf, logdirname, now, filename, quiet=False):
+    """
+    Opens the result sink configured for a run.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+        logdirname (str): Directory for logging files.
+        now (datetime): Current date and time object.
+        filename (str): Name of the file (or MSISDN) being processed, - for stdin.
+        quiet (bool): Do not print each line to the console, whatever the quiet setting.
+
+    Returns:
+        ResultWriter: The sink.
+
+    Raises:
+        ValueError: If the configured output format is unknown.
+    """
+    output_format = get_option(cf, 'output_format', 'text').lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("output_format must be one of " + ", ".join(sorted(OUTPUT_FORMATS)) + ", not " +
+                         repr(output_format))
+    quiet = quiet or get_option(cf, 'quiet', 'no').lower() in ('1', 'yes', 'true', 'on')
+    return ResultWriter(result_file_path(logdirname, now, 'stdin' if filename == '-' else filename, output_format),
+                        output_format, quiet, get_option(cf, 'output_flush_seconds', 1.0, float))
+
+
+def debit_credit_logic(session_id, msisdn, details, current_date, envelopes, transport, filename, logdirname, now, args,
+                       policy='earliest', writer=None):
+    """
+    Function to execute debit and credit operations logic.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+        details (str): Details of the operation.
+        current_date (str): Current date and time.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        filename (str): Name of the file being processed.
+        logdirname (str): Directory for logging files.
+        now (datetime): Current date and time object.
+        args (AdjustmentRequest): The operation of the line.
+        policy (str): How bonus debits pick their buckets, see BucketIndex.
+        writer (ResultWriter): Sink for the result line, None to append it to the text output file.
+
+    """
+    result = debit_credit_result(session_id, msisdn, details, current_date, envelopes, transport, args, policy=policy)
+    sink = writer if writer is not None else ResultWriter(result_file_path(logdirname, now, filename))
+    try:
+        sink.write(result)
+    finally:
+        if writer is None:
+            sink.close()
+
+
+def process_line(session_id, details, current_date, envelopes, transport, subscriber=None, batcher=None, ledger=None,
+                 line_no=0, record=None, cache=None, policy='earliest'):
+    """
+    Parses one input line and runs its operation, as done by a bulk worker.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        details (str): Input line.
+        current_date (str): Current date and time.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        subscriber (SubscriberState): Prefetched subscriber state, None to look it up.
+        batcher (SubmitBatcher): Batches the adjustments of a bulk run, None to submit them directly.
+        ledger (AdjustmentLedger): Skips the adjustments already applied, None to submit every one.
+        line_no (int): Line number in the input file, from 0.
+        record (AdjustmentRecord): The line as parsed by read_records, None to parse it here; a
+            PlannedRecord brings the subscriber state it was planned on.
+        cache (SubscriberCache): Subscribers looked up by earlier lines, None to look each one up.
+        policy (str): How bonus debits pick their buckets, see BucketIndex.
+
+    Returns:
+        LineResult: The result line, or None when nothing is to be written for the line.
+    """
+    if not details.strip():
+        return None
+    if record is not None and not record.msisdn:
+        # The reader could not parse the line and has reported it
+        return None
+    if subscriber is None:
+        # Lines of an execution plan are run on the state they were planned on, without a lookup
+        subscriber = getattr(record, 'subscriber', None)
+    metrics = getattr(transport, 'metrics', None)
+    started = time.time()
+    args = parse_argument(session_id, envelopes, transport, details, subscriber, record, cache)
+    if metrics is not None:
+        metrics.stage('lookup', time.time() - started, args is not None)
+    if args is None:
+        return None
+    return debit_credit_result(session_id, args.msisdn, details, current_date, envelopes, transport, args, batcher,
+                               ledger, line_no, cache, policy)
+
+
+class SubscriberPrefetch(object):
+    """
+    Looks subscribers up in batched RetrieveRequests ahead of the bulk workers.
+
+    Only the first line of an MSISDN that has no earlier line still in progress
+    gets prefetched information; its later lines look the subscriber up again
+    once the earlier adjustments are done, as they always have.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        batch_size (int): Subscribers per RetrieveRequest.
+    """
+
+    def __init__(self, session_id, envelopes, transport, batch_size):
+        self.session_id = session_id
+        self.envelopes = envelopes
+        self.transport = transport
+        self.batch_size = batch_size
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.prefetched = 0
+
+    def jobs(self, lines):
+        """
+        Prefetches the subscribers of a batch of lines.
+
+        Args:
+            lines (list): (sequence number, line, MSISDN, position, record) of each line.
+
+        Returns:
+            list: (sequence number, line, MSISDN, subscriber, position, record) jobs, subscriber None when not prefetched.
+        """
+        wanted, seen = [], set()
+        with self.lock:
+            for seq, details, key, where, record in lines:
+                if key and key not in seen and not self.inflight.get(key):
+                    wanted.append(key)
+                    seen.add(key)
+                self.inflight[key] = self.inflight.get(key, 0) + 1
+        infos = get_sub_info_batch(self.session_id, self.envelopes, wanted, self.transport) if wanted else {}
+        self.lookups += 1 if wanted else 0
+        self.prefetched += len(infos)
+        return [(seq, details, key, infos.pop(key, None), where, record) for seq, details, key, where, record in lines]
+
+    def done(self, key):
+        """
+        Records that a line of an MSISDN has finished.
+
+        Args:
+            key (str): MSISDN of the line.
+        """
+        with self.lock:
+            count = self.inflight.get(key, 0) - 1
+            if count > 0:
+                self.inflight[key] = count
+            else:
+                self.inflight.pop(key, None)
+
+
+class CheckpointJournal(object):
+    """
+    Append-only journal of the input lines a bulk run has finished.
+
+    Each finished line is recorded as soon as its operation completes, with
+    its byte offset and length in the input, line number, outcome, MSISDN,
+    operation and result line. Records are written straight to the file so
+    they survive the process being killed, and synced to disk every
+    sync_lines records. A run that finishes marks the journal complete.
+
+    A resumed run reads the input again from the end of the lines finished
+    in a row and skips the few finished after it, so no finished line is
+    sent to the gateway twice. Failed lines do not count as finished and run
+    again, the adjustment ledger keeping what they applied from being sent
+    twice.
+
+    Args:
+        path (str): Journal file.
+        input_file (str): Input file of the run.
+        sync_lines (int): Records written between syncs to disk.
+    """
+
+    COMPLETE = b"#complete\n"
+
+    def __init__(self, path, input_file, sync_lines=1000):
+        self.path = path
+        self.input_file = input_file
+        self.sync_lines = max(sync_lines, 1)
+        self.header = ("#checkpoint\t%s\t%d\n" % (os.path.abspath(input_file), os.path.getsize(input_file))).encode('utf-8')
+        self.start = (0, 0)
+        self.done = set()
+        self.finished = self.failed = 0
+        self.read_all = False
+        self.fd = None
+        self.unsynced = 0
+        self.lock = threading.Lock()
+
+    def open(self, resume):
+        """
+        Opens the journal, loading the lines finished earlier when resuming.
+
+        Args:
+            resume (bool): Continue the run recorded in the journal.
+
+        Raises:
+            ValueError: If the journal is of another input, or of an unfinished
+                run that a fresh run would overwrite.
+        """
+        exists = os.path.exists(self.path)
+        if resume and exists:
+            self.load()
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            return
+        if exists and not resume and not self.complete():
+            raise ValueError("journal %s is of an unfinished run, run again with --resume or remove it" % self.path)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self.fd, self.header)
+
+    def complete(self):
+        """
+        Checks whether the journal is of a run that finished.
+
+        Returns:
+            bool: True when the journal ends with the completion mark.
+        """
+        with open(self.path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(file.tell() - len(self.COMPLETE), 0))
+            return file.read() == self.COMPLETE
+
+    def load(self):
+        """
+        Reads the lines finished by the earlier run.
+
+        Raises:
+            ValueError: If the journal is of another input file, or the input changed.
+        """
+        with open(self.path, 'rb') as file:
+            if file.readline() != self.header:
+                raise ValueError("journal %s does not match %s as it is now" % (self.path, self.input_file))
+            # Lines finish a little out of order; only those after a gap are kept
+            offset, line_no, ahead, failed = 0, 0, {}, set()
+            for record in file:
+                fields = record.split(b"\t", 4)
+                if len(fields) < 5 or not record.endswith(b"\n"):
+                    continue  # Completion mark, or a record torn by a crash
+                if fields[3] == b"failed":
+                    # Run again, unless a later resume finished it
+                    failed.add(int(fields[0]))
+                    continue
+                failed.discard(int(fields[0]))
+                self.finished += 1
+                ahead[int(fields[0])] = (int(fields[0]) + int(fields[1]), int(fields[2]) + 1)
+                while offset in ahead:
+                    offset, line_no = ahead.pop(offset)
+        self.start = (offset, line_no)
+        self.done = set(ahead)
+        self.failed = len(failed)
+
+    def record(self, where, msisdn, details, result):
+        """
+        Records a finished line.
+
+        Args:
+            where (tuple): Byte offset, byte length and line number of the line.
+            msisdn (str): MSISDN of the line.
+            details (str): The input line.
+            result (str): Result line written for it, None if there is none.
+        """
+        operation = " ".join(details.split()[1:])
+        outcome = "ok" if result else ("failed" if operation else "blank")
+        line = "%d\t%d\t%d\t%s\t%s\t%s\t%s\n" % (where[0], where[1], where[2], outcome, msisdn or "", operation,
+                                                  " ".join((result or "").split()))
+        line = line.encode('utf-8') if isinstance(line, type(u"")) else line
+        with self.lock:
+            os.write(self.fd, line)
+            self.unsynced += 1
+            if self.unsynced >= self.sync_lines:
+                os.fsync(self.fd)
+                self.unsynced = 0
+
+    def close(self, complete):
+        """
+        Syncs and closes the journal.
+
+        Args:
+            complete (bool): Mark the run as finished, provided the whole input was read.
+        """
+        with self.lock:
+            if complete and self.read_all:
+                os.write(self.fd, self.COMPLETE)
+            os.fsync(self.fd)
+            os.close(self.fd)
+
+
+def journal_path(logdirname, file_name):
+    """
+    Builds the path of the checkpoint journal of an input file.
+
+    Args:
+        logdirname (str): Directory for logging files.
+        file_name (str): Input file.
+
+    Returns:
+        str: Path of the journal, next to the output files.
+    """
+    return os.path.join(logdirname, 'checkpoint_' + os.path.basename(file_name) + '.journal')
+
+
+# Input formats by file extension, after any compression extension
+INPUT_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.json': 'jsonl', '.plan': 'plan'}
+
+# Column names of CSV headers and JSONL keys, by record field
+INPUT_COLUMNS = {'msisdn': 'msisdn', 'main': 'main', 'main_delta': 'main', 'bonus': 'bonus', 'bonus_delta': 'bonus',
+                 'bucket': 'bucket', 'bucket_id': 'bucket'}
+
+
+def open_input(file_name):
+    """
+    Opens an input file for reading as bytes, decompressing it when needed.
+
+    Args:
+        file_name (str): Input file, ending in .gz or .bz2 when compressed, - for stdin.
+
+    Returns:
+        file: The open input.
+    """
+    if file_name == '-':
+        return getattr(sys.stdin, 'buffer', sys.stdin)
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rb')
+    if file_name.endswith('.bz2'):
+        return bz2.BZ2File(file_name, 'rb')
+    return open(file_name, 'rb')
+
+
+def input_format(file_name, configured='auto'):
+    """
+    Works out the format of an input file.
+
+    Args:
+        file_name (str): Input file.
+        configured (str): Format set with input_format, auto to go by the file extension.
+
+    Returns:
+        str: text, csv, jsonl or plan.
+    """
+    if configured != 'auto':
+        return configured
+    root, extension = os.path.splitext(file_name)
+    if extension in ('.gz', '.bz2'):
+        extension = os.path.splitext(root)[1]
+    return INPUT_FORMATS.get(extension.lower(), 'text')
+
+
+def fields_details(msisdn, main, bonus, bucket):
+    """
+    Writes the fields of a CSV or JSONL row as an input line.
+
+    Args:
+        msisdn: MSISDN of the row.
+        main: Main balance amount, signed, + when unsigned; empty for none.
+        bonus: Bonus balance amount, as main.
+        bucket: Bucket to credit the bonus to, empty for none.
+
+    Returns:
+        str: The line, as it would be written in a text input file.
+    """
+    details = [str(msisdn or "").strip()]
+    for name, amount in (("main", main), ("bonus", bonus)):
+        amount = str(amount if amount is not None else "").strip()
+        if amount:
+            details.append(name + " " + (amount if amount[0] in "+-" else "+" + amount))
+    if bucket:
+        details.append(str(bucket).strip())
+    return " ".join(details) + "\n"
+
+
+class RecordReader(object):
+    """
+    Turns the rows of an input file into adjustment records.
+
+    Text lines are parsed as they are. CSV rows hold the msisdn, main, bonus
+    and bucket columns, in that order or as named by a header row; JSONL rows
+    are objects with those keys. Both are written as the equivalent text line,
+    so results, the journal and the operations see every format alike. Lines
+    of an execution plan, see PlanWriter, give their input line and the
+    subscriber state it was planned on.
+
+    Args:
+        input_format (str): text, csv, jsonl or plan.
+    """
+
+    def __init__(self, input_format):
+        self.input_format = input_format
+        self.columns = None
+
+    def __call__(self, text, line_no):
+        """
+        Parses one row.
+
+        Args:
+            text (str): The row.
+            line_no (int): Line number of the row, from 0.
+
+        Returns:
+            tuple: The input line and its AdjustmentRecord, None for blank and header rows;
+            None for the header and totals of a plan.
+        """
+        if not text.strip():
+            return text, None
+        details = text
+        try:
+            if self.input_format == 'plan':
+                entry = json.loads(text)
+                if 'line' not in entry:
+                    return None
+                details = entry['details']
+                if entry.get('state') is None:
+                    # Planned without a subscriber state, the run has nothing to go on either
+                    return details, AdjustmentRecord("", None, None, None, details)
+                return details, PlannedRecord(*parse_details(details) + (planned_state(entry['state']),))
+            if self.input_format == 'csv':
+                row = next(csv.reader([text]))
+                if self.columns is None and line_no == 0 and row and not row[0].strip().lstrip('+').isdigit():
+                    self.columns = [INPUT_COLUMNS.get(name.strip().lower()) for name in row]
+                    return "", None
+                names = self.columns or ['msisdn', 'main', 'bonus', 'bucket']
+                row = dict((name, value) for name, value in zip(names, row) if name)
+                details = fields_details(row.get('msisdn'), row.get('main'), row.get('bonus'), row.get('bucket'))
+            elif self.input_format == 'jsonl':
+                row = dict((INPUT_COLUMNS.get(key.lower()), value) for key, value in json.loads(text).items())
+                details = fields_details(row.get('msisdn'), row.get('main'), row.get('bonus'), row.get('bucket'))
+            return details, parse_details(details)
+        except Exception as e:
+            # The line is still handed on, so it is counted and journaled as failed
+            log_error("while reading line " + str(line_no + 1), e)
+            print("Error in read_records: {}".format(e))
+            return details, AdjustmentRecord("", None, None, None, details)
+
+
+def read_records(file_name, journal=None, input_format='text'):
+    """
+    Reads the input rows still to be run, as a stream in constant memory.
+
+    Args:
+        file_name (str): Input file, - for stdin.
+        journal (CheckpointJournal): Journal whose finished lines are skipped, None to read every line.
+        input_format (str): text, csv, jsonl or plan.
+
+    Yields:
+        tuple: The input line, its AdjustmentRecord (None for a blank or header
+        row) and its (byte offset, byte length, line number).
+    """
+    offset, line_no = journal.start if journal is not None else (0, 0)
+    done = journal.done if journal is not None else ()
+    parse = RecordReader(input_format)
+
+    def decode(raw):
+        return raw if isinstance(raw, str) else raw.decode('utf-8', 'replace')
+
+    with open_input(file_name) as file:
+        if offset:
+            # A CSV header still names the columns of the rows after it
+            parse(decode(file.readline()), 0)
+            file.seek(offset)
+        for raw in file:
+            if offset not in done:
+                parsed = parse(decode(raw), line_no)
+                if parsed is not None:
+                    yield parsed + ((offset, len(raw), line_no),)
+            offset += len(raw)
+            line_no += 1
+    if journal is not None:
+        journal.read_all = True
+
+
+def record_problem(record):
+    """
+    Checks an adjustment record before it is run.
+
+    Args:
+        record (AdjustmentRecord): Record read by read_records.
+
+    Returns:
+        str: Why the record cannot be run, None when it is fine.
+    """
+    if not record.msisdn:
+        return "line cannot be parsed"
+    if not VALID_MSISDN.match(record.msisdn):
+        return "invalid MSISDN " + record.msisdn
+    for name, amount in AMOUNT_FIELD.findall(FIELD_SEPARATORS.sub(" ", record.details)):
+        if not VALID_AMOUNT.match(amount):
+            return "malformed " + name.lower() + " amount " + repr(amount)
+    main, bonus = record.main_delta, record.bonus_delta
+    if not main and not bonus:
+        return "no amount to adjust"
+    if main and bonus and (main < 0) != (bonus < 0):
+        return "debit and credit in one line"
+    if bonus and bonus > 0 and record.bucket_id is None:
+        return "bonus credit without a bucket (MAA or MA4)"
+    return None
+
+
+def preflight_file(file_name, input_format, output_path, rejects_path, aggregate=False):
+    """
+    Validates an input file ahead of the run and writes the lines to run.
+
+    The file is streamed once. Malformed lines are written to the rejects file
+    with the reason, the others to the output as normalized text lines. When
+    aggregating, the lines of each MSISDN are merged, in an index keyed on the
+    MSISDN, into one net main and bonus adjustment written in the order the
+    MSISDN first appears; a net adjustment that debits one balance and
+    credits the other becomes two lines, and a bonus credit to another bucket
+    stays a line of its own.
+
+    Args:
+        file_name (str): Input file, - for stdin.
+        input_format (str): text, csv or jsonl.
+        output_path (str): Text file receiving the lines to run.
+        rejects_path (str): File receiving the rejected lines.
+        aggregate (bool): Merge the lines of each MSISDN.
+
+    Returns:
+        dict: Lines read, rejected and written, and the adjustments in and out.
+    """
+    counts = dict.fromkeys(('lines', 'rejected', 'written', 'adjustments', 'adjusted', 'netted'), 0)
+    index = collections.OrderedDict()
+    rejects = None
+    with open(output_path, 'w') as output:
+        try:
+            for details, record, where in read_records(file_name, input_format=input_format):
+                if record is None:
+                    continue
+                counts['lines'] += 1
+                problem = record_problem(record)
+                if problem is not None:
+                    if rejects is None:
+                        rejects = open(rejects_path, 'w')
+                    rejects.write("line %d: %s: %s\n" % (where[2] + 1, problem, details.strip()))
+                    counts['rejected'] += 1
+                    continue
+                main, bonus = record.main_delta or Amount(0), record.bonus_delta or Amount(0)
+                counts['adjustments'] += bool(main) + bool(bonus)
+                bucket = record.bucket_id if bonus > 0 else None
+                if not aggregate:
+                    output.write(fields_details(record.msisdn, main.signed(), bonus.signed(), bucket))
+                    counts['written'] += 1
+                    counts['adjusted'] += bool(main) + bool(bonus)
+                    continue
+                # Entries hold the net main and bonus and the bucket credited
+                entry = index.setdefault(record.msisdn, [Amount(0), Amount(0), None])
+                entry[0] += main
+                if bucket is not None and entry[2] not in (None, bucket):
+                    entry = index.setdefault((record.msisdn, bucket), [Amount(0), Amount(0), bucket])
+                entry[1] += bonus
+                entry[2] = entry[2] or bucket
+            for key, (main, bonus, bucket) in index.items():
+                msisdn = key[0] if isinstance(key, tuple) else key
+                if not main and not bonus:
+                    counts['netted'] += 1
+                    continue
+                mixed = main and bonus and (main < 0) != (bonus < 0)
+                parts = [(main, Amount(0)), (Amount(0), bonus)] if mixed else [(main, bonus)]
+                for main, bonus in parts:
+                    output.write(fields_details(msisdn, main.signed(), bonus.signed(),
+                                                bucket if bonus > 0 else None))
+                    counts['written'] += 1
+                    counts['adjusted'] += bool(main) + bool(bonus)
+        finally:
+            if rejects is not None:
+                rejects.close()
+    return counts
+
+
+def prepare_input(cf, file_name, logdirname, now, preflight=False, aggregate=False):
+    """
+    Runs the pre-flight pass over an input file when it is asked for.
+
+    Args:
+        cf (ConfigParser): Configuration parser object containing parameter details.
+        file_name (str): Input file, - for stdin.
+        logdirname (str): Directory for logging files.
+        now (datetime): Current date and time object.
+        preflight (bool): Validate the file first, as with the preflight option.
+        aggregate (bool): Merge the lines of each MSISDN, as with the aggregate option.
+
+    Returns:
+        str: The file to run: the pre-flight output, or file_name when there is no pre-flight pass.
+    """
+    enabled = ('1', 'yes', 'true', 'on')
+    aggregate = aggregate or get_option(cf, 'aggregate', 'no').lower() in enabled
+    if not (preflight or aggregate or get_option(cf, 'preflight', 'no').lower() in enabled):
+        return file_name
+    name = 'stdin' if file_name == '-' else os.path.basename(file_name)
+    # Named after the input alone, so a rerun or --resume finds the same checkpoint journal
+    output_path = os.path.join(logdirname, 'preflight_' + name + '.txt')
+    rejects_path = os.path.join(logdirname, now.strftime('rejects_' + name + '_%d%m%Y_%H%M.txt'))
+    started = time.time()
+    counts = preflight_file(file_name, input_format(file_name, get_option(cf, 'input_format', 'auto')),
+                            output_path, rejects_path, aggregate)
+    summary = ("Pre-flight of %s in %.1fs: %d lines, %d rejected%s, %d lines to run; saves %d lookups and up to %d submits"
+               % (file_name, time.time() - started, counts['lines'], counts['rejected'],
+                  " (see " + rejects_path + ")" if counts['rejected'] else "", counts['written'],
+                  counts['lines'] - counts['written'], counts['adjustments'] - counts['adjusted']))
+    if counts['netted']:
+        summary += ", %d subscribers netted to nothing" % counts['netted']
+    logging.info(summary)
+    print(summary)
+    # The pre-flight output is a text file, whatever the format of the input
+    cf.set('parameters', 'input_format', 'text')
+    return output_path
+
+
+def bulk_worker(jobs, results, session_id, current_date, envelopes, transport, prefetch, batcher, journal, ledger, cache,
+                policy):
+    """
+    Worker loop of the bulk engine, running the lines queued to it in order.
+
+    Args:
+        jobs (Queue.Queue): Lines to process as (sequence number, line, MSISDN, subscriber, position, record), None to stop.
+        results (Queue.Queue): Receives (sequence number, result line) for every job.
+        session_id (str): Session ID for authentication.
+        current_date (str): Current date and time.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        prefetch (SubscriberPrefetch): Batched lookups, or None when lookups are not batched.
+        batcher (SubmitBatcher): Batches the adjustments of the run.
+        journal (CheckpointJournal): Records each finished line, None for no checkpoints.
+        ledger (AdjustmentLedger): Skips the adjustments already applied, None to submit every one.
+        cache (SubscriberCache): Subscribers looked up by earlier lines, None to look each one up.
+        policy (str): How bonus debits pick their buckets, see BucketIndex.
+    """
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        seq, details, key, subscriber, where, record = job
+        try:
+            result = process_line(session_id, details, current_date, envelopes, transport, subscriber, batcher, ledger, where[2],
+                                  record, cache, policy)
+        except Exception as e:
+            log_error("while processing line " + str(where[2] + 1), e)
+            result = None
+        if journal is not None:
+            journal.record(where, key, details, result)
+        if prefetch is not None:
+            prefetch.done(key)
+        results.put((seq, result))
+
+
+def dispatch_lines(file_name, worker_queues, results, window, prefetch, journal=None, input_format='text', metrics=None):
+    """
+    Reads the input file and hands each line to the worker owning its MSISDN.
+
+    Lines of one MSISDN always go to the same worker, so they run in input order.
+
+    Args:
+        file_name (str): Input file.
+        worker_queues (list): Job queue of each worker.
+        results (Queue.Queue): Receives (None, line count) once the file is read.
+        window (threading.BoundedSemaphore): Bounds the lines read ahead of the writer.
+        prefetch (SubscriberPrefetch): Batched lookups, or None when lookups are not batched.
+        journal (CheckpointJournal): Journal of a resumed run, whose finished lines are skipped.
+        input_format (str): text, csv, jsonl or plan.
+        metrics (RunMetrics): Records the time taken to read and parse each line, None for no metrics.
+    """
+    seq = 0
+    batch = []
+    batch_size = prefetch.batch_size if prefetch is not None else 1
+
+    def dispatch(batch):
+        jobs = prefetch.jobs(batch) if prefetch is not None else [line[:3] + (None,) + line[3:] for line in batch]
+        for job in jobs:
+            worker_queues[hash(job[2]) % len(worker_queues)].put(job)
+
+    try:
+        started = time.time()
+        for details, record, where in read_records(file_name, journal, input_format):
+            if metrics is not None:
+                metrics.stage('parse', time.time() - started, record is None or bool(record.msisdn))
+            window.acquire()
+            batch.append((seq, details, record.msisdn if record is not None else "", where, record))
+            seq += 1
+            if len(batch) >= batch_size:
+                dispatch(batch)
+                batch = []
+            started = time.time()
+    except Exception as e:
+        log_error("while reading " + file_name, e)
+    finally:
+        if batch:
+            dispatch(batch)
+        for jobs in worker_queues:
+            jobs.put(None)
+        results.put((None, seq))
+
+
+def ledger_path(cf, logdirname):
+    """
+    Returns the adjustment ledger file of a run.
 
     Args:
-        a (list): List of filenames.
-        cf (ConfigParser.ConfigParser): Configuration parser object.
+        cf (ConfigParser): Configuration parser object containing parameter details.
+        logdirname (str): Directory for logging files.
 
     Returns:
-        tuple: A tuple containing essential session information.
+        str: The ledger_file option, by default a ledger in the log directory of the run.
     """
-    workdir = os.getcwd()  # Getting current working directory
-    if len(a) == 0:
-        logging.info("Error: Configuration file config.ini not found in current directory :%s" ,workdir)
-        sys.exit()    
+    return get_option(cf, 'ledger_file', os.path.join(logdirname, 'adjustment_ledger.sqlite'))
+
+
+def open_ledger(cf, logdirname, file_name):
+    """
+    Opens the adjustment ledger for an input file.
+
+    Args:
+        cf (ConfigParser): Configuration parser object containing parameter details.
+        logdirname (str): Directory for logging files.
+        file_name (str): Input file.
+
+    Returns:
+        AdjustmentLedger: The open ledger, None when it is turned off or the input is stdin.
+    """
+    path = ledger_path(cf, logdirname)
+    if path.lower() in ('no', 'off', 'none') or file_name == '-':
+        return None
+    return AdjustmentLedger(path, file_name,
+                            get_option(cf, 'ledger_resend_unknown', 'no').lower() in ('1', 'yes', 'true', 'on'))
+
+
+def open_journal(cf, logdirname, file_name, resume):
+    """
+    Opens the checkpoint journal of an input file.
+
+    Args:
+        cf (ConfigParser): Configuration parser object containing parameter details.
+        logdirname (str): Directory for logging files.
+        file_name (str): Input file.
+        resume (bool): Continue the run recorded in the journal.
+
+    Returns:
+        CheckpointJournal: The open journal, None when checkpoints are turned off or the input is stdin.
+
+    Raises:
+        ValueError: If the journal cannot be used for this run.
+    """
+    if get_option(cf, 'checkpoint', 'yes').lower() in ('0', 'no', 'false', 'off') or file_name == '-':
+        if resume:
+            raise ValueError("--resume needs a checkpoint journal, which stdin and checkpoint = no runs do not keep")
+        return None
+    journal = CheckpointJournal(journal_path(logdirname, file_name), file_name,
+                                get_option(cf, 'checkpoint_sync_lines', 1000, int))
+    journal.open(resume)
+    if resume:
+        message = ("Resuming %s from line %d: %d lines finished earlier, %d failed lines run again (see %s)"
+                   % (file_name, journal.start[1] + 1, journal.finished, journal.failed, journal.path))
+        logging.info(message)
+        print(message)
+    return journal
+
+
+def process_bulk_file(session_id, file_name, current_date, cf, envelopes, transport, logdirname, now, workers, resume=False,
+                      quiet=False, writer=None):
+    """
+    Processes an input file through a pool of workers.
+
+    Results are written to the output file in input order, and each finished
+    line to the checkpoint journal of the file. Adjustments the ledger holds as
+    applied by an earlier run of the file are not sent again. An execution
+    plan, input_format plan, is run on the subscriber states it holds.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        file_name (str): Input file.
+        current_date (str): Current date and time.
+        cf (ConfigParser): Configuration parser object containing parameter details.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        logdirname (str): Directory for logging files.
+        now (datetime): Current date and time object.
+        workers (int): Number of worker threads.
+        resume (bool): Skip the lines the checkpoint journal records as finished.
+        quiet (bool): Do not print each result line.
+        writer (ResultWriter): Sink for the results, None for the configured results file.
+
+    Returns:
+        int: Number of lines processed.
+    """
+    import sqlite3  # For the ledger errors
+    started = time.time()
+
+    ledger = None
     try:
-        soap_url = cf.get('parameters', 'soap_url').split(',')
-        url_info = cf.get('parameters', 'eSM_url').split(',')  # Default url for the SOAP service
-        url = "http://{}:{}/{}".format(url_info[0], url_info[1], url_info[2])
-        header = cf.get('parameters', 'header').split(',')
-        headers = {header[0]: "; ".join(header[1:])}  # headers for the HTTP request
-        # Open session to retrieve the session ID        
-        session_id = get_session_id(cf, url, headers, soap_url)
-        return soap_url, url, headers, session_id
-        
-    except Exception as e:
-        logging.info("TIME: " + str(time.strftime("%H:%M:%S", time.localtime(time.time()))) +
-                     " Error occurred at session_login " + str(e))
-        sys.exit() 
+        policy = bonus_debit_policy(cf)
+        file_format = input_format(file_name, get_option(cf, 'input_format', 'auto'))
+        planned = file_format == 'plan'
+        if planned:
+            # A plan runs on the date and policy its decisions were made with
+            header = read_plan_header(file_name)
+            current_date, policy = header['current_date'], header['policy']
+        if writer is None:
+            writer = result_writer(cf, logdirname, now, file_name, quiet)
+        ledger = open_ledger(cf, logdirname, file_name)
+        journal = open_journal(cf, logdirname, file_name, resume)
+    except (ValueError, IOError, OSError, sqlite3.Error) as e:
+        if ledger is not None:
+            ledger.close()
+        log_error("while setting up the bulk run", e)
+        print("Error in process_bulk_file: {}".format(e))
+        return 0
 
-		
+    # Subscribers are looked up ahead of the workers when lookups are batched; plans need no lookups
+    lookup_batch = get_option(cf, 'lookup_batch_size', 1, int)
+    prefetch = SubscriberPrefetch(session_id, envelopes, transport, lookup_batch) if lookup_batch > 1 and not planned else None
+
+    # Adjustments from all workers are grouped into batched SubmitRequests; a
+    # worker waits on its adjustment, so a batch never holds more than workers
+    batcher = SubmitBatcher(session_id, envelopes, transport, min(get_option(cf, 'submit_batch_size', 1, int), workers),
+                            get_option(cf, 'submit_linger_ms', 20, int) / 1000.0)
+
+    # Later lines of a subscriber take its state from the cache, or from the plan
+    cache = subscriber_cache(cf) if not planned else None
+
+    results = Queue.Queue()
+    window = threading.BoundedSemaphore(max(workers * get_option(cf, 'bulk_window', 50, int), 2 * lookup_batch))
+    worker_queues = [Queue.Queue() for _ in range(workers)]
+    # Workers spread over the sessions of the pool, when there are several
+    session_ids = transport.sessions.ids if transport.sessions is not None else [session_id]
+    threads = [threading.Thread(target=bulk_worker, args=(jobs, results, session_ids[i % len(session_ids)], current_date,
+                                                          envelopes, transport, prefetch, batcher, journal, ledger, cache,
+                                                          policy))
+               for i, jobs in enumerate(worker_queues)]
+    metrics = transport.metrics
+    threads.append(threading.Thread(target=dispatch_lines, args=(file_name, worker_queues, results, window, prefetch, journal,
+                                                                 file_format, metrics)))
+    if metrics is not None:
+        metrics.start()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Write the results back in input order as they complete
+    pending = {}
+    next_seq, total = 0, None
+    try:
+        while total is None or next_seq < total:
+            seq, result = results.get()
+            if seq is None:
+                total = result
+                continue
+            pending[seq] = result
+            while next_seq in pending:
+                written = time.time()
+                writer.write(pending.pop(next_seq))
+                if metrics is not None:
+                    metrics.stage('write', time.time() - written)
+                window.release()
+                next_seq += 1
+    finally:
+        writer.close()
+        if metrics is not None:
+            metrics.stop()
+        if journal is not None:
+            journal.close(complete=total is not None and next_seq >= total)
+        if ledger is not None:
+            ledger.close()
+
+    elapsed = time.time() - started
+    summary = ("Processed %d lines with %d workers in %.1fs (%.1f lines/sec), %d adjustments in %d submits (%.1f adjustments/sec)"
+               % (next_seq, workers, elapsed, next_seq / elapsed if elapsed else 0.0, batcher.adjustments,
+                  batcher.submits, batcher.adjustments / elapsed if elapsed else 0.0))
+    logging.info(summary)
+    print(summary)
+    writer.report()
+    if metrics is not None:
+        metrics.report()
+    if ledger is not None:
+        ledger.report()
+    if cache is not None:
+        cache.report()
+    if prefetch is not None:
+        logging.info("Prefetched %d subscribers in %d batched lookups of up to %d",
+                     prefetch.prefetched, prefetch.lookups, lookup_batch)
+    return next_seq
+
+
+# Version of the execution plan files written by PlanWriter
+PLAN_VERSION = 1
 
-def get_session_id(cf, url, headers, soap_url):
+
+def plan_state(subscriber):
     """
-    Retrieves the session ID after successful login.
+    Writes the state of a subscriber as the state field of a plan entry.
 
     Args:
-        cf (ConfigParser.ConfigParser): Configuration parser object.
-        url (str): URL for the SOAP service.
-        headers (dict): HTTP headers for the request.
-        soap_url (list): List containing SOAP URLs.
+        subscriber (SubscriberState): The state.
 
     Returns:
-        str: The session ID.
+        list: MSISDN, status, account state, main balance in 1/10000 NGN units (None when not
+        on IN), bonus status and [bundle ID, state, end date, COSP ID, bucket ID, counter] of each bonus bucket.
     """
-    key = cf.get('parameters', 'key')  # Getting the key from configuration
-    print(key)  # Printing the key
-    soap_username = cf.get('parameters', 'Soap_username')  # Getting the SOAP username
-    logging.info('Logged in using :%s', soap_username)  # Logging the login username
-    
-    soap_password = cf.get('parameters', 'Soap_password')  # Getting the SOAP password
-    session_id_request = """
-    <soapenv:Envelope xmlns:soapenv=\"{soap_url[0]}\" xmlns:v2=\"{soap_url[1]}\">
-       <soapenv:Header/>
-       <soapenv:Body>
-          <v2:LoginRequest>
-             <v2:loginId>{soap_username}</v2:loginId>
-             <v2:passwd>{soap_password}</v2:passwd>
-             <v2:wsdlVersion>V_1</v2:wsdlVersion>
-          </v2:LoginRequest>
-       </soapenv:Body>
-    </soapenv:Envelope>
+    return [subscriber.msisdn, subscriber.status, subscriber.state,
+            None if subscriber.balance is None else int(subscriber.balance), subscriber.bonus_status,
+            [[bucket.bundle_id, bucket.state, bucket.end_date, bucket.cosp_id, bucket.bucket_id, int(bucket.counter)]
+             for bucket in subscriber.buckets]]
+
+
+def planned_state(row):
     """
-    session_id_request = session_id_request.format(soap_username=soap_username, soap_password=soap_password, soap_url=soap_url)
-    response = requests.request("POST", url, headers=headers, data=session_id_request)  # Making a POST request
-    root = ET.fromstring(response.text)  # Parsing the XML response
-    session_id = root.find(".//{" + soap_url[1] + "}sessionId").text  # Extracting the session ID
-    return session_id  # Returning the session ID
+    Reads the state field of a plan entry.
+
+    Args:
+        row (list): The state as written by plan_state.
 
-def close_session(session_id, url, headers, soap_url):
+    Returns:
+        SubscriberState: The state.
     """
-    Closes the session.
+    msisdn, status, state, balance, bonus_status, buckets = row
+    return SubscriberState(msisdn, status, state, None if balance is None else Amount(balance), bonus_status,
+                           tuple(BundleBucket(*(bucket[:5] + [Amount(bucket[5])])) for bucket in buckets))
+
+
+def simulate_steps(steps, subscriber):
+    """
+    Runs an operation generator without the gateway, as if each adjustment it yields succeeded.
 
     Args:
-        session_id (str): The session ID.
-        url (str): URL for the SOAP service.
-        headers (dict): HTTP headers for the request.
-        soap_url (list): List containing SOAP URLs.
+        steps: Generator from line_steps, or the result line it returned.
+        subscriber (SubscriberState): The state the operation runs on.
+
+    Returns:
+        tuple: The expected result line (None when the operation failed or holds nothing to
+        run), the (adjustment tuple, result) of each adjustment and the state they leave.
     """
-    logout_request = """
-    <soapenv:Envelope xmlns:soapenv=\"{soap_url[0]}\" xmlns:v2=\"{soap_url[1]}\">
-       <soapenv:Header/>
-       <soapenv:Body>
-          <v2:LogoutRequest>
-             <v2:SessionInfo>
-                <v2:sessionId>{session_id}</v2:sessionId>
-             </v2:SessionInfo>
-          </v2:LogoutRequest>
-       </soapenv:Body>
-    </soapenv:Envelope>
+    if not hasattr(steps, 'send'):
+        return steps, [], subscriber
+    applied = []
+    try:
+        step = next(steps)
+        while isinstance(step, tuple):
+            if step[0] == 'balance':
+                amount = Amount.parse(step[2])
+                subscriber = subscriber.with_balance(subscriber.balance + (amount if step[3] == 'INCR' else -amount))
+                result = ('SUCCESS', str(int(subscriber.balance)))
+            else:
+                amount = Amount(step[2]) if step[4] == 'INCR' else -Amount(step[2])
+                # A credit to a bucket the subscriber does not hold yet leaves the known buckets as they are
+                subscriber = subscriber.with_bucket_counter(step[3], amount) or subscriber
+                result = 'SUCCESS'
+            applied.append((step, result))
+            step = steps.send(result)
+        return step, applied, subscriber
+    except StopIteration:
+        # The operation logged its own error
+        return None, applied, subscriber
+
+
+class PlanWriter(object):
+    """
+    Writes the execution plan of an input file, deciding every line without adjusting any balance.
+
+    Each line is decided on the state of its subscriber as looked up, or as
+    the earlier lines of the subscriber leave it when their adjustments
+    succeed. The plan is a JSON lines file: a header naming the input, the
+    run date and the bonus debit policy; an entry per input line with its line
+    number, the line, the subscriber state and either the adjustments to send
+    and the result expected of them, or the result the line is skipped with,
+    or the error that left it without a plan; and the totals.
+
+    Args:
+        path (str): Plan file.
+        input_file (str): Input file planned.
+        current_date (str): Date the lines are decided on.
+        policy (str): How bonus debits pick their buckets, see BucketIndex.
+        remaining (collections.Counter): Lines of each MSISDN in the input, so the state of a
+            subscriber is dropped after its last line; None to keep every state.
     """
-    response = requests.request("POST", url, data=logout_request.format(session_id=session_id, soap_url=soap_url), headers=headers)  # Making a POST request to logout
 
+    TOTALS = ('lines', 'adjust', 'skip', 'error', 'adjustments')
 
+    def __init__(self, path, input_file, current_date, policy='earliest', remaining=None):
+        self.path = path
+        self.input_file = input_file
+        self.current_date = current_date
+        self.policy = policy
+        self.remaining = remaining
+        self.states = {}
+        self.counts = dict.fromkeys(self.TOTALS, 0)
+        self.debited = self.credited = Amount(0)
+        self.file = None
 
+    def open(self):
+        self.file = open(self.path, 'w', 1 << 16)
+        self.file.write(json.dumps({'plan': PLAN_VERSION, 'input': self.input_file, 'current_date': self.current_date,
+                                    'policy': self.policy}, sort_keys=True) + '\n')
 
-	
-def get_sub_info(session_id, cf, msisdn, url, headers, soap_url):
+    def known(self, msisdn):
+        """
+        Tells whether the state of a subscriber comes from its earlier lines.
+
+        Args:
+            msisdn (str): MSISDN of the line.
+
+        Returns:
+            bool: True when no lookup is needed.
+        """
+        return msisdn in self.states
+
+    def add(self, details, record, where, subscriber=None):
+        """
+        Decides one input line and writes its entry.
+
+        Args:
+            details (str): The input line.
+            record (AdjustmentRecord): The line as parsed by read_records.
+            where (tuple): Byte offset, byte length and line number of the line.
+            subscriber (SubscriberState): The state looked up, None when the state is known or the lookup failed.
+        """
+        msisdn = record.msisdn
+        entry = collections.OrderedDict((('line', where[2] + 1), ('details', details.rstrip('\r\n'))))
+        subscriber = self.states.get(msisdn, subscriber) if msisdn else None
+        if subscriber is None:
+            entry['error'] = "line cannot be parsed" if not msisdn else "subscriber lookup failed"
+        else:
+            entry['state'] = plan_state(subscriber)
+            args = parse_argument(None, None, None, details, subscriber, record)
+            text, applied = None, []
+            if args is not None:
+                text, applied, self.states[msisdn] = simulate_steps(
+                    line_steps(args.msisdn, details, self.current_date, args, self.policy), subscriber)
+            result = line_result(text, applied)
+            if result is None:
+                entry['error'] = "no operation to run"
+            elif applied:
+                entry['adjustments'] = [[int(field) if isinstance(field, Amount) else field for field in step]
+                                        for step, status in applied]
+                entry['expected'] = str(result)
+                for name, amount in (('debit', result.debited), ('credit', result.credited)):
+                    if amount:
+                        entry[name] = amount.ngn()
+                self.counts['adjustments'] += len(applied)
+                self.debited += result.debited
+                self.credited += result.credited
+            else:
+                entry['skip'] = str(result)
+        self.counts['lines'] += 1
+        self.counts['error' if 'error' in entry else 'adjust' if 'adjustments' in entry else 'skip'] += 1
+        if self.remaining is not None and msisdn:
+            self.remaining[msisdn] -= 1
+            if self.remaining[msisdn] <= 0:
+                del self.remaining[msisdn]
+                self.states.pop(msisdn, None)
+        if self.file is None:
+            self.open()
+        self.file.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        """
+        Writes the totals and closes the plan.
+        """
+        if self.file is None:
+            self.open()
+        totals = dict(self.counts, debit=self.debited.ngn(), credit=self.credited.ngn())
+        self.file.write(json.dumps({'totals': totals}, sort_keys=True) + '\n')
+        self.file.close()
+        self.file = None
+
+    def summary(self):
+        """
+        Builds the summary of the plan.
+
+        Returns:
+            str: The summary.
+        """
+        counts = self.counts
+        return ("Planned %d lines: %d to adjust with %d adjustments, %d skipped, %d without a plan; "
+                "debits NGN%s, credits NGN%s; plan in %s"
+                % (counts['lines'], counts['adjust'], counts['adjustments'], counts['skip'], counts['error'],
+                   self.debited.ngn(), self.credited.ngn(), self.path))
+
+
+def read_plan_header(file_name):
     """
-    Get subscriber information using SOAP request.
+    Reads the header of an execution plan.
 
     Args:
-        session_id (str): Session ID for authentication.
-        cf (ConfigParser): Configuration parser object containing parameter details.
-        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
-        url (str): URL to send the SOAP request.
-        headers (dict): HTTP headers for the request.
-        soap_url (list): List containing SOAP URL information.
+        file_name (str): Plan file.
 
     Returns:
-        tuple: A tuple containing main_status, result, bonus_status, result1, and result2.
+        dict: The header, with the input, current_date and policy the plan was made with.
 
     Raises:
-        Exception: If an error occurs during the process.
+        ValueError: If the file is not a plan this version can run.
+    """
+    with open(file_name) as file:
+        line = file.readline()
+    try:
+        header = json.loads(line)
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or 'plan' not in header:
+        raise ValueError("%s is not an execution plan" % file_name)
+    if header['plan'] != PLAN_VERSION:
+        raise ValueError("%s is a plan of version %s, not %d" % (file_name, header['plan'], PLAN_VERSION))
+    return header
+
 
+def lookup_subscribers(session_ids, envelopes, transport, msisdns, batch_size):
     """
+    Looks subscribers up in batched RetrieveRequests, a thread per session id.
 
-    try:
-        # Retrieve XML names for account and bundle queries
-        sub_xml_names = cf.get('parameters', 'acct_query_names').split(',')
-        bid_xml_names = cf.get('parameters', 'bundle_query_names').split(',')
-
-        # SOAP request template
-        retrieve_request = """
-        <soap-env:Envelope xmlns:soap-env="{soap_url[0]}">
-            <soap-env:Body>
-                <ns0:RetrieveRequest xmlns:ns0="{soap_url[1]}">
-                    <ns0:SessionInfo>
-                        <ns0:sessionId>{session_id}</ns0:sessionId>
-                    </ns0:SessionInfo>
-                    <ns0:RequestInfo>
-                        <ns0:ReqID></ns0:ReqID>
-                    </ns0:RequestInfo>
-                    <ns0:TaskList>
-                        <ns0:Task>
-                            <ns0:Name>{sub_xml_names[0]}</ns0:Name>
-                            <ns0:QueryCriteria>
-                                <ns0:Param>
-                                    <ns0:Name>{sub_xml_names[1]}</ns0:Name>
-                                    <ns0:Value>{msisdn}</ns0:Value>
-                                </ns0:Param>
-                            </ns0:QueryCriteria>
-                            <ns0:QueryData>
-                                <ns0:Collection>
-                                    <ns0:CollectionName>{sub_xml_names[2]}</ns0:CollectionName>
-                                    <ns0:Attributes>
-                                        <ns0:item>{sub_xml_names[1]}</ns0:item>
-                                        <ns0:item>{sub_xml_names[3]}</ns0:item>
-                                        <ns0:item>{sub_xml_names[4]}</ns0:item>
-                                        <ns0:item>{sub_xml_names[5]}</ns0:item>
-                                        <ns0:item>{sub_xml_names[6]}</ns0:item>
-                                        <ns0:item>{sub_xml_names[7]}</ns0:item>
-                                        <ns0:item>{sub_xml_names[8]}</ns0:item>
-                                    </ns0:Attributes>
-                                </ns0:Collection>
-                            </ns0:QueryData>
-                        </ns0:Task>
-                        <ns0:Task>
-                            <ns0:Name>{bid_xml_names[0]}</ns0:Name>
-                            <ns0:QueryCriteria>
-                                <ns0:Param>
-                                    <ns0:Name>{bid_xml_names[1]}</ns0:Name>
-                                    <ns0:Value>{msisdn}</ns0:Value>
-                                </ns0:Param>
-                            </ns0:QueryCriteria>
-                            <ns0:QueryData>
-                                <ns0:Collection>
-                                    <ns0:CollectionName>{bid_xml_names[2]}</ns0:CollectionName>
-                                    <ns0:Attributes>
-                                        <ns0:item>{bid_xml_names[3]}</ns0:item>
-                                        <ns0:item>{bid_xml_names[4]}</ns0:item>
-                                        <ns0:item>{bid_xml_names[5]}</ns0:item>
-                                        <ns0:item>{bid_xml_names[6]}</ns0:item>
-                                        <ns0:item>{bid_xml_names[7]}</ns0:item>
-                                        <ns0:item>{bid_xml_names[8]}</ns0:item>
-                                    </ns0:Attributes>
-                                </ns0:Collection>
-                            </ns0:QueryData>
-                        </ns0:Task>
-                    </ns0:TaskList>
-                </ns0:RetrieveRequest>
-            </soap-env:Body>
-        </soap-env:Envelope>
-        """  
-
-        # Populate the SOAP request template with data
-        retrieve_request = retrieve_request.format(
-            session_id=session_id,
-            msisdn=msisdn,
-            soap_url=soap_url,
-            sub_xml_names=sub_xml_names,
-            bid_xml_names=bid_xml_names    
-        )
+    Args:
+        session_ids (list): Session of each lookup thread.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        msisdns (list): Distinct MSISDNs to look up.
+        batch_size (int): Subscribers per RetrieveRequest.
 
-        # Send the SOAP request to get bucket information
-        response = requests.request("POST", url, data=retrieve_request, headers=headers)
-       
-        # Parse the response XML
-        root1 = ET.fromstring(response.text)
-
-        # Extract relevant information from the XML response
-        xml_data = response.text
-        pattern = r"<Name>(.*?)</Name>.*?<[V|R].*?>(.*?)</[V|R].*?>"
-        pattern_err = r"<ErrorCode>(.*?)</ErrorCode>.*?<ErrorMsg>(.*?),/ErrorMsg>"
-        matches = re.findall(pattern, xml_data, re.DOTALL)
-        find_err = [(key.encode('utf-8'), value.encode('utf-8')) for key, value in re.findall(pattern, xml_data, re.DOTALL)]
-        match_list = [(key.encode('utf-8'), value.encode('utf-8')) for key, value in matches]
-        
-        # Extract main and bonus status
-        result = [value[1] if match_list[0][1] == 'SUCCESS' else msisdn for value in match_list[1:8]]
-        match_str = " ".join([" ".join([match[0], match[1]]) for match in match_list[9:]])
-        main_status = match_list[0][1] if match_list[0][1] else 'FAILURE'
-        bonus_status = match_list[8][1] if main_status == 'SUCCESS' else 'FAILURE'
-
-        # Extract detailed information
-        pattern1 = r'Bundle\sID\s(bdl\w+|\d+_\w\w|\d\d{1})\sBundle\sState\s(\S*)\sEnd\sDate\sTime\s(\S*)\sTariff\sPlan\sCOSP\sID\s(\S*)\sBucket/Discount\sID\s1\s(\S*)\sBucket/UBD\sCounter\s1\s(\S*)'
-        pattern2 = r'Bundle\sID\s(sbcALWAYSON)\sBundle\sState\s(\S*)\sEnd\sDate\sTime\s(\S*)\sTariff\sPlan\sCOSP\sID\s(\S*)\sBucket/Discount\sID\s1\s(\S*)\sBucket/UBD\sCounter\s1\s(\S*)'
-        result1 = re.findall(pattern1, match_str)
-        result2 = re.findall(pattern2, match_str)
-        
-        # Return the collected information
-        return main_status, result, bonus_status, result1, result2
+    Returns:
+        dict: SubscriberState of each MSISDN found, those whose lookup failed left out.
+    """
+    batches = [msisdns[i:i + batch_size] for i in range(0, len(msisdns), batch_size)]
+    found = {}
 
-    except Exception as e:
-        # Log and print any errors that occur
-        logging.info("TIME: " + str(time.strftime("%H:%M:%S", time.localtime(time.time()))) +
-                     " Error occurred while getting sub information" + str(e))
-        print("Error in get_sub_info: {}".format(e)) 
-		
-		
-		
+    def lookup(session_id, batches):
+        for batch in batches:
+            found.update(get_sub_info_batch(session_id, envelopes, batch, transport))
+
+    threads = [threading.Thread(target=lookup, args=(session_id, batches[i::len(session_ids)]))
+               for i, session_id in enumerate(session_ids[:len(batches)])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return found
 
 
-def balance_adjustment(session_id, msisdn, amount, adjust_method, cf, url, headers, soap_url):
+def plan_bulk_file(session_id, file_name, current_date, cf, envelopes, transport, logdirname, now, workers):
     """
-    Adjusts the balance of a subscriber.
+    Writes the execution plan of an input file, looking its subscribers up but adjusting no balance.
+
+    Lines are read in chunks; the subscribers of a chunk not decided on by
+    an earlier line are looked up lookup_batch_size at a time, by workers
+    threads at once, and the lines are then decided in input order. The plan
+    is run with --execute, see process_bulk_file.
 
     Args:
         session_id (str): Session ID for authentication.
-        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
-        amount (float): Amount to adjust the balance.
-        adjust_method (str): Method to adjust the balance.
+        file_name (str): Input file, - for stdin.
+        current_date (str): Current date and time.
         cf (ConfigParser): Configuration parser object containing parameter details.
-        url (str): URL to send the SOAP request.
-        headers (dict): HTTP headers for the request.
-        soap_url (list): List containing SOAP URL information.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        logdirname (str): Directory for logging files.
+        now (datetime): Current date and time object.
+        workers (int): Number of lookup threads.
 
     Returns:
-        tuple: A tuple containing adj_status (adjustment status) and balance after adjustment.
+        str: The plan file, None on error.
+    """
+    started = time.time()
+    name = 'stdin' if file_name == '-' else os.path.basename(file_name)
+    path = os.path.join(logdirname, now.strftime('plan_' + name + '_%d%m%Y_%H%M.plan'))
+    try:
+        policy = bonus_debit_policy(cf)
+        file_format = input_format(file_name, get_option(cf, 'input_format', 'auto'))
+        if file_format == 'plan':
+            raise ValueError("%s is already an execution plan, run it with --execute" % file_name)
+        # Counting the lines of each MSISDN first lets the plan forget a subscriber after its last line
+        remaining = None
+        if file_name != '-':
+            remaining = collections.Counter(record.msisdn for details, record, where
+                                            in read_records(file_name, input_format=file_format)
+                                            if record is not None and record.msisdn)
+        plan = PlanWriter(path, os.path.abspath(file_name) if file_name != '-' else file_name, current_date, policy,
+                          remaining)
+    except (ValueError, IOError, OSError) as e:
+        log_error("while setting up the plan", e)
+        print("Error in plan_bulk_file: {}".format(e))
+        return None
 
-    Raises:
-        Exception: If an error occurs during the process.
+    batch_size = max(get_option(cf, 'lookup_batch_size', 100, int), 1)
+    session_ids = transport.sessions.ids if transport.sessions is not None else [session_id]
+    session_ids = [session_ids[i % len(session_ids)] for i in range(max(workers, 1))]
+    metrics = transport.metrics
+    if metrics is not None:
+        metrics.start()
+
+    def decide(chunk):
+        wanted, seen = [], set()
+        for details, record, where in chunk:
+            if record.msisdn and not plan.known(record.msisdn) and record.msisdn not in seen:
+                wanted.append(record.msisdn)
+                seen.add(record.msisdn)
+        found = lookup_subscribers(session_ids, envelopes, transport, wanted, batch_size) if wanted else {}
+        for details, record, where in chunk:
+            plan.add(details, record, where, found.get(record.msisdn))
+
+    chunk = []
+    try:
+        for details, record, where in read_records(file_name, input_format=file_format):
+            if record is None:
+                continue
+            chunk.append((details, record, where))
+            if len(chunk) >= batch_size * len(session_ids):
+                decide(chunk)
+                chunk = []
+        decide(chunk)
+    except (ValueError, IOError, OSError) as e:
+        log_error("while planning " + file_name, e)
+        print("Error in plan_bulk_file: {}".format(e))
+        path = None
+    finally:
+        plan.close()
+        if metrics is not None:
+            metrics.stop()
+
+    summary = "%s (%.1fs)" % (plan.summary(), time.time() - started)
+    logging.info(summary)
+    print(summary)
+    if metrics is not None:
+        metrics.report()
+    return path
+
+
+# Byte of the shard order file for input lines run in no shard (blank, header or unreadable)
+NO_SHARD = 255
+
+
+class ShardResultWriter(ResultWriter):
+    """
+    Results of one shard of a sharded run, kept for merge_shards.
+
+    Writes one JSON line for every line of the shard, null for lines without
+    a result, so the merge can put the results back in input order.
+
+    Args:
+        path (str): Results file of the shard, replaced by each run of the shard.
+    """
+
+    def __init__(self, path):
+        ResultWriter.__init__(self, path, 'jsonl', quiet=True)
+
+    def open(self):
+        self.file = open(self.path, 'w', 1 << 16)
+
+    def write(self, result):
+        result = self.count(result)
+        if self.file is None:
+            self.open()
+        entry = None if result is None else [str(result), result.outcome, int(result.debited), int(result.credited)]
+        self.file.write(json.dumps(entry) + '\n')
+        self.flush_due()
+
+
+def shard_of(msisdn, shards):
+    """
+    Picks the shard of an MSISDN, the same in every process and on every host.
+
+    Args:
+        msisdn (str): Normalized MSISDN.
+        shards (int): Number of shards.
+
+    Returns:
+        int: The shard, from 0.
+    """
+    return (zlib.crc32(msisdn.encode('utf-8')) & 0xffffffff) % shards
 
+
+def shard_paths(shard_dir, shards):
+    """
+    Returns:
+        list: Input file of each shard in a shard directory.
+    """
+    return [os.path.join(shard_dir, 'shard_%02d.txt' % k) for k in range(shards)]
+
+
+def split_shards(file_name, shards, shard_dir, input_format='text'):
     """
+    Splits an input file into shards by MSISDN, so all lines of a subscriber are in one shard.
+
+    Writes the shard input files as text lines, an order file holding the
+    shard of every input line, one byte each, and a manifest naming the input
+    file, all into shard_dir.
+
+    Args:
+        file_name (str): Input file.
+        shards (int): Number of shards, at most 254.
+        shard_dir (str): Directory for the shard files, created if missing.
+        input_format (str): text, csv or jsonl.
 
+    Returns:
+        list: Number of lines in each shard.
+    """
+    if not 1 < shards < NO_SHARD:
+        raise ValueError("shards must be between 2 and %d, not %d" % (NO_SHARD - 1, shards))
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    files = [open(path, 'w') for path in shard_paths(shard_dir, shards)]
+    counts = [0] * shards
     try:
-        # Retrieve XML names for balance adjustment
-        bal_xml_names = cf.get('parameters', 'main_adj_names').split(',')
-
-        # SOAP request template for balance adjustment
-        submit_request = """
-        <S:Envelope
-                xmlns:S="{soap_url[0]}">
-                <S:Body>
-                        <SubmitRequest
-                                xmlns="{soap_url[1]}">
-                                <SessionInfo>
-                                        <sessionId>{session_id}</sessionId>
-                                </SessionInfo>
-                                <RequestInfo>
-                                        <ReqID></ReqID>
-                                </RequestInfo>
-                                <TaskList>
-                                        <Task>
-                                                <Name>{bal_xml_names[0]}</Name>
-                                                <ParamList>
-                                                        <Param>
-                                                                <Name>{bal_xml_names[1]}</Name>
-                                                                <!-- Required -->
-                                                                <Value>{msisdn}</Value>
-                                                        </Param>
-                                                        <Param>
-                                                                <Name>{bal_xml_names[2]}</Name>
-                                                                <Value>{adjust_method}</Value>
-                                                        </Param>
-                                                        <Param>
-                                                                <Name>{bal_xml_names[3]}</Name>
-                                                                <Value>N</Value>
-                                                        </Param>
-                                                        <Param>
-                                                                <Name>{bal_xml_names[4]}</Name>
-                                                                <Value>N</Value>
-                                                        </Param>
-                                                        <Param>
-                                                                <Name>{bal_xml_names[5]}</Name>
-                                                                <Value>{amount}</Value>
-                                                        </Param>
-                                                 </ParamList>
-                                                <ContinueOnFailure>True</ContinueOnFailure>
-                                        </Task>
-                                </TaskList>
-                        </SubmitRequest>
-                </S:Body>
-        </S:Envelope>
-        """
-        
-        # Populate the SOAP request template with data
-        submit_request = submit_request.format(
-                        session_id = session_id, 
-                        msisdn = msisdn, 
-                        amount = amount, 
-                        adjust_method = adjust_method, 
-                        soap_url = soap_url,
-                        bal_xml_names = bal_xml_names
-        )
+        with open(os.path.join(shard_dir, 'order'), 'wb') as order:
+            pending = bytearray()
+            for details, record, where in read_records(file_name, None, input_format):
+                if record is None or not record.msisdn:
+                    pending.append(NO_SHARD)
+                else:
+                    k = shard_of(record.msisdn, shards)
+                    files[k].write(details.rstrip('\r\n') + '\n')
+                    counts[k] += 1
+                    pending.append(k)
+                if len(pending) >= 65536:
+                    order.write(bytes(pending))
+                    del pending[:]
+            order.write(bytes(pending))
+    finally:
+        for file in files:
+            file.close()
+    with open(os.path.join(shard_dir, 'manifest.json'), 'w') as file:
+        json.dump({'input': file_name if file_name == '-' else os.path.abspath(file_name), 'shards': shards,
+                   'lines': counts}, file)
+    return counts
 
-        # Send the SOAP request to increase the balance
-        response = requests.request("POST", url, data=submit_request, headers=headers)
-        
-        # Extract relevant information from the XML response
-        xml_data = response.text
-        pattern = r"<Name>(.*?)</Name>.*?<[V|R].*?>(.*?)</[V|R].*?>"
-        matches = re.findall(pattern, xml_data, re.DOTALL)
-        match_list = [(key.encode('utf-8'), value.encode('utf-8')) for key, value in matches]
-        
-        # Extract adjustment status and balance
-        adj_status = match_list[0][1]
-        pattern1 = r"\d+"
-        balance = re.findall(pattern1, match_list[-1][1])
-        
-        # Return the adjustment status and balance
-        return adj_status, balance[0]
-        
-    except Exception as e:
-        # Log and print any errors that occur
-        logging.info("TIME: " + str(time.strftime("%H:%M:%S", time.localtime(time.time()))) +
-                     " Error occurred while adjusting balance" + str(e))
-        print("Error in balance_adjustment: {}".format(e))
-		
-		
-		
-		
-		
 
-		
-		
-def bucket_adjustment(session_id, msisdn, amount, bucket_id, adjust_method, cf, url, headers, soap_url):
+def run_shard(a, cf, shard_file, current_date, logdirname, now):
+    """
+    Runs one shard on its own session, writing its results next to it for merge_shards.
+
+    Shards keep no checkpoint journal: a shard that did not finish is run
+    again whole, and the adjustment ledger keeps its applied adjustments from
+    being sent twice.
+
+    Args:
+        a (list): List of the configuration files read.
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+        shard_file (str): Input file of the shard.
+        current_date (str): Current date and time.
+        logdirname (str): Directory for logging files.
+        now (datetime): Current date and time object.
+
+    Returns:
+        int: Number of lines processed.
+    """
+    cf.set('parameters', 'checkpoint', 'no')
+    envelopes, transport, session_id = session_login(a, cf)
+    try:
+        workers = max(get_option(cf, 'bulk_workers', 1, int), 1)
+        return process_bulk_file(session_id, shard_file, current_date, cf, envelopes, transport, logdirname, now,
+                                 workers, writer=ShardResultWriter(shard_file + '.results'))
+    finally:
+        if session_id:
+            transport.sessions.close()
+        transport.close()
+
+
+def shard_process(items, shard_file, current_date, logdirname, now, k):
+    """
+    Runs one shard in a process of the pool of run_sharded.
+
+    Args:
+        items (list): (name, value) of the configuration parameters.
+        shard_file (str): Input file of the shard.
+        current_date (str): Current date and time.
+        logdirname (str): Log directory of the run; the shard logs to a shard_<k> directory in it.
+        now (datetime): Current date and time object.
+        k (int): The shard.
+    """
+    cf = ConfigParser.ConfigParser(allow_no_value=True)
+    cf.add_section('parameters')
+    for name, value in items:
+        cf.set('parameters', name, value)
+    # The logging of the parent has no listener thread in this process
+    for handler in logging.getLogger().handlers[:]:
+        logging.getLogger().removeHandler(handler)
+    shard_logs = os.path.join(logdirname, 'shard_%02d' % k)
+    logs = setup_logging(now, shard_logs, cf)
+    # The merge prints the results and summary of the whole run
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        run_shard(['config'], cf, shard_file, current_date, shard_logs, now)
+    finally:
+        # Pool processes end without running atexit
+        stop_logging(logs)
+
+
+def merge_shards(shard_dir, writer):
     """
-    Adjusts a specific bucket associated with a subscriber.
+    Writes the results of all shards to one sink, in the order of the input file.
 
     Args:
-        session_id (str): Session ID for authentication.
-        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
-        amount (float): Amount to adjust the bucket.
-        bucket_id (str): Identifier for the bucket to be adjusted.
-        adjust_method (str): Method to adjust the bucket.
-        cf (ConfigParser): Configuration parser object containing parameter details.
-        url (str): URL to send the SOAP request.
-        headers (dict): HTTP headers for the request.
-        soap_url (list): List containing SOAP URL information.
+        shard_dir (str): Directory of the shard files, see split_shards.
+        writer (ResultWriter): Sink for the merged results.
 
     Returns:
-        str: The main status indicating the success or failure of the bucket adjustment.
+        int: Number of input lines merged.
 
     Raises:
-        Exception: If an error occurs during the process.
-
+        ValueError: If the results of a shard are missing or incomplete.
     """
-
+    with open(os.path.join(shard_dir, 'manifest.json')) as file:
+        manifest = json.load(file)
+    paths = [path + '.results' for path in shard_paths(shard_dir, manifest['shards'])]
+    for path, lines in zip(paths, manifest['lines']):
+        if lines and not os.path.isfile(path):
+            raise ValueError("no results for " + path[:-len('.results')] + ", run it with --shard")
+    results = [open(path) if os.path.isfile(path) else None for path in paths]
+    merged = 0
     try:
-        # Retrieve XML names for bucket adjustment
-        buc_xml_names = cf.get('parameters', 'bucket_adj_names').split(',')
-
-        # SOAP request template for bucket adjustment
-        submit_request = """
-        <S:Envelope
-                xmlns:S="{soap_url[0]}">
-                <S:Body>
-                        <SubmitRequest
-                                xmlns="{soap_url[1]}">
-                                <SessionInfo>
-                                        <sessionId>{session_id}</sessionId>
-                                </SessionInfo>
-                                <RequestInfo>
-                                        <ReqID>{amount}</ReqID>
-                                </RequestInfo>
-                                <TaskList>
-                                        <Task>
-                                                <Name>{buc_xml_names[0]}</Name>
-                                                <ParamList>
-                                                        <Param>
-                                                                <Name>{buc_xml_names[1]}</Name>
-                                                                <!-- Required -->
-                                                                <Value>{msisdn}</Value>
-                                                        </Param>
-                                                        <Param>
-                                                                <Name>{buc_xml_names[2]}</Name>
-                                                                <!-- Required -->
-                                                                <Value>bdlBERVOBM_{bucket_id}</Value>
-                                                        </Param>
-                                                </ParamList>
-                                                <ContinueOnFailure>True</ContinueOnFailure>
-                                        </Task>
-                                        <Task>
-                                                <Name>{buc_xml_names[3]}</Name>
-                                                <ParamList>
-                                                        <Param>
-                                                                <Name>{buc_xml_names[1]}</Name>
-                                                                <!-- Required -->
-                                                                <Value>{msisdn}</Value>
-                                                        </Param>
-                                                        <Param>
-                                                                <Name>{buc_xml_names[4]}</Name>
-                                                                <!-- Required -->
-                                                                <Value>{bucket_id}</Value>
-                                                        </Param>
-                                                        <Param>
-                                                                <Name>{buc_xml_names[5]}</Name>
-                                                                <!-- Required -->
-                                                                <Value>{adjust_method}</Value>
-                                                        </Param>
-                                                        <Param>
-                                                                <Name>{buc_xml_names[6]}</Name>
-                                                                <!-- Required -->
-                                                                <Value>{amount}</Value>
-                                                        </Param>
-                                                </ParamList>
-                                        </Task>
-                                </TaskList>
-                        </SubmitRequest>
-                </S:Body>
-        </S:Envelope>
-        """
-
-        # Populate the SOAP request template with data
-        submit_request = submit_request.format(
-            session_id=session_id,
-            msisdn=msisdn,
-            amount=amount,
-            bucket_id=bucket_id,
-            adjust_method = adjust_method,
-            soap_url = soap_url,
-            buc_xml_names=buc_xml_names
-        )
+        with open(os.path.join(shard_dir, 'order'), 'rb') as order:
+            for block in iter(lambda: order.read(65536), b''):
+                for k in bytearray(block):
+                    merged += 1
+                    if k == NO_SHARD:
+                        writer.write(None)
+                        continue
+                    line = results[k].readline()
+                    if not line:
+                        raise ValueError("results of " + paths[k] + " end early, run the shard again with --shard")
+                    entry = json.loads(line)
+                    writer.write(entry and LineResult(entry[0], entry[1], Amount(entry[2]), Amount(entry[3])))
+    finally:
+        for file in results:
+            if file is not None:
+                file.close()
+    return merged
 
-        # Send the SOAP request to adjust the bucket
-        response = requests.request("POST", url, data=submit_request, headers=headers)
 
-        # Parse the response XML
-        root1 = ET.fromstring(response.text)
+def run_sharded(a, cf, file_name, current_date, logdirname, now, quiet=False, split_only=False, merge_dir=None):
+    """
+    Runs an input file as shards, each in a process of its own with its own session, and merges their results.
 
-        # Extract the main status from the response
-        xml_data = response.text
-        pattern = r"<Name>(.*?)</Name>.*?<[V|R].*?>(.*?)</[V|R].*?>"
-        matches = re.findall(pattern, xml_data, re.DOTALL)
-        match_list = [(key.encode('utf-8'), value.encode('utf-8')) for key, value in matches]
-        main_status = match_list[1][1]
+    Args:
+        a (list): List of the configuration files read.
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+        file_name (str): Input file.
+        current_date (str): Current date and time.
+        logdirname (str): Directory for logging files.
+        now (datetime): Current date and time object.
+        quiet (bool): Do not print each result line.
+        split_only (bool): Stop after writing the shard files, to run them on other hosts.
+        merge_dir (str): Shard directory whose results, run elsewhere, are only to be merged.
 
-        # Return the main status indicating success or failure
-        return main_status
+    Returns:
+        int: Number of lines merged, 0 when only split or on error.
+    """
+    import multiprocessing  # For running the shards in processes of their own
+    started = time.time()
+    name = 'stdin' if file_name == '-' else os.path.basename(file_name or '')
+    shard_dir = merge_dir or os.path.join(logdirname, name + now.strftime('_%d%m%Y_%H%M.shards'))
+    try:
+        if merge_dir is None:
+            shards = get_option(cf, 'shards', 1, int)
+            counts = split_shards(file_name, shards, shard_dir,
+                                  input_format(file_name, get_option(cf, 'input_format', 'auto')))
+            message = "Split %s into %d shards of %s lines in %s" % (file_name, shards, ", ".join(map(str, counts)),
+                                                                     shard_dir)
+            logging.info(message)
+            print(message)
+            if split_only:
+                return 0
+            # The rate limit is a ceiling on the calls of the whole run, so each shard process gets its share
+            running = len([count for count in counts if count]) or 1
+            rate = get_option(cf, 'rate_limit', 0.0, float)
+            items = [(name, str(rate / running) if name == 'rate_limit' and rate > 0 else value)
+                     for name, value in cf.items('parameters', raw=True) if name not in ('ledger_file', 'session_cache')]
+            # The shards log to directories of their own but check and record the ledger of the run; each
+            # logs in and out with sessions of its own rather than sharing the cached ones
+            items.append(('ledger_file', ledger_path(cf, logdirname)))
+            processes = [multiprocessing.Process(target=shard_process,
+                                                 args=(items, path, current_date, logdirname, now, k))
+                         for k, path in enumerate(shard_paths(shard_dir, shards)) if counts[k]]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+                if process.exitcode:
+                    logging.error("A shard process exited with status %d", process.exitcode)
+        with open(os.path.join(shard_dir, 'manifest.json')) as file:
+            input_file = json.load(file)['input']
+        writer = result_writer(cf, logdirname, now, input_file, quiet)
+        writer.started = started
+        try:
+            lines = merge_shards(shard_dir, writer)
+        finally:
+            writer.close()
+    except (ValueError, IOError, OSError) as e:
+        log_error("in the sharded run", e)
+        print("Error in run_sharded: {}".format(e))
+        return 0
+    writer.report()
+    return lines
 
-    except Exception as e:
-        # Log and print any errors that occur
-        logging.info("TIME: " + str(time.strftime("%H:%M:%S", time.localtime(time.time()))) +
-                     " Error occurred while adjusting bucket " + str(e))
-        print("Error in bucket_adjustment: {}".format(e))
-		
-		
-		
-	
-def setup_logging(now, logdirname):
+
+def log_directory(workdir, now):
     """
-    Sets up logging configuration to log operations.
+    Builds the log directory of a run, one per month.
 
     Args:
-        now (datetime.datetime): Current date and time.
-        logdirname (str): Directory path for storing log files.
+        workdir (str): Directory the script is run from.
+        now (datetime): Current date and time object.
 
     Returns:
-        None
-
+        str: The directory of the log and results files.
     """
-    # Define log file name based on current date and time
-    logfilename = logdirname + '/' + now.strftime('Credit_Debit_Ops_Tool_%d%m%Y_%H%M.log')
-
-    # Create the log directory if it doesn't exist
-    if not os.path.exists(logdirname):
-        os.makedirs(logdirname)
+    return workdir + '/' + 'IN_Operations_logs' + '/' + 'Credit_Debit_logs' + '/' + now.strftime('Credit_Debit_%m%Y')
 
-    # Configure logging parameters
-    logging.basicConfig(
-        filename=logfilename,
-        filemode='w',
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        level=logging.INFO,
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
 
-	
-	
-	
-	
-def parse_argument(session_id, cf, url, headers, soap_url, details):
+def single_subscriber(session_id, details, current_date, cf, envelopes, transport, logdirname, now, quiet=False):
     """
-    Parses the command line arguments to extract necessary information.
+    Runs the operation given on the command line for one MSISDN.
 
     Args:
         session_id (str): Session ID for authentication.
-        cf (ConfigParser): Configuration parser object containing parameter details.
-        url (str): URL to send the SOAP request.
-        headers (dict): HTTP headers for the request.
-        soap_url (list): List containing SOAP URL information.
-        details (str): Details extracted from command line arguments.
+        details (str): MSISDN followed by the operation.
+        current_date (str): Current date and time.
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        logdirname (str): Directory for logging files.
+        now (datetime): Current date and time object.
+        quiet (bool): Do not print the result line to the console.
+    """
+    args = parse_argument(session_id, envelopes, transport, details)
+    # parse_argument logs the failed lookup and returns None, there is no result to write then
+    if args is None:
+        return
+    msisdn = args.msisdn
+    # Perform debit/credit logic based on the input details
+    writer = result_writer(cf, logdirname, now, msisdn, quiet)
+    try:
+        debit_credit_logic(session_id, msisdn, details, current_date, envelopes, transport, msisdn, logdirname, now,
+                           args, bonus_debit_policy(cf), writer)
+    finally:
+        writer.close()
 
-    Returns:
-        tuple: Parsed details including debit and credit amounts, subscriber information, etc.
 
-    Raises:
-        Exception: If an error occurs during parsing.
+class OutputCapture(object):
+    """
+    Stands in for sys.stdout to collect what a daemon command prints.
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        """
+        Returns:
+            bytes: The printed text, UTF-8 encoded.
+        """
+        text = "".join(self.parts)
+        return text.encode('utf-8') if isinstance(text, type(u"")) else text
+
 
+class CommandDaemon(object):
     """
-    try:
-        # Normalize the input details
-        args = re.sub(r"[\t\s;,:]{1,10}", " ", details)
+    Runs single-subscriber commands on one session kept logged in.
 
-        # Extract MSISDN from the input
-        msisdn = args.split()[0]
-        msisdn = msisdn if msisdn.startswith("234") else "234" + msisdn
+    The configuration is read again when its file changes, and the daemon
+    then logs in with the new settings; the gateway dropping the session is
+    handled by the transport, as for any run.
 
-        # Extract debit and credit amounts for main and bonus
-        debit_amt_main = " ".join(re.findall(r"MAIN|main\s\-(\d+\.?\d?\d?)", args))
-        debit_amt_main = float(debit_amt_main) if debit_amt_main else ""
+    Args:
+        config_path (str): Configuration file.
+        options (argparse.Namespace): Command line options of the daemon, applied to each configuration read.
+        workdir (str): Directory the results and log directories are made in.
+    """
 
-        debit_amt_bonus = " ".join(re.findall(r"BONUS|bonus\s\-(\d+\.?\d?\d?)", args))
-        debit_amt_bonus = int(float(debit_amt_bonus) * 10000) if debit_amt_bonus else ""
+    def __init__(self, config_path, options, workdir):
+        self.config_path = config_path
+        self.options = options
+        self.workdir = workdir
+        self.cf = None
+        self.envelopes = self.transport = self.session_id = None
 
-        credit_amt_main = " ".join(re.findall(r"MAIN|main\s\+(\d+\.?\d?\d?)", args))
-        credit_amt_main = float(credit_amt_main) if credit_amt_main else ""
+    def login(self):
+        """
+        Logs in, or in again when the configuration has changed since.
+        """
+        cf, a = load_config(self.config_path)
+        if cf is self.cf:
+            return
+        if self.cf is not None:
+            logging.info("Configuration %s changed, logging in again", self.config_path)
+            self.close()
+        apply_cli_options(cf, self.options)
+        self.envelopes, self.transport, self.session_id = session_login(a, cf)
+        self.cf = cf
 
-        credit_amt_bonus = " ".join(re.findall(r"BONUS|bonus\s\+(\d+\.?\d?\d?)", args))
-        credit_amt_bonus = float(credit_amt_bonus) * 10000 if credit_amt_bonus else ""
+    def run(self, details, quiet=False):
+        """
+        Runs one command, as the script run for one MSISDN would.
 
-        # Retrieve subscriber information
-        sub_info = get_sub_info(session_id, cf, msisdn, url, headers, soap_url)
+        Args:
+            details (str): MSISDN followed by the operation.
+            quiet (bool): Do not print the result line.
 
-        # Extract relevant status information
-        status = sub_info[1][3] if sub_info[0] == "SUCCESS" else ""
-        deactivated = re.match(r"\w{3}_DE\w{4,6}\d*", status)
-        valid_state = re.match(r"\w{3}_VA\w{3}\d*", status)
+        Returns:
+            bytes: What the command printed.
+        """
+        self.login()
+        now = datetime.datetime.now()
+        logdirname = log_directory(self.workdir, now)
+        if not os.path.exists(logdirname):
+            os.makedirs(logdirname)
+        output = OutputCapture()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            logging.info("Daemon command: %s", details)
+            single_subscriber(self.session_id, details, now.strftime("%Y%m%d%H%M"), self.cf, self.envelopes,
+                              self.transport, logdirname, now, quiet)
+        except Exception as e:
+            log_error("in the daemon command", e, details=details)
+            print("Error in main: {}".format(e))
+        finally:
+            sys.stdout = stdout
+        return output.getvalue()
 
-        return debit_amt_main, debit_amt_bonus, credit_amt_main, credit_amt_bonus, deactivated, valid_state, msisdn, sub_info
+    def close(self):
+        """
+        Closes the session, or keeps it for the next run, and the connections.
+        """
+        if self.transport is not None:
+            if self.session_id:
+                self.transport.sessions.close()
+            self.transport.close()
+        self.cf = self.transport = None
 
-    except Exception as e:
-        logging.info("TIME: " + str(time.strftime("%H:%M:%S", time.localtime(time.time()))) +
-                     " Error occurred while parsing argument " + str(e))
-        print("Error in parse_argument: {}".format(e))	
-		
-		
-		
-		
 
-	
+def serve_commands(daemon, path):
+    """
+    Serves single-subscriber commands on a local UNIX socket until stopped.
 
-def debit_operations(args, sub_info, session_id, current_date, cf, url, headers, soap_url):
+    Each connection sends one JSON line, {"details": ..., "quiet": ...}, and
+    is sent back what the command printed. Commands are run one at a time in
+    the order they arrive, so two commands for a subscriber never overlap.
+    The socket is made readable and writable by its owner only.
+
+    Args:
+        daemon (CommandDaemon): Runs the commands.
+        path (str): Socket file.
     """
-    Perform debit operations for a subscriber.
+    import signal
+    import socket
+    if os.path.exists(path):
+        if daemon_listening(path):
+            raise ValueError("a daemon already listens on " + path)
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(64)
+    # Stopping the daemon closes its session and removes the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.info("Daemon listening on %s", path)
+    try:
+        daemon.login()
+        while True:
+            conn, _ = server.accept()
+            try:
+                line = conn.makefile('rb').readline()
+                if line:
+                    # daemon_listening connects without sending a command
+                    request = json.loads(line.decode('utf-8'))
+                    conn.sendall(daemon.run(request['details'], bool(request.get('quiet'))))
+            except (ValueError, KeyError, socket.error) as e:
+                log_error("while serving a daemon command", e)
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        os.remove(path)
+        daemon.close()
+        logging.info("Daemon on %s stopped", path)
+
 
+def daemon_listening(path):
+    """
     Args:
-        args (tuple): Tuple containing debit operation arguments.
-        sub_info (tuple): Tuple containing subscriber information.
-        session_id (str): Session ID for authentication.
-        current_date (str): Current date for comparison.
-        cf (ConfigParser): Configuration parser object containing parameter details.
-        url (str): URL to send the SOAP request.
-        headers (dict): HTTP headers for the request.
-        soap_url (list): List containing SOAP URL information.
+        path (str): Socket file.
 
     Returns:
-        str: A formatted string representing the result of the debit operations.
-
-    Raises:
-        Exception: If an error occurs during the process.
+        bool: Whether a daemon accepts connections on it.
     """
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        # Extracting relevant information from arguments and subscriber info
-        debit_amt_main, debit_amt_bonus, deactivated, valid_state = args[:2] + args[4:6]
-        main_status, main_info = sub_info[:2]
-        msisdn, status, balance = main_info[0], main_info[3], main_info[6]
+        client.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        client.close()
 
-        # Main balance debit operation
-        if debit_amt_main:
-            if main_status == 'SUCCESS' and not deactivated and not valid_state:
-                if float(balance) >= debit_amt_main:
-                    # Perform main balance adjustment
-                    adj_status, adj_balance = balance_adjustment(session_id, msisdn, debit_amt_main, 'DECR', cf, url, headers, soap_url)
-                    main_debit = "main debiting " + adj_status + ", current main balance -> NGN" + str(float(adj_balance) / 10000)
-                else:
-                    main_debit = "Current main balance of NGN" + str(float(balance) / 10000) + " not sufficient for debiting NGN" + str(debit_amt_main)
-            elif deactivated:
-                main_debit = "The line is deactive, can't debit"
-            elif valid_state:
-                main_debit = "The line is in valid state, can't debit"
-        else:
-            main_debit = ""
 
-        # Bonus balance debit operation
-        if debit_amt_bonus:
-            bonus_status, bonus_info1, bonus_info2 = sub_info[2:]
-            if bonus_status == "SUCCESS" and not deactivated and not valid_state:
-                bonus_debit_detail = list(filter(lambda x: (x[2] >= current_date or x[2] == "") and (float(x[5]) >= debit_amt_bonus), bonus_info1))
-                if len(bonus_debit_detail) == 1:
-                    bucket_id, adj_bonus = bonus_debit_detail[0][4:6]
-                    # Perform bonus balance adjustment
-                    bonus_debit = bucket_adjustment(session_id, msisdn, debit_amt_bonus, bucket_id, 'DECR', cf, url, headers, soap_url)
-                    bonus_debit = "bonus debiting " + bonus_debit + ", current bonus balance -> NGN" + str((int(adj_bonus) - float(debit_amt_bonus)) / 10000)
-                elif len(bonus_debit_detail) > 1 and float(bonus_info1[0][5]) >= debit_amt_bonus:
-                    bucket_id, adj_bonus = bonus_debit_detail[0][4:6]
-                    # Perform bonus balance adjustment
-                    bonus_debit = bucket_adjustment(session_id, msisdn, debit_amt_bonus, bonus_id, 'DECR', cf, url, headers, soap_url)
-                    bonus_debit = "bonus debiting " + bonus_debit + ", current bonus balance -> NGN" + str((int(bonus_info1[0][5]) - float(debit_amt_bonus)) / 10000)
-                elif len(bonus_debit_detail) > 1 and float(bonus_info1[1][5]) >= debit_amt_bonus:
-                    bucket_id, adj_bonus = bonus_debit_detail[1][4:6]
-                    # Perform bonus balance adjustment
-                    bonus_debit = bucket_adjustment(session_id, msisdn, debit_amt_bonus, bucket_id, 'DECR', cf, url, headers, soap_url)
-                    bonus_debit = "bonus debiting " + bonus_debit + ", current bonus balance -> NGN" + str((int(bonus_info[0][5]) - float(debit_amt_bonus)) / 10000)
-                else:
-                    bonus_debit = "Current bonus balance not sufficient for debiting NGN" + str(float(debit_amt_bonus) / 10000)
-            elif deactivated:
-                bonus_debit = "The line is deactive, can't debit bonus"
-            elif valid_state:
-                bonus_debit = "The line is in valid state, can't debit bonus"
-            else:
-                bonus_debit = "Insufficient bonus balance for debiting"
-        else:
-            bonus_debit = ""
+def daemon_command(path, details, quiet=False):
+    """
+    Hands a single-subscriber command to the daemon listening on a socket.
 
-        # Concatenate main and bonus debit results
-        demarcate = " | " if main_debit and bonus_debit else ""
-        return "{}: {}{}{}".format(main_info[0], main_debit or "", demarcate, bonus_debit or "")
+    Args:
+        path (str): Socket file of the daemon.
+        details (str): MSISDN followed by the operation.
+        quiet (bool): Do not print the result line.
 
-    except Exception as e:
-        # Log and print any errors that occur
-        logging.info("TIME: " + str(datetime.now().strftime("%H:%M:%S")) +
-                     " Error occurred while carrying out debit operations " + str(e))
-        print("Error in debit_operations: {}".format(e))
-		
-		
-		
-		
-		
-		
-		
-def credit_operations(args, sub_info, details, session_id, cf, url, headers, soap_url):
+    Returns:
+        str: What the command printed, None if no daemon listens on the socket.
     """
-    Perform credit operations on the main and bonus balances of a subscriber.
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(path)
+        except socket.error:
+            # A socket left by a daemon that was killed
+            return None
+        client.sendall(json.dumps({'details': details, 'quiet': quiet}).encode('utf-8') + b'\n')
+        parts = []
+        while True:
+            part = client.recv(65536)
+            if not part:
+                return b"".join(parts).decode('utf-8')
+            parts.append(part)
+    finally:
+        client.close()
+
+
+def parse_cli(argv):
+    """
+    Parses the command line.
 
     Args:
-        args (list): List containing credit operation arguments.
-        sub_info (list): List containing subscriber information.
-        details (str): Details of the credit operation.
-        session_id (str): Session ID for authentication.
-        cf (ConfigParser): Configuration parser object containing parameter details.
-        url (str): URL to send the SOAP request.
-        headers (dict): HTTP headers for the request.
-        soap_url (list): List containing SOAP URL information.
+        argv (list): Command line arguments, without the script name.
 
     Returns:
-        str: Information about the result of the credit operations.
-
+        argparse.Namespace: Options, with the file name or MSISDN details in details.
     """
+    parser = argparse.ArgumentParser(description="Credit and debit main and bonus balances of subscriber lines.")
+    parser.add_argument('--workers', type=int, help="worker threads for bulk files (config: bulk_workers)")
+    parser.add_argument('--max-inflight', type=int, help="maximum concurrent SOAP calls (config: max_inflight)")
+    parser.add_argument('--pool-size', type=int, help="HTTP connections kept open to the gateway (config: http_pool_size)")
+    parser.add_argument('--lookup-batch', type=int, help="subscribers per batched lookup (config: lookup_batch_size)")
+    parser.add_argument('--submit-batch', type=int, help="adjustments per batched submit (config: submit_batch_size)")
+    parser.add_argument('--rate-limit', type=float, help="maximum SOAP calls per second (config: rate_limit)")
+    parser.add_argument('--input-format', choices=('auto', 'text', 'csv', 'jsonl'),
+                        help="format of the input file, auto to go by its extension (config: input_format)")
+    parser.add_argument('--preflight', action='store_true',
+                        help="validate the input file before the run, writing malformed lines to a rejects file "
+                             "(config: preflight)")
+    parser.add_argument('--aggregate', action='store_true',
+                        help="merge the lines of each MSISDN into one net adjustment, after validating them "
+                             "(config: aggregate)")
+    parser.add_argument('--output-format', choices=('text', 'csv', 'jsonl'),
+                        help="format of the results file (config: output_format)")
+    parser.add_argument('--quiet', action='store_true',
+                        help="do not print each result line to the console (config: quiet)")
+    parser.add_argument('--progress', action='store_true',
+                        help="show a progress line on stderr during bulk runs (config: progress)")
+    parser.add_argument('--metrics-file',
+                        help="file the run metrics are written to while running, .json for JSON, else Prometheus text "
+                             "(config: metrics_file)")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted bulk run, skipping the lines its checkpoint journal records")
+    parser.add_argument('--shards', type=int,
+                        help="split bulk files by MSISDN into this many shards, each run in a process of its own "
+                             "(config: shards)")
+    parser.add_argument('--split-only', action='store_true',
+                        help="with --shards, only write the shard files, to run them with --shard on other hosts")
+    parser.add_argument('--shard', action='store_true',
+                        help="run the given shard file of a sharded run, writing its results next to it")
+    parser.add_argument('--merge', action='store_true',
+                        help="merge the results of the given shard directory into one results file")
+    parser.add_argument('--plan', action='store_true',
+                        help="write an execution plan of the input file, deciding every line without adjusting any "
+                             "balance")
+    parser.add_argument('--execute', action='store_true',
+                        help="run the adjustments of the given execution plan, without looking subscribers up")
+    parser.add_argument('--daemon', action='store_true',
+                        help="stay running, serving single-MSISDN runs on a local UNIX socket on one session "
+                             "(config: daemon_socket)")
+    parser.add_argument('--serve', action='store_true',
+                        help="stay running, serving credits, debits, balance queries and bulk jobs over HTTP/JSON "
+                             "(config: service_address)")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="run on the asyncio client instead of worker threads (Python 3.7+)")
+    parser.add_argument('details', nargs=argparse.REMAINDER,
+                        help="input file (- for stdin), or MSISDN followed by the operation")
+    options = parser.parse_args(argv)
+    # Everything after the file or MSISDN lands in details, so an option there would be taken as operation text
+    misplaced = [token for token in options.details if token.startswith('--')]
+    if misplaced:
+        parser.error("options go before the input file or MSISDN: {}".format(' '.join(misplaced)))
+    return options
 
-    try:
-        # Extracting credit amounts, subscriber status, and balance information
-        credit_amt_main, credit_amt_bonus, deactivated, valid_state = args[2:4]+args[4:6]
-        main_status, main_info, bonus_status, bonus_info1 = sub_info[:4]
-        msisdn, status, balance = main_info[0], main_info[3], main_info[6] 
-        
-        # Credit operation for main balance
-        if credit_amt_main:
-            if main_status == 'SUCCESS':
-                if not deactivated and not valid_state:
-                    # Perform balance adjustment for main balance
-                    adj_status, adj_balance = balance_adjustment(session_id, msisdn, credit_amt_main, 'INCR', cf, url, headers, soap_url)
-                    main_credit = "main crediting " + adj_status + ", current main balance -> NGN" + str(float(adj_balance)/10000)
-                elif valid_state:
-                    main_credit = "The line is in valid state, can't credit main."
-                elif deactivated:
-                    main_credit = "The line is deactive, can't credit main"
-                else:
-                    main_credit = "call the script_writer attention"
-            else:
-                main_credit = "not on IN"
-        else:
-            main_credit = ""    
-        
-        # Credit operation for bonus balance
-        if credit_amt_bonus:
-            if bonus_status == 'SUCCESS' and not deactivated and not valid_state:
-                bonus_balance = float(bonus_info1[0][5])/10000 if bonus_info1 else 0
-                credit_bucket_id = "MAA" if "MAA" in details else "MA4" if "MA4" in details else None
-                
-                # Perform bucket adjustment for bonus balance
-                if credit_bucket_id:
-                    adj_status = bucket_adjustment(session_id, msisdn, int(credit_amt_bonus), credit_bucket_id, 'INCR', cf, url, headers, soap_url)
-                    total_bal = str(bonus_balance + (credit_amt_bonus)/10000) if adj_status == 'SUCCESS' else str(bonus_balance)
-                    bonus_credit = "bonus crediting " + adj_status + ", current bonus balance -> " + total_bal
-                else:
-                    bonus_credit = "Bucket id was not inputted, bonus credit was not executed"               
-            elif valid_state:
-                bonus_credit = "can't be credit in valid state"
-            elif deactivated:
-                bonus_credit = "can't be credited in deactivate state"
-            else:
-               bonus_credit = "call the script_writer attention"
-        else:
-            bonus_credit = ""
-            
-        # Formatting the result of credit operations
-        demarcate = " | " if main_credit and bonus_credit else ""
-        return "{}: {}{}{}".format(msisdn, main_credit or "", demarcate, bonus_credit or "" )
-    
-    except Exception as e:
-        # Logging and printing any errors that occur
-        logging.info("TIME: " + str(time.strftime("%H:%M:%S", time.localtime(time.time()))) +
-                     " Error occurred while carrying out credit operations " + str(e))
-        print("Error in credit_operations: {}".format(e))   
-		
-		
-		
-		
-		
-		
-		
-		
-def debit_credit_logic(session_id, msisdn, details, current_date, cf, url, headers, soap_url, filename, logdirname, now, args):
+
+def apply_cli_options(cf, options):
     """
-    Function to execute debit and credit operations logic.
+    Overrides configured settings with the ones given on the command line.
 
     Args:
-        session_id (str): Session ID for authentication.
-        msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
-        details (str): Details of the operation.
-        current_date (str): Current date and time.
         cf (ConfigParser): Configuration parser object containing parameter details.
-        url (str): URL to send the SOAP request.
-        headers (dict): HTTP headers for the request.
-        soap_url (list): List containing SOAP URL information.
-        filename (str): Name of the file being processed.
-        logdirname (str): Directory for logging files.
-        now (datetime): Current date and time object.
-        args (list): List containing arguments for the operations.
-
+        options (argparse.Namespace): Parsed command line options.
     """
+    overrides = {'bulk_workers': options.workers, 'max_inflight': options.max_inflight,
+                 'http_pool_size': options.pool_size, 'lookup_batch_size': options.lookup_batch,
+                 'submit_batch_size': options.submit_batch, 'rate_limit': options.rate_limit,
+                 'input_format': options.input_format, 'output_format': options.output_format,
+                 'quiet': 'yes' if options.quiet else None, 'progress': 'yes' if options.progress else None,
+                 'metrics_file': options.metrics_file, 'shards': options.shards}
+    for name, value in overrides.items():
+        if value is not None and cf.has_section('parameters'):
+            cf.set('parameters', name, str(value))
 
-    # Create output file path
-    output_info = logdirname + '/' + now.strftime('debit_credit_' + filename +'_%d%m%Y_%H%M.txt')
-    
-    # Extract subscriber information
-    sub_info = args[7]
-    
-    # Check if the operation is a debit
-    if details.count("-") >= 1 and details.count("+") == 0 and len(sub_info[1]) == 7:
-        # Execute debit operation
-        debited = debit_operations(args, sub_info, session_id, current_date, cf, url, headers, soap_url)
-        # Write debit information to the output file
-        with open(output_info, 'a') as file:
-            file.write(debited + '\n')        
-        print(debited)
-
-    # Check if the operation is a credit
-    if details.count("+") >= 1 and details.count("-") == 0 and len(sub_info[1]) == 7:
-        # Execute credit operation
-        credited = credit_operations(args, sub_info, details, session_id, cf, url, headers, soap_url)
-        # Write credit information to the output file
-        with open(output_info, 'a') as file:
-            file.write(credited + '\n')
-        print(credited)
-        
-    # Handle scenario where subscriber is not on IN
-    elif len(sub_info[1]) < 7:
-        info = msisdn + ": " + 'not on IN'
-        with open(output_info, 'a') as file:
-            file.write(info + '\n')
-        print(info)
-		
-		
-		
-		
-		
-		
-		
-		   
 
 def main():
     """
@@ -818,61 +5185,122 @@ def main():
     # Get the current working directory and time
     workdir = os.getcwd()
     workdir1 = "/sms/IN_TEAM/dayo/CUSTOMIZED-SCRIPT"
+    options = parse_cli(sys.argv[1:])
 
     now = datetime.datetime.now()
     current_date = now.strftime("%Y%m%d%H%M")
     
     # Create a directory for logging files
-    logdirname = workdir + '/' + 'IN_Operations_logs'+ '/' + 'Credit_Debit_logs' + '/' + now.strftime('Credit_Debit_%m%Y')
+    logdirname = log_directory(workdir, now)
 
-    logs = setup_logging(now, logdirname)
-        
-    logging.info('Log Execution Directory is at path :%s', logdirname)
-        
     fnm = "config1.ini"
-    cf = ConfigParser.ConfigParser(allow_no_value=True)
-    a = cf.read(os.path.join(workdir1, fnm))
+    cf, a = load_config(os.path.join(workdir1, fnm))
+    apply_cli_options(cf, options)
+
+    # A single MSISDN is handed to the daemon when one listens, before logging and login are set up
+    details = options.details
+    single = (bool(details) and details[0] != '-' and not os.path.isfile(details[0]) and
+              not (options.daemon or options.serve or options.use_async))
+    socket_path = get_option(cf, 'daemon_socket', os.path.join(workdir, 'IN_Operations_logs', 'credit_debit.sock'))
+    if single and os.path.exists(socket_path):
+        output = daemon_command(socket_path, " ".join(details), options.quiet)
+        if output is not None:
+            sys.stdout.write(output)
+            return
+    if single and cf.has_section('parameters') and not cf.has_option('parameters', 'session_cache'):
+        # Single-MSISDN runs keep their session for the next one, which then skips the login
+        cf.set('parameters', 'session_cache', os.path.join(workdir, 'IN_Operations_logs', 'Credit_Debit_logs',
+                                                           'single_sessions.json'))
+
+    try:
+        logs = setup_logging(now, logdirname, cf)
+    except ValueError as e:
+        # Logging is set up with the default settings to report the bad ones
+        logs = setup_logging(now, logdirname)
+        log_error("in the logging settings", e)
+        print("Error in main: {}".format(e))
+        return
+
+    logging.info('Log Execution Directory is at path :%s', logdirname)
+    if options.daemon:
+        # Commands are run on one session kept logged in, until the daemon is stopped
+        try:
+            serve_commands(CommandDaemon(os.path.join(workdir1, fnm), options, workdir), socket_path)
+        except (ValueError, IOError, OSError) as e:
+            log_error("in the daemon", e)
+            print("Error in main: {}".format(e))
+        return
+    if options.serve:
+        # Requests of many clients share one session pool and are coalesced into batched calls
+        import esm_service
+        esm_service.main(a, cf, logdirname)
+        return
+    two_phase = options.plan or options.execute
+    if options.use_async and two_phase:
+        logging.info("--plan and --execute run on worker threads, not on the asyncio client")
+    elif options.use_async:
+        # The asyncio client runs the session on one event loop, without worker threads
+        if sys.version_info < (3, 7):
+            logging.info("The asyncio client needs Python 3.7 or later")
+            print("Error in main: --async needs Python 3.7 or later")
+            return
+        import esm_async
+        esm_async.main(a, cf, options.details, current_date, logdirname, now, options)
+        return
+    if details and not two_phase and (options.shard or options.merge or (get_option(cf, 'shards', 1, int) > 1 and
+                                                                         (details[0] == '-' or os.path.isfile(details[0])))):
+        # Sharded runs log in once per shard, each shard process on its own session
+        if options.shard:
+            run_shard(a, cf, details[0], current_date, logdirname, now)
+        elif options.merge:
+            run_sharded(a, cf, None, current_date, logdirname, now, options.quiet, merge_dir=details[0])
+        else:
+            file_name = prepare_input(cf, details[0], logdirname, now, options.preflight, options.aggregate)
+            run_sharded(a, cf, file_name, current_date, logdirname, now, options.quiet, options.split_only)
+        return
     logged_in = session_login(a, cf)
-    soap_url, url, headers, session_id = logged_in
+    envelopes, transport, session_id = logged_in
     
     # Check if login was successful
     if len(logged_in) == 3:
         logging.info("Logged in successfully")
     try:
         # Get the MSISDN or filename from command line arguments
-        arg = sys.argv
-        if len(arg) > 1:
-            file_name = arg[1]
-            isFile = os.path.isfile(file_name)
+        arg = options.details
+        if len(arg) > 0:
+            file_name = arg[0]
+            isFile = file_name == '-' or os.path.isfile(file_name)
             if isFile:
-                # Try to open the argument as a file
-                with open(file_name, 'r') as file:
-                    for details in file:
-                        args = parse_argument(session_id, cf, url, headers, soap_url, details)
-                        msisdn = args[6]
-                        # Perform debit/credit logic based on the input details
-                        debit_credit_logic(session_id, msisdn, details, current_date, cf, url, headers, soap_url, file_name, logdirname, now, args)
+                workers = max(get_option(cf, 'bulk_workers', 1, int), 1)
+                if options.execute:
+                    # The plan holds the decisions and subscriber states, nothing is looked up again
+                    cf.set('parameters', 'input_format', 'plan')
+                else:
+                    file_name = prepare_input(cf, file_name, logdirname, now, options.preflight, options.aggregate)
+                if options.plan:
+                    plan_bulk_file(session_id, file_name, current_date, cf, envelopes, transport, logdirname, now, workers)
+                else:
+                    # Process the file, its pre-flight output or its plan through the bulk worker pool
+                    process_bulk_file(session_id, file_name, current_date, cf, envelopes, transport, logdirname, now,
+                                      workers, options.resume, options.quiet)
 
             else:
                 # If it's not a file, assume it's a MSISDN
-                details = " ".join(arg[1:])
-                args = parse_argument(session_id, cf, url, headers, soap_url, details)
-                msisdn = args[6]
-                # Perform debit/credit logic based on the input details
-                debit_credit_logic(session_id, msisdn, details, current_date, cf, url, headers, soap_url, msisdn, logdirname, now, args)
+                single_subscriber(session_id, " ".join(arg), current_date, cf, envelopes, transport, logdirname, now,
+                                  options.quiet)
       
 
     except Exception as e:
-        logging.info("TIME: " + str(time.strftime("%H:%M:%S", time.localtime(time.time()))) +
-                     " Error occurred in the main " + str(e))
+        log_error("in the main", e)
         # Handle exceptions and print an error message
         print("Error in main: {}".format(e))
         
     finally:
-        # Close the session
+        # Close the sessions, or keep them for the next run
         if session_id:
-            close_session(session_id, url, headers, soap_url)
+            transport.sessions.close()
             logging.info('Session properly closed and tool Execution Ended ')
+        transport.close()
         
 
 # Execute the main function if the script is run as the main module
@@ -0,0 +1,675 @@
+#!/usr/bin/python
+
+"""
+Title: Asyncio client for the eSM SOAP gateway used by credit_debit.py
+Script Name: esm_async.py
+
+Runs the credit_debit.py operations on a single event loop, so thousands of
+subscriber operations can be in flight from one process without a thread per
+request. The envelopes, response parsing and debit/credit decisions are the
+ones of credit_debit.py; only the I/O is asynchronous. Needs Python 3.7 or
+later and is selected with `credit_debit.py --async`.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import ssl
+import time
+import zlib
+from urllib.parse import urlsplit
+
+import credit_debit as cd
+
+
+class StaleConnection(ConnectionError):
+    """
+    Raised when a pooled connection was closed by the gateway before any of
+    the response arrived, so the request can safely be sent again.
+    """
+
+
+# Errors are logged the way credit_debit.py logs them
+log_error = cd.log_error
+
+
+class AsyncHttpPool(object):
+    """
+    Keep-alive HTTP/1.1 connections to one host, shared by all coroutines.
+
+    At most `limit` requests are sent to the host at once. A request that
+    fails, times out or is cancelled closes its connection instead of
+    returning it to the pool, so a late response can never be read as the
+    answer to the next request sent on that connection.
+
+    Args:
+        url (str): URL for the SOAP service.
+        headers (dict): HTTP headers for the request.
+        limit (int): Maximum concurrent requests, and open connections, to the host.
+        timeout (tuple): Connect and read timeouts in seconds.
+        compress (bool): Gzip the request bodies.
+        limiter (RateLimiter): Paces the requests, None for no rate limit.
+        metrics (RunMetrics): Records the latency and size of each request, None for no metrics.
+    """
+
+    def __init__(self, url, headers, limit=100, timeout=(5, 30), compress=False, limiter=None, metrics=None):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self.timeout = timeout
+        self.compress = compress
+        self.limiter = limiter
+        self.metrics = metrics
+        self.slots = asyncio.Semaphore(limit)
+        self.idle = []
+        # The request head is rendered once, only the length changes per call
+        head = ["POST %s HTTP/1.1" % ((parts.path or '/') + ('?' + parts.query if parts.query else '')),
+                "Host: %s:%d" % (self.host, self.port), "Connection: keep-alive", "Accept-Encoding: gzip"]
+        head.extend("%s: %s" % item for item in headers.items())
+        if compress:
+            head.append("Content-Encoding: gzip")
+        self.head = ("\r\n".join(head) + "\r\nContent-Length: %d\r\n\r\n").encode('latin-1')
+
+    async def post(self, data):
+        """
+        Sends a SOAP request over a pooled connection.
+
+        Args:
+            data (bytes): SOAP envelope to send.
+
+        Returns:
+            tuple: The HTTP status code and the response body.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        operation = cd.soap_operation(data) if self.metrics is not None else None
+        if self.compress:
+            packer = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes the gzip format
+            data = packer.compress(data) + packer.flush()
+        request = self.head % len(data) + data
+        if self.limiter is None and self.metrics is None:
+            return await self.request(request)
+        if self.limiter is not None:
+            wait = self.limiter.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+        started = time.time()
+        try:
+            status, body = await self.request(request)
+        except Exception:
+            self.record(operation, time.time() - started, False, len(data), 0)
+            raise
+        self.record(operation, time.time() - started, status < 500, len(data), len(body))
+        return status, body
+
+    def record(self, operation, latency, ok, sent, received):
+        """
+        Reports a request to the rate limiter and the run metrics, as credit_debit.SoapTransport.record.
+        """
+        if self.limiter is not None:
+            self.limiter.record(latency, ok)
+        if self.metrics is not None:
+            self.metrics.call(operation, latency, ok, sent, received)
+
+    async def request(self, request):
+        """
+        Sends a complete HTTP request within the per-host limit.
+
+        Args:
+            request (bytes): The complete HTTP request.
+
+        Returns:
+            tuple: The HTTP status code and the response body.
+        """
+        async with self.slots:
+            while self.idle:
+                conn = self.idle.pop()
+                try:
+                    return await self.send(conn, request)
+                except StaleConnection:
+                    # The gateway closed the idle connection, try the next one
+                    continue
+            conn = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout[0])
+            return await self.send(conn, request)
+
+    async def send(self, conn, request):
+        """
+        Runs one request and response exchange on a connection.
+
+        Args:
+            conn (tuple): (StreamReader, StreamWriter) of the connection.
+            request (bytes): The complete HTTP request.
+
+        Returns:
+            tuple: The HTTP status code and the response body.
+        """
+        try:
+            status, body, keep_alive = await asyncio.wait_for(self.exchange(conn, request), self.timeout[1])
+        except BaseException:
+            conn[1].close()
+            raise
+        if keep_alive:
+            self.idle.append(conn)
+        else:
+            conn[1].close()
+        return status, body
+
+    async def exchange(self, conn, request):
+        """
+        Writes a request and reads its response.
+
+        Args:
+            conn (tuple): (StreamReader, StreamWriter) of the connection.
+            request (bytes): The complete HTTP request.
+
+        Returns:
+            tuple: The status code, the body and whether the connection can be reused.
+        """
+        reader, writer = conn
+        writer.write(request)
+        await writer.drain()
+        try:
+            status = int((await reader.readuntil(b'\r\n')).split()[1])
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            raise StaleConnection("connection closed by the gateway")
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if not size:
+                    while await reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body, keep_alive = await reader.read(), False
+        if headers.get('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 47)
+        return status, body, keep_alive
+
+    async def close(self):
+        """
+        Closes the pooled connections.
+        """
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+class AsyncEsmClient(object):
+    """
+    Asyncio client for the eSM gateway operations of credit_debit.py.
+
+    Args:
+        cf (ConfigParser): Configuration parser object containing parameter details.
+    """
+
+    def __init__(self, cf):
+        self.cf = cf
+        self.soap_url, url, headers = cd.gateway_address(cf)
+        self.pool = AsyncHttpPool(url, headers,
+                                  limit=cd.get_option(cf, 'async_connections', 100, int),
+                                  timeout=(cd.get_option(cf, 'connect_timeout', 5.0, float),
+                                           cd.get_option(cf, 'read_timeout', 30.0, float)),
+                                  compress=cd.get_option(cf, 'gzip', 'no').lower() in ('1', 'yes', 'true', 'on'),
+                                  limiter=cd.rate_limiter(cf), metrics=cd.run_metrics(cf))
+        self.envelopes = cd.EnvelopeBuilder(cf, self.soap_url)
+        self.cache_file = cd.get_option(cf, 'session_cache', '')
+        self.session_id = None
+        self.renewing = asyncio.Lock()
+        self.adjustments = 0
+        self.cache = cd.subscriber_cache(cf)
+        self.policy = cd.bonus_debit_policy(cf)
+
+    async def login(self):
+        """
+        Opens the session used by the other operations.
+
+        Returns:
+            str: The session ID.
+        """
+        soap_username = self.cf.get('parameters', 'Soap_username')
+        logging.info('Logged in using :%s', soap_username)
+        request = cd.LOGIN_TEMPLATE.format(soap_username=soap_username, soap_url=self.soap_url,
+                                           soap_password=self.cf.get('parameters', 'Soap_password'))
+        status, body = await self.pool.post(request)
+        self.session_id = cd.session_id_from_response(body, self.soap_url)
+        return self.session_id
+
+    async def logout(self):
+        """
+        Closes the session.
+        """
+        await self.pool.post(cd.LOGOUT_TEMPLATE.format(session_id=self.session_id, soap_url=self.soap_url))
+        self.session_id = None
+
+    async def open_session(self):
+        """
+        Logs in, or reuses the session cached by a previous run within its TTL.
+
+        Returns:
+            str: The session ID.
+        """
+        if self.cache_file:
+            cached, stale = cd.load_session_cache(self.cf, self.cache_file,
+                                                  cd.get_option(self.cf, 'session_ttl', 600.0, float))
+            # Only one session is used, the others would otherwise stay open on the gateway
+            for session_id in stale + cached[1:]:
+                try:
+                    await self.pool.post(cd.LOGOUT_TEMPLATE.format(session_id=session_id, soap_url=self.soap_url))
+                except Exception as e:
+                    log_error("while logging out a cached session", e)
+            if cached:
+                logging.info("Reusing cached session from %s", self.cache_file)
+                self.session_id = cached[0]
+                return self.session_id
+        return await self.login()
+
+    async def close_session(self):
+        """
+        Caches the session for the next run, or logs it out.
+        """
+        if self.cache_file:
+            cd.save_session_cache(self.cf, self.cache_file, [self.session_id])
+        else:
+            await self.logout()
+
+    async def renew(self, request):
+        """
+        Logs in again after a request failed on a session the gateway dropped.
+
+        Args:
+            request (bytes): The failed request.
+
+        Returns:
+            str: The session ID to retry with, None if the request holds no session.
+        """
+        match = cd.SESSION_ID.search(request)
+        if match is None:
+            return None
+        async with self.renewing:
+            # Requests sent before an earlier renewal only need the new ID
+            if match.group(2).decode('utf-8') == self.session_id:
+                await self.login()
+                logging.warning("Session expired or invalid, logged in again")
+        return self.session_id
+
+    async def tasks(self, request):
+        """
+        Sends a request and parses its task results.
+
+        Args:
+            request (bytes): SOAP envelope to send.
+
+        Returns:
+            list: The TaskResults of the response.
+        """
+        status, body = await self.pool.post(request)
+        if status >= 500 and cd.SESSION_FAULT.search(body):
+            # The gateway dropped the session, log in again and retry the call once
+            session_id = await self.renew(request)
+            if session_id is not None:
+                status, body = await self.pool.post(cd.with_session(request, session_id))
+        return cd.parse_response(body, self.envelopes.task_names).tasks
+
+    async def sub_info(self, msisdn):
+        """
+        Get subscriber information, as credit_debit.get_sub_info.
+
+        Args:
+            msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+
+            SubscriberState: The state of the subscriber, None if the lookup failed.
+            tuple: A tuple containing main_status, result, bonus_status, result1, and result2.
+        """
+        try:
+            started = time.time()
+            tasks = await self.tasks(self.envelopes.retrieve(self.session_id, msisdn))
+            cd.log_event(logging.DEBUG, "Subscriber lookup", msisdn=msisdn, operation='lookup',
+                         latency_ms=int((time.time() - started) * 1000), status=tasks[0].status)
+            return cd.sub_info_from_tasks(msisdn, tasks[0], tasks[1] if len(tasks) > 1 else None)
+        except Exception as e:
+            log_error("while getting sub information", e, msisdn=msisdn, operation='lookup')
+            print("Error in get_sub_info: {}".format(e))
+
+    async def balance_adjustment(self, msisdn, amount, adjust_method, req_id=''):
+        """
+        Adjusts the balance of a subscriber, as credit_debit.balance_adjustment.
+
+        Args:
+            msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+            amount (float): Amount to adjust the balance.
+            adjust_method (str): Method to adjust the balance.
+            req_id (str): ReqID identifying the adjustment, empty for none.
+
+        Returns:
+            tuple: adj_status (adjustment status) and balance after adjustment.
+        """
+        try:
+            self.adjustments += 1
+            started = time.time()
+            result = cd.balance_from_tasks(await self.tasks(
+                self.envelopes.balance_adjustment(self.session_id, msisdn, amount, adjust_method, req_id)))
+            cd.log_event(logging.DEBUG, "Balance adjustment", msisdn=msisdn, operation='balance ' + adjust_method,
+                         latency_ms=int((time.time() - started) * 1000), status=result[0], req_id=req_id)
+            return result
+        except Exception as e:
+            log_error("while adjusting balance", e, msisdn=msisdn, operation='balance ' + adjust_method, req_id=req_id)
+            print("Error in balance_adjustment: {}".format(e))
+
+    async def bucket_adjustment(self, msisdn, amount, bucket_id, adjust_method, req_id=''):
+        """
+        Adjusts a specific bucket of a subscriber, as credit_debit.bucket_adjustment.
+
+        Args:
+            msisdn (str): Mobile Subscriber Integrated Services Digital Network Number.
+            amount (float): Amount to adjust the bucket.
+            bucket_id (str): Identifier for the bucket to be adjusted.
+            adjust_method (str): Method to adjust the bucket.
+            req_id (str): ReqID identifying the adjustment, empty for none.
+
+        Returns:
+            str: The status of the bucket adjustment.
+        """
+        try:
+            self.adjustments += 1
+            started = time.time()
+            status = cd.bucket_status_from_tasks(await self.tasks(
+                self.envelopes.bucket_adjustment(self.session_id, msisdn, amount, bucket_id, adjust_method, req_id)))
+            cd.log_event(logging.DEBUG, "Bucket adjustment", msisdn=msisdn, operation='bucket ' + adjust_method,
+                         bucket_id=bucket_id, latency_ms=int((time.time() - started) * 1000), status=status,
+                         req_id=req_id)
+            return status
+        except Exception as e:
+            log_error("while adjusting bucket", e, msisdn=msisdn, operation='bucket ' + adjust_method,
+                      bucket_id=bucket_id, req_id=req_id)
+            print("Error in bucket_adjustment: {}".format(e))
+
+    async def run_steps(self, steps, ledger=None, line_no=0):
+        """
+        Runs an operation generator, as credit_debit.run_steps.
+
+        Args:
+            steps: Generator from credit_debit.line_steps, or the result line it returned.
+            ledger (AdjustmentLedger): Skips the adjustments already applied, None to submit every one.
+            line_no (int): Line number of the operation in the input file, from 0.
+
+        Returns:
+            cd.LineResult: The result line, None when the operation failed or holds nothing to run.
+        """
+        if not hasattr(steps, 'send'):
+            return cd.line_result(steps, [])
+        metrics = self.pool.metrics
+        applied = []
+        started = time.time()
+        submitting = 0.0
+        try:
+            step = next(steps)
+            while isinstance(step, tuple):
+                sent = time.time()
+                # The ledger rules of AdjustmentLedger.apply, around an awaited submit
+                req_id, send, result = ledger.prepare(line_no, step) if ledger is not None else ('', True, None)
+                if send:
+                    if step[0] == 'balance':
+                        result = await self.balance_adjustment(*step[1:], req_id=req_id)
+                    else:
+                        result = await self.bucket_adjustment(*step[1:], req_id=req_id)
+                    if self.cache is not None:
+                        self.cache.adjusted(step, result)
+                    if ledger is not None:
+                        ledger.finish(req_id, result)
+                submitting += time.time() - sent
+                applied.append((step, result))
+                step = steps.send(result)
+            return cd.line_result(step, applied)
+        except StopIteration:
+            return None
+        finally:
+            steps.close()
+            if metrics is not None:
+                metrics.stage('decide', time.time() - started - submitting)
+                if applied:
+                    metrics.stage('submit', submitting, all(cd.applied_ok(result) for step, result in applied))
+
+    async def process_line(self, details, current_date, ledger=None, line_no=0, record=None):
+        """
+        Parses one input line and runs its operation, as credit_debit.process_line.
+
+        Args:
+            details (str): Input line.
+            current_date (str): Current date and time.
+            ledger (AdjustmentLedger): Skips the adjustments already applied, None to submit every one.
+            line_no (int): Line number in the input file, from 0.
+            record (AdjustmentRecord): The line as parsed by credit_debit.read_records, None to parse it here.
+
+        Returns:
+            str: The result line, or None when nothing is to be written for the line.
+        """
+        if not details.strip():
+            return None
+        if record is not None:
+            # The reader has reported the lines it could not parse
+            msisdn = record.msisdn or None
+            if msisdn is None:
+                return None
+        else:
+            try:
+                msisdn = cd.extract_msisdn(details)
+            except ValueError:
+                msisdn = None
+        metrics = self.pool.metrics
+        started = time.time()
+        subscriber = None
+        if msisdn is not None:
+            if self.cache is not None:
+                # Without a parsed record the line is taken to be a debit
+                debit = record is None or (record.main_delta or 0) < 0 or (record.bonus_delta or 0) < 0
+                subscriber = self.cache.get(msisdn, debit)
+            if subscriber is None:
+                subscriber = await self.sub_info(msisdn)
+                if subscriber is not None and self.cache is not None:
+                    self.cache.put(msisdn, subscriber)
+        # The subscriber is already known, so parse_argument makes no call of its own
+        args = None
+        if msisdn is None or subscriber is not None:
+            args = cd.parse_argument(self.session_id, self.envelopes, None, details, subscriber, record)
+        if metrics is not None:
+            metrics.stage('lookup', time.time() - started, args is not None)
+        if args is None:
+            return None
+        return await self.run_steps(cd.line_steps(args.msisdn, details, current_date, args, self.policy), ledger, line_no)
+
+    async def close(self):
+        """
+        Closes the pooled connections.
+        """
+        await self.pool.close()
+
+
+async def process_file(client, file_name, current_date, writer, limit, journal=None, ledger=None,
+                       input_format='text'):
+    """
+    Processes an input file with up to `limit` lines in flight.
+
+    Lines of one MSISDN run one after the other in input order, and the
+    results are written in input order, as in the threaded bulk engine.
+
+    Args:
+        client (AsyncEsmClient): Logged in client.
+        file_name (str): Input file.
+        current_date (str): Current date and time.
+        writer (cd.ResultWriter): Sink for the result lines.
+        limit (int): Maximum lines in flight.
+        journal (CheckpointJournal): Records each finished line and skips those of an earlier run, None for no checkpoints.
+        ledger (AdjustmentLedger): Skips the adjustments already applied, None to submit every one.
+        input_format (str): text, csv or jsonl.
+
+    Returns:
+        int: Number of lines processed.
+    """
+    window = asyncio.Semaphore(limit)
+    ordered = asyncio.Queue()
+    latest = {}
+
+    async def run_line(details, record, key, where, previous):
+        if previous is not None:
+            # Wait for the earlier line of the MSISDN, whatever its outcome
+            await asyncio.wait([previous])
+        result = None
+        try:
+            result = await client.process_line(details, current_date, ledger, where[2], record)
+        except Exception as e:
+            log_error("while processing line " + str(where[2] + 1), e)
+        if journal is not None:
+            journal.record(where, key, details, result)
+        return result
+
+    async def write_results():
+        while True:
+            task = await ordered.get()
+            if task is None:
+                break
+            result = await task
+            written = time.time()
+            writer.write(result)
+            if metrics is not None:
+                metrics.stage('write', time.time() - written)
+            window.release()
+
+    metrics = client.pool.metrics
+    results = asyncio.ensure_future(write_results())
+    seq = 0
+    try:
+        started = time.time()
+        for details, record, where in cd.read_records(file_name, journal, input_format):
+            if metrics is not None:
+                metrics.stage('parse', time.time() - started, record is None or bool(record.msisdn))
+            await window.acquire()
+            key = record.msisdn if record is not None else ""
+            task = asyncio.ensure_future(run_line(details, record, key, where, latest.get(key)))
+            latest[key] = task
+            task.add_done_callback(lambda done, key=key: latest.pop(key) if latest.get(key) is done else None)
+            ordered.put_nowait(task)
+            seq += 1
+            started = time.time()
+    except Exception as e:
+        log_error("while reading " + file_name, e)
+    finally:
+        ordered.put_nowait(None)
+        await results
+    return seq
+
+
+async def run(a, cf, details, current_date, logdirname, now, options=None):
+    """
+    Runs the script's session on the asyncio client.
+
+    Args:
+        a (list): List of the configuration files read.
+        cf (ConfigParser): Configuration parser object containing parameter details.
+        details (list): Input file, or MSISDN followed by the operation.
+        current_date (str): Current date and time.
+        logdirname (str): Directory for logging files.
+        now (datetime): Current date and time object.
+        options (argparse.Namespace): Command line options of credit_debit.py, for --resume, --preflight and --aggregate.
+    """
+    if len(a) == 0:
+        logging.error("Configuration file config.ini not found")
+        return
+    try:
+        client = AsyncEsmClient(cf)
+    except ValueError as e:
+        log_error("in the configuration", e)
+        print("Error in main: {}".format(e))
+        return
+    try:
+        await client.open_session()
+    except Exception as e:
+        log_error("at session_login", e)
+        await client.close()
+        return
+    logging.info("Logged in successfully")
+    try:
+        if details and (details[0] == '-' or os.path.isfile(details[0])):
+            started = time.time()
+            file_name = cd.prepare_input(cf, details[0], logdirname, now, getattr(options, 'preflight', False),
+                                         getattr(options, 'aggregate', False))
+            ledger = None
+            try:
+                writer = cd.result_writer(cf, logdirname, now, file_name, getattr(options, 'quiet', False))
+                ledger = cd.open_ledger(cf, logdirname, file_name)
+                journal = cd.open_journal(cf, logdirname, file_name, getattr(options, 'resume', False))
+            except (ValueError, IOError, OSError, sqlite3.Error) as e:
+                if ledger is not None:
+                    ledger.close()
+                log_error("while setting up the run", e)
+                print("Error in process_file: {}".format(e))
+                return
+            metrics = client.pool.metrics
+            if metrics is not None:
+                metrics.start()
+            try:
+                lines = await process_file(client, file_name, current_date, writer,
+                                           cd.get_option(cf, 'async_lines', 1000, int), journal, ledger,
+                                           cd.input_format(file_name, cd.get_option(cf, 'input_format', 'auto')))
+            finally:
+                writer.close()
+                if metrics is not None:
+                    metrics.stop()
+                if journal is not None:
+                    journal.close(complete=True)
+                if ledger is not None:
+                    ledger.close()
+            elapsed = time.time() - started
+            summary = ("Processed %d lines on the asyncio client in %.1fs (%.1f lines/sec), %d adjustments (%.1f adjustments/sec)"
+                       % (lines, elapsed, lines / elapsed if elapsed else 0.0, client.adjustments,
+                          client.adjustments / elapsed if elapsed else 0.0))
+            logging.info(summary)
+            print(summary)
+            writer.report()
+            if metrics is not None:
+                metrics.report()
+            if ledger is not None:
+                ledger.report()
+            if client.cache is not None:
+                client.cache.report()
+        elif details:
+            line = " ".join(details)
+            result = await client.process_line(line, current_date)
+            if result:
+                writer = cd.result_writer(cf, logdirname, now, cd.extract_msisdn(line), getattr(options, 'quiet', False))
+                try:
+                    writer.write(result)
+                finally:
+                    writer.close()
+    except Exception as e:
+        log_error("in the main", e)
+        print("Error in main: {}".format(e))
+    finally:
+        try:
+            await client.close_session()
+            logging.info('Session properly closed and tool Execution Ended ')
+        finally:
+            await client.close()
+
+
+def main(a, cf, details, current_date, logdirname, now, options=None):
+    """
+    Entry point of `credit_debit.py --async`, see run.
+    """
+    asyncio.run(run(a, cf, details, current_date, logdirname, now, options))
@@ -0,0 +1,550 @@
+#!/usr/bin/python
+
+"""
+Title: Local HTTP/JSON service for the credit_debit.py operations
+Script Name: esm_service.py
+
+Serves credits, debits, balance queries and bulk jobs over HTTP from one
+long-running process, on one pool of sessions and one pool of connections to
+the eSM gateway, instead of a credit_debit.py process and login per
+operation. Requests arriving together are coalesced: their lookups go to the
+gateway in one batched RetrieveRequest and their adjustments in one batched
+SubmitRequest. The result lines are the ones credit_debit.py writes for the
+same operations. Started with `credit_debit.py --serve`.
+
+Endpoints, all answering JSON:
+    POST /credit          {"msisdn": ..., "main": "10", "bonus": "2", "bucket": "MAA"}
+    POST /debit           {"msisdn": ..., "main": "5", "bonus": "1"}
+    GET  /balance/MSISDN
+    POST /jobs            {"file": path} or {"lines": [input line, ...]}
+    GET  /jobs, /jobs/ID
+    GET  /stats
+"""
+
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import credit_debit as cd
+
+# Amounts of the credit and debit requests, unsigned; the endpoint gives the sign
+REQUEST_AMOUNT = re.compile(r"\d+(?:\.\d\d?)?$")
+
+
+class ServiceError(Exception):
+    """
+    Raised for a request the service answers with an error status.
+
+    Args:
+        status (int): HTTP status of the answer.
+        message (str): Why the request failed.
+    """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class SubscriberLocks(object):
+    """
+    One lock per MSISDN with requests in progress.
+
+    The requests of a subscriber run one after another, each looking up the
+    state the previous one left, while requests of other subscribers run,
+    and are coalesced, alongside.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.held = {}
+
+    @contextlib.contextmanager
+    def hold(self, msisdn):
+        """
+        Holds the lock of a subscriber for the duration of a with block.
+
+        Args:
+            msisdn (str): MSISDN of the subscriber.
+        """
+        with self.lock:
+            entry = self.held.setdefault(msisdn, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.held[msisdn]
+
+
+class LookupBatcher(object):
+    """
+    Groups the subscriber lookups of concurrent requests into batched RetrieveRequests.
+
+    Works as credit_debit.SubmitBatcher does for adjustments: the first
+    lookup of a batch waits up to the window for others to join it, and the
+    batch is sent as soon as it is full or the window has passed. A lookup
+    alone in its batch is sent as credit_debit.py sends it.
+
+    Args:
+        session_id (str): Session ID for authentication.
+        envelopes (EnvelopeBuilder): Pre-rendered SOAP envelopes.
+        transport (SoapTransport): Shared HTTP transport for the SOAP calls.
+        batch_size (int): Subscribers per RetrieveRequest.
+        window (float): Seconds a batch waits to fill up.
+    """
+
+    def __init__(self, session_id, envelopes, transport, batch_size, window):
+        self.session_id = session_id
+        self.envelopes = envelopes
+        self.transport = transport
+        self.batch_size = max(batch_size, 1)
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = []
+        self.lookups = 0
+        self.retrieves = 0
+
+    def get(self, msisdn):
+        """
+        Looks a subscriber up with the other lookups of its batch.
+
+        Args:
+            msisdn (str): MSISDN of the subscriber.
+
+        Returns:
+            SubscriberState: The state of the subscriber, None if the lookup failed.
+        """
+        entry = [msisdn, threading.Event(), None]
+        batch = None
+        with self.lock:
+            self.pending.append(entry)
+            leader = len(self.pending) == 1
+            if len(self.pending) >= self.batch_size:
+                batch, self.pending = self.pending, []
+        if batch is None and leader and not entry[1].wait(self.window):
+            with self.lock:
+                # Still unsent after the window, send whatever has gathered
+                if self.pending and self.pending[0] is entry:
+                    batch, self.pending = self.pending, []
+        if batch is not None:
+            self.flush(batch)
+        entry[1].wait()
+        return entry[2]
+
+    def flush(self, batch):
+        """
+        Sends a batch and hands each waiting lookup its subscriber.
+
+        Args:
+            batch (list): Pending [MSISDN, event, subscriber] entries.
+        """
+        try:
+            msisdns = list(collections.OrderedDict((entry[0], None) for entry in batch))
+            with self.lock:
+                self.lookups += len(batch)
+                self.retrieves += 1
+            if len(msisdns) == 1:
+                infos = {msisdns[0]: cd.get_sub_info(self.session_id, self.envelopes, msisdns[0], self.transport)}
+            else:
+                infos = cd.get_sub_info_batch(self.session_id, self.envelopes, msisdns, self.transport)
+            for entry in batch:
+                entry[2] = infos.get(entry[0])
+        finally:
+            for entry in batch:
+                entry[1].set()
+
+
+def subscriber_json(subscriber):
+    """
+    Writes the state of a subscriber as the answer of a balance query.
+
+    Args:
+        subscriber (SubscriberState): The state.
+
+    Returns:
+        dict: MSISDN, statuses, account state, main balance in NGN (None when not on IN) and bonus buckets.
+    """
+    return {'msisdn': subscriber.msisdn, 'status': subscriber.status, 'state': subscriber.state,
+            'main_balance': None if subscriber.balance is None else subscriber.balance.ngn(),
+            'bonus_status': subscriber.bonus_status,
+            'buckets': [{'bundle_id': bucket.bundle_id, 'state': bucket.state, 'end_date': bucket.end_date,
+                         'bucket_id': bucket.bucket_id, 'counter': bucket.counter.ngn()}
+                        for bucket in subscriber.buckets]}
+
+
+class AdjustmentService(object):
+    """
+    The operations of the service, on one login shared by all requests.
+
+    Credits and debits are run as credit_debit.py runs the line of one
+    MSISDN, with the lookup and the adjustments coalesced with those of the
+    other requests in flight, and their result lines appended to one results
+    file. Bulk jobs run one at a time, in the order they were posted, through
+    credit_debit.process_bulk_file.
+
+    Args:
+        a (list): List of the configuration files read.
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+        logdirname (str): Directory for logging, results and job files.
+    """
+
+    def __init__(self, a, cf, logdirname):
+        self.cf = cf
+        self.logdirname = logdirname
+        if not cf.has_option('parameters', 'http_pool_size'):
+            # Coalesced calls from many requests go out side by side
+            cf.set('parameters', 'http_pool_size', '10')
+        self.envelopes, self.transport, self.session_id = cd.session_login(a, cf)
+        batch_size = cd.get_option(cf, 'service_batch_size', 100, int)
+        window = cd.get_option(cf, 'service_window_ms', 5.0, float) / 1000.0
+        self.lookups = LookupBatcher(self.session_id, self.envelopes, self.transport, batch_size, window)
+        self.batcher = cd.SubmitBatcher(self.session_id, self.envelopes, self.transport, batch_size, window)
+        self.policy = cd.bonus_debit_policy(cf)
+        self.locks = SubscriberLocks()
+        self.writer = cd.result_writer(cf, logdirname, datetime.datetime.now(), 'service', quiet=True)
+        self.write_lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.job_lock = threading.Lock()
+        self.job_ready = threading.Condition(self.job_lock)
+        self.job_queue = collections.deque()
+        self.job_count = 0
+        self.job_thread = threading.Thread(target=self.run_jobs)
+        self.job_thread.daemon = True
+        self.job_thread.start()
+
+    def adjust(self, sign, fields):
+        """
+        Credits or debits the balances of a subscriber.
+
+        Args:
+            sign (str): + to credit, - to debit.
+            fields (dict): msisdn, main and bonus amounts in NGN, unsigned, and the bucket of a bonus credit.
+
+        Returns:
+            dict: The MSISDN, the result line, its outcome and the NGN debited and credited.
+
+        Raises:
+            ServiceError: If the request is malformed (400) or the subscriber could not be looked up (502).
+        """
+        amounts = {}
+        for name in ('main', 'bonus'):
+            amount = fields.get(name)
+            amount = str(amount).strip() if amount is not None else ""
+            if amount and not REQUEST_AMOUNT.match(amount):
+                raise ServiceError(400, "malformed %s amount %r, give NGN without a sign" % (name, amount))
+            amounts[name] = sign + amount if amount else ""
+        if not amounts['main'] and not amounts['bonus']:
+            raise ServiceError(400, "no amount to adjust")
+        # The line the command line would be given for the same operation
+        details = cd.fields_details(fields.get('msisdn'), amounts['main'], amounts['bonus'], fields.get('bucket')).strip()
+        try:
+            record = cd.parse_details(details)
+        except ValueError as e:
+            raise ServiceError(400, str(e))
+        now = datetime.datetime.now()
+        with self.locks.hold(record.msisdn):
+            subscriber = self.lookups.get(record.msisdn)
+            # A failed batch leaves the subscriber to be looked up on its own, as a bulk line's
+            result = cd.process_line(self.session_id, details, now.strftime("%Y%m%d%H%M"), self.envelopes,
+                                     self.transport, subscriber, self.batcher, record=record, policy=self.policy)
+        if result is None:
+            raise ServiceError(502, "subscriber %s could not be looked up" % record.msisdn)
+        with self.write_lock:
+            self.writer.write(result)
+        return {'msisdn': record.msisdn, 'result': str(result), 'outcome': result.outcome,
+                'debited': result.debited.ngn(), 'credited': result.credited.ngn()}
+
+    def balance(self, msisdn):
+        """
+        Looks up the balances of a subscriber.
+
+        Args:
+            msisdn (str): MSISDN, with or without the 234 country code.
+
+        Returns:
+            dict: The state of the subscriber, see subscriber_json.
+
+        Raises:
+            ServiceError: If the MSISDN is not valid (400) or the lookup failed (502).
+        """
+        msisdn = cd.normalize_msisdn(msisdn.strip())
+        if not cd.VALID_MSISDN.match(msisdn):
+            raise ServiceError(400, "invalid MSISDN " + msisdn)
+        with self.locks.hold(msisdn):
+            subscriber = self.lookups.get(msisdn)
+            if subscriber is None:
+                subscriber = cd.get_sub_info(self.session_id, self.envelopes, msisdn, self.transport)
+        if subscriber is None:
+            raise ServiceError(502, "subscriber %s could not be looked up" % msisdn)
+        return subscriber_json(subscriber)
+
+    def submit_job(self, fields):
+        """
+        Queues a bulk job.
+
+        Args:
+            fields (dict): file, an input file on this host, or lines, the input lines of the job.
+
+        Returns:
+            dict: The job, see job.
+
+        Raises:
+            ServiceError: If the job names no readable input (400).
+        """
+        with self.job_lock:
+            self.job_count += 1
+            job_id = str(self.job_count)
+        if fields.get('file'):
+            file_name = os.path.abspath(str(fields['file']))
+            if not os.path.isfile(file_name):
+                raise ServiceError(400, "no input file " + file_name)
+        elif isinstance(fields.get('lines'), list):
+            file_name = os.path.join(self.logdirname, datetime.datetime.now().strftime(
+                'service_job_' + job_id + '_%d%m%Y_%H%M%S.txt'))
+            with open(file_name, 'w') as file:
+                for line in fields['lines']:
+                    file.write(str(line).rstrip('\n') + '\n')
+        else:
+            raise ServiceError(400, "a job needs a file or a list of lines")
+        with self.job_lock:
+            job = self.jobs[job_id] = {'id': job_id, 'status': 'queued', 'file': file_name, 'results': None,
+                                       'lines': 0, 'summary': []}
+            self.job_queue.append(job)
+            self.job_ready.notify()
+        logging.info("Bulk job %s queued for %s", job_id, file_name)
+        return dict(job)
+
+    def job(self, job_id):
+        """
+        Args:
+            job_id (str): ID of a job.
+
+        Returns:
+            dict: The ID, status (queued, running, done or failed), input file, results file, lines run and
+            summary of the job.
+
+        Raises:
+            ServiceError: If there is no such job (404).
+        """
+        with self.job_lock:
+            if job_id not in self.jobs:
+                raise ServiceError(404, "no job " + job_id)
+            return dict(self.jobs[job_id])
+
+    def job_list(self):
+        """
+        Returns:
+            list: Every job posted, see job.
+        """
+        with self.job_lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def run_jobs(self):
+        """
+        Runs the queued bulk jobs one at a time, until None is queued.
+        """
+        while True:
+            with self.job_lock:
+                while not self.job_queue:
+                    self.job_ready.wait()
+                job = self.job_queue.popleft()
+            if job is None:
+                return
+            self.run_job(job)
+
+    def run_job(self, job):
+        """
+        Runs one bulk job as `credit_debit.py <file>` runs it, on the session of the service.
+
+        Args:
+            job (dict): The job.
+        """
+        now = datetime.datetime.now()
+        writer = cd.result_writer(self.cf, self.logdirname, now, job['file'], quiet=True)
+        with self.job_lock:
+            job.update(status='running', results=writer.path)
+        try:
+            workers = max(cd.get_option(self.cf, 'bulk_workers', 1, int), 1)
+            lines = cd.process_bulk_file(self.session_id, job['file'], now.strftime("%Y%m%d%H%M"), self.cf,
+                                         self.envelopes, self.transport, self.logdirname, now, workers, quiet=True,
+                                         writer=writer)
+            with self.job_lock:
+                job.update(status='done', lines=lines, summary=writer.summary())
+        except Exception as e:
+            cd.log_error("in the bulk job", e, job=job['id'])
+            with self.job_lock:
+                job.update(status='failed', summary=[str(e)])
+
+    def stats(self):
+        """
+        Returns:
+            dict: Requests served, and the lookups and adjustments in the batched calls that carried them.
+        """
+        with self.write_lock:
+            results = dict(self.writer.counts)
+        return {'results': results,
+                'lookups': {'subscribers': self.lookups.lookups, 'retrieves': self.lookups.retrieves},
+                'adjustments': {'adjustments': self.batcher.adjustments, 'submits': self.batcher.submits},
+                'jobs': len(self.jobs)}
+
+    def close(self):
+        """
+        Stops the job thread after the running job, closes the results file and the session.
+        """
+        with self.job_lock:
+            self.job_queue.append(None)
+            self.job_ready.notify()
+        with self.write_lock:
+            self.writer.close()
+        if self.session_id:
+            self.transport.sessions.close()
+        self.transport.close()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler passing the requests to the server's AdjustmentService.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        service = self.server.service
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        try:
+            fields = self.read_json() if method == 'POST' else {}
+            status = 200
+            if method == 'POST' and parts in (['credit'], ['debit']):
+                reply = service.adjust('+' if parts[0] == 'credit' else '-', fields)
+            elif method == 'GET' and len(parts) == 2 and parts[0] == 'balance':
+                reply = service.balance(parts[1])
+            elif method == 'POST' and parts == ['jobs']:
+                status, reply = 202, service.submit_job(fields)
+            elif method == 'GET' and parts == ['jobs']:
+                reply = service.job_list()
+            elif method == 'GET' and len(parts) == 2 and parts[0] == 'jobs':
+                reply = service.job(parts[1])
+            elif method == 'GET' and parts == ['stats']:
+                reply = service.stats()
+            else:
+                raise ServiceError(404, "no endpoint %s %s" % (method, self.path))
+        except ServiceError as e:
+            status, reply = e.status, {'error': str(e)}
+        except Exception as e:
+            cd.log_error("in the service", e, path=self.path)
+            status, reply = 500, {'error': str(e)}
+        data = json.dumps(reply, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        """
+        Returns:
+            dict: The JSON object of the request body.
+
+        Raises:
+            ServiceError: If the body is not a JSON object (400).
+        """
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            fields = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError as e:
+            raise ServiceError(400, "malformed JSON body: %s" % e)
+        if not isinstance(fields, dict):
+            raise ServiceError(400, "the body must be a JSON object")
+        return fields
+
+    def log_message(self, format, *args):
+        logging.debug("Service request %s", format % args)
+
+
+class ServiceServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server hosting an AdjustmentService.
+
+    Args:
+        address (tuple): (host, port) to listen on, port 0 for any free port.
+        service (AdjustmentService): Service answering the requests.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256  # Many clients connecting at once
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, ServiceHandler)
+        self.service = service
+
+
+def service_address(cf):
+    """
+    Reads where the service listens from the configuration.
+
+    Args:
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+
+    Returns:
+        tuple: (host, port) of service_address, 127.0.0.1:8088 by default.
+    """
+    host, _, port = cd.get_option(cf, 'service_address', '127.0.0.1:8088').rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def main(a, cf, logdirname):
+    """
+    Logs in and serves the requests until the process is stopped.
+
+    Args:
+        a (list): List of the configuration files read.
+        cf (ConfigParser.ConfigParser): Configuration parser object.
+        logdirname (str): Directory for logging, results and job files.
+    """
+    address = service_address(cf)
+    service = AdjustmentService(a, cf, logdirname)
+    try:
+        server = ServiceServer(address, service)
+    except (IOError, OSError) as e:
+        service.close()
+        cd.log_error("while starting the service", e)
+        print("Error in main: {}".format(e))
+        return
+    # Stopping the service closes its session and results file
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.info("Service listening on http://%s:%d", address[0], server.server_address[1])
+    print("Service listening on http://%s:%d" % (address[0], server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        logging.info("Service on port %d stopped", server.server_address[1])
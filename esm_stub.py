@@ -0,0 +1,460 @@
+#!/usr/bin/python
+
+"""
+Title: Local stub of the eSM SOAP gateway used by credit_debit.py
+Script Name: esm_stub.py
+
+Answers LoginRequest, LogoutRequest, RetrieveRequest and SubmitRequest with the
+same element names the credit_debit.py config keys drive, so the script can be
+run and measured without the real IN.
+
+Latency, drawn from one of several distributions, random faults and a
+throttling capacity can be injected to see how the script behaves against a
+slow or overloaded node.
+
+Usage: python esm_stub.py [--latency-ms MS] [--jitter-ms MS] [--latency-dist DIST] [--fault-rate RATE]
+                          [--capacity CALLS] [--bundles N] [--bundles-max N] [port]
+"""
+
+import argparse
+import math
+import random
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+SOAP_ENV = "http://schemas.xmlsoap.org/soap/envelope/"
+ESM_NS = "http://esm.example.com/v2"
+
+# Shapes of the injected latency, see StubGateway.delay
+LATENCY_DISTRIBUTIONS = ('uniform', 'normal', 'exponential', 'lognormal')
+
+# Bundle attribute names the credit_debit.py bundle parser keys on
+BUNDLE_FIELDS = ["Bundle ID", "Bundle State", "End Date Time", "Tariff Plan COSP ID",
+                 "Bucket/Discount ID 1", "Bucket/UBD Counter 1"]
+
+
+def local_name(tag):
+    """
+    Strips the namespace from an element tag.
+
+    Args:
+        tag (str): Element tag, possibly in {namespace}name form.
+
+    Returns:
+        str: The tag without its namespace.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+def xml_escape(value):
+    """
+    Escapes a value for use as XML text.
+
+    Args:
+        value: Value to escape.
+
+    Returns:
+        str: The escaped text.
+    """
+    return str(value).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+class Subscriber(object):
+    """
+    In-memory state of a simulated subscriber.
+
+    Attributes:
+        msisdn (str): Subscriber number.
+        state (str): Account state, e.g. SUB_ACTIVE.
+        balance (int): Main balance in 1/10000 units.
+        bundles (list): Bundle rows as lists of BUNDLE_FIELDS values.
+    """
+
+    def __init__(self, msisdn, state, balance, bundles):
+        self.msisdn = msisdn
+        self.state = state
+        self.balance = balance
+        self.bundles = bundles
+
+
+class StubGateway(object):
+    """
+    Subscriber store and SOAP operation handlers of the stub.
+
+    Args:
+        bundles_per_sub (int): Bundles created for each new subscriber.
+        seed (int): Seed for the generated subscriber data.
+        latency (float): Seconds added to every response.
+        jitter (float): Spread in seconds of the latency added, see delay.
+        fault_rate (float): Share of requests answered with a SOAP fault.
+        capacity (int): Requests per second served before answering with a
+            throttling fault, 0 for no limit.
+        session_requests (int): Requests a session serves before it expires, 0 for no limit.
+        latency_dist (str): Distribution of the added latency, one of LATENCY_DISTRIBUTIONS.
+        bundles_max (int): Most bundles of a new subscriber, each getting between
+            bundles_per_sub and this many; 0 for exactly bundles_per_sub.
+    """
+
+    def __init__(self, bundles_per_sub=2, seed=1, latency=0.0, jitter=0.0, fault_rate=0.0, capacity=0, session_requests=0,
+                 latency_dist='uniform', bundles_max=0):
+        if latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError("latency_dist must be one of " + ", ".join(LATENCY_DISTRIBUTIONS))
+        self.bundles_per_sub = bundles_per_sub
+        self.bundles_max = max(bundles_max, bundles_per_sub)
+        self.seed = seed
+        self.latency = latency
+        self.jitter = jitter
+        self.latency_dist = latency_dist
+        self.fault_rate = fault_rate
+        self.capacity = capacity
+        self.session_requests = session_requests
+        self.random = random.Random(seed)
+        self.subscribers = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.counters = {'connections': 0, 'requests': 0, 'faults': 0, 'throttled': 0, 'logins': 0}
+        self.second, self.served = 0, 0
+
+    def count(self, name, amount=1):
+        """
+        Increments one of the stub counters.
+
+        Args:
+            name (str): Counter name.
+            amount (int): Increment.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def subscriber(self, msisdn):
+        """
+        Returns the subscriber for an MSISDN, creating it on first use.
+
+        MSISDNs ending in 0 are not provisioned on the IN, ending in 1 are
+        deactivated and ending in 2 are in valid state.
+
+        Args:
+            msisdn (str): Subscriber number.
+
+        Returns:
+            Subscriber: The subscriber, or None when not provisioned.
+        """
+        with self.lock:
+            if msisdn in self.subscribers:
+                return self.subscribers[msisdn]
+            if msisdn.endswith('0'):
+                return None
+            rnd = random.Random("%s-%s" % (self.seed, msisdn))
+            state = {'1': 'SUB_DEACTIVE', '2': 'SUB_VALID1'}.get(msisdn[-1], 'SUB_ACTIVE')
+            bundles = []
+            count = self.bundles_per_sub
+            if self.bundles_max > count:
+                # Drawn only for a range, so fixed counts keep the data of earlier seeds
+                count = rnd.randint(count, self.bundles_max)
+            for i in range(count):
+                end_date = "20991231%04d" % rnd.randint(0, 2359) if i % 3 else ""
+                bundles.append(["bdlBERVOBM_%d" % (i + 1), "ACTIVE", end_date, str(100 + i),
+                                "MA%d" % (i + 1), str(rnd.randint(0, 50000) * 100)])
+            sub = Subscriber(msisdn, state, rnd.randint(0, 200000) * 100, bundles)
+            self.subscribers[msisdn] = sub
+            return sub
+
+    def delay(self):
+        """
+        Draws the latency added to a response, with the lock held.
+
+        uniform adds up to jitter on top of latency; normal draws around
+        latency with jitter as the standard deviation; exponential adds a long
+        tail of mean jitter on top of latency; lognormal has latency as its
+        median and latency + jitter as its mean.
+
+        Returns:
+            float: Seconds to wait.
+        """
+        if not self.jitter:
+            return self.latency
+        if self.latency_dist == 'normal':
+            return max(self.random.gauss(self.latency, self.jitter), 0.0)
+        if self.latency_dist == 'exponential':
+            return self.latency + self.random.expovariate(1.0 / self.jitter)
+        if self.latency_dist == 'lognormal' and self.latency:
+            sigma = math.sqrt(2 * math.log(1 + self.jitter / self.latency))
+            return self.latency * self.random.lognormvariate(0, sigma)
+        return self.latency + self.random.uniform(0, self.jitter)
+
+    def injected_fault(self):
+        """
+        Applies the injected latency and decides on an injected fault.
+
+        Returns:
+            str: Fault string to answer with, or None to serve the request.
+        """
+        with self.lock:
+            delay = self.delay()
+            fault = self.fault_rate and self.random.random() < self.fault_rate
+            now = int(time.time())
+            if now != self.second:
+                self.second, self.served = now, 0
+            self.served += 1
+            throttled = self.capacity and self.served > self.capacity
+        if delay:
+            time.sleep(delay)
+        if throttled:
+            self.count('throttled')
+            return "Too many requests, throttled"
+        if fault:
+            self.count('faults')
+            return "Internal error"
+        return None
+
+    def handle(self, body):
+        """
+        Dispatches a SOAP request to its handler.
+
+        Args:
+            body (bytes): Request envelope.
+
+        Returns:
+            str: Response envelope.
+        """
+        root = ET.fromstring(body)
+        request = [child for child in root.iter() if local_name(child.tag).endswith('Request')][0]
+        name = local_name(request.tag)
+        if name == 'LoginRequest':
+            return self.login()
+        session_id = [e for e in request.iter() if local_name(e.tag) == 'sessionId'][0]
+        with self.lock:
+            served = self.sessions.get(session_id.text)
+            if served is not None:
+                if self.session_requests and served >= self.session_requests:
+                    del self.sessions[session_id.text]
+                    served = None
+                else:
+                    self.sessions[session_id.text] = served + 1
+        if served is None:
+            return self.fault("Invalid session")
+        if name == 'LogoutRequest':
+            with self.lock:
+                self.sessions.pop(session_id.text, None)
+            return self.envelope('<LogoutResponse xmlns="%s"><Result>SUCCESS</Result></LogoutResponse>' % ESM_NS)
+        tasks = [e for e in request.iter() if local_name(e.tag) == 'Task']
+        if name == 'RetrieveRequest':
+            return self.envelope('<RetrieveResponse xmlns="%s"><ResultList>%s</ResultList></RetrieveResponse>'
+                                 % (ESM_NS, "".join(self.retrieve(task) for task in tasks)))
+        return self.envelope('<SubmitResponse xmlns="%s"><ResultList>%s</ResultList></SubmitResponse>'
+                             % (ESM_NS, "".join(self.submit(task) for task in tasks)))
+
+    def login(self):
+        """
+        Opens a new session.
+
+        Returns:
+            str: LoginResponse envelope.
+        """
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = 0
+            self.counters['logins'] += 1
+        return self.envelope('<LoginResponse xmlns="%s"><sessionId>%s</sessionId></LoginResponse>' % (ESM_NS, session_id))
+
+    def retrieve(self, task):
+        """
+        Answers one query task of a RetrieveRequest.
+
+        The first requested attribute is echoed with the MSISDN, the fourth
+        with the account state and the seventh with the main balance.
+
+        Args:
+            task (Element): The Task element.
+
+        Returns:
+            str: TaskResult fragment.
+        """
+        children = dict((local_name(e.tag), e) for e in task)
+        task_name = children['Name'].text
+        msisdn = [e for e in task.iter() if local_name(e.tag) == 'Value'][0].text
+        items = [e.text for e in task.iter() if local_name(e.tag) == 'item']
+        sub = self.subscriber(msisdn)
+        if sub is None:
+            return ('<TaskResult><Name>%s</Name><Result>FAILURE</Result>'
+                    '<ErrorCode>1001</ErrorCode><ErrorMsg>Subscriber not found</ErrorMsg></TaskResult>' % task_name)
+        if "Bundle ID" in items:
+            rows = "".join("<Record>%s</Record>" % "".join(
+                "<Attribute><Name>%s</Name><Value>%s</Value></Attribute>" % (xml_escape(n), xml_escape(v))
+                for n, v in zip(BUNDLE_FIELDS, bundle)) for bundle in sub.bundles)
+            return '<TaskResult><Name>%s</Name><Result>SUCCESS</Result><Data>%s</Data></TaskResult>' % (task_name, rows)
+        values = [sub.msisdn, "NGA", "PREPAID", sub.state, "EN", "ALL", sub.balance]
+        attrs = "".join("<Attribute><Name>%s</Name><Value>%s</Value></Attribute>" % (xml_escape(n), xml_escape(v))
+                        for n, v in zip(items, values))
+        return '<TaskResult><Name>%s</Name><Result>SUCCESS</Result><Data>%s</Data></TaskResult>' % (task_name, attrs)
+
+    def submit(self, task):
+        """
+        Applies one task of a SubmitRequest.
+
+        Main balance adjustments carry the amount in naira and answer with the
+        new balance in 1/10000 units; bucket adjustments carry 1/10000 units.
+
+        Args:
+            task (Element): The Task element.
+
+        Returns:
+            str: TaskResult fragment.
+        """
+        task_name = [e for e in task if local_name(e.tag) == 'Name'][0].text
+        params = [[c.text for c in p] for p in task.iter() if local_name(p.tag) == 'Param']
+        values = [p[1] if len(p) > 1 else None for p in params]
+        sub = self.subscriber(values[0])
+        if sub is None:
+            return '<TaskResult><Name>%s</Name><Result>FAILURE</Result></TaskResult>' % task_name
+        methods = [v for v in values if v in ('INCR', 'DECR')]
+        if not methods:
+            # Bundle provisioning task of a bucket adjustment
+            return '<TaskResult><Name>%s</Name><Result>SUCCESS</Result></TaskResult>' % task_name
+        sign = 1 if methods[0] == 'INCR' else -1
+        if len(params) >= 5:
+            with self.lock:
+                sub.balance += sign * int(round(float(values[4]) * 10000))
+            return ('<TaskResult><Name>%s</Name><Result>SUCCESS</Result>'
+                    '<Attribute><Name>Balance</Name><Value>%d</Value></Attribute></TaskResult>' % (task_name, sub.balance))
+        bucket_id, amount = values[1], int(float(values[3]))
+        with self.lock:
+            for bundle in sub.bundles:
+                if bundle[4] == bucket_id:
+                    bundle[5] = str(int(bundle[5]) + sign * amount)
+                    break
+            else:
+                sub.bundles.append(["bdlBERVOBM_" + bucket_id, "ACTIVE", "", "100", bucket_id, str(max(amount, 0))])
+        return '<TaskResult><Name>%s</Name><Result>SUCCESS</Result></TaskResult>' % task_name
+
+    def envelope(self, body):
+        """
+        Wraps a response body in a SOAP envelope.
+
+        Args:
+            body (str): Response element.
+
+        Returns:
+            str: The SOAP envelope.
+        """
+        return '<S:Envelope xmlns:S="%s"><S:Body>%s</S:Body></S:Envelope>' % (SOAP_ENV, body)
+
+    def fault(self, message):
+        """
+        Builds a SOAP fault.
+
+        Args:
+            message (str): Fault string.
+
+        Returns:
+            str: The SOAP fault envelope.
+        """
+        return self.envelope('<S:Fault><faultcode>S:Server</faultcode><faultstring>%s</faultstring></S:Fault>'
+                             % xml_escape(message))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler passing SOAP requests to the server's StubGateway.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.gateway.count('connections')
+
+    def do_POST(self):
+        gateway = self.server.gateway
+        gateway.count('requests')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            fault = gateway.injected_fault()
+            reply = gateway.fault(fault) if fault else gateway.handle(body)
+            code = 500 if '<S:Fault>' in reply else 200
+        except Exception as e:
+            reply, code = gateway.fault("Malformed request: %s" % e), 500
+        data = reply.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server hosting a StubGateway.
+
+    Args:
+        address (tuple): (host, port) to listen on, port 0 for any free port.
+        gateway (StubGateway): Gateway answering the requests.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256  # Clients opening many connections at once
+
+    def __init__(self, address, gateway):
+        HTTPServer.__init__(self, address, StubHandler)
+        self.gateway = gateway
+
+
+def start_stub(port=0, **kwargs):
+    """
+    Starts a stub gateway on a background thread.
+
+    Args:
+        port (int): Port to listen on, 0 for any free port.
+        **kwargs: Options passed to StubGateway.
+
+    Returns:
+        StubServer: The running server; its port is server.server_address[1].
+    """
+    server = StubServer(('127.0.0.1', port), StubGateway(**kwargs))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stub of the eSM SOAP gateway.")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="milliseconds added to every response")
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help="spread of the latency in milliseconds")
+    parser.add_argument('--latency-dist', choices=LATENCY_DISTRIBUTIONS, default='uniform',
+                        help="distribution of the latency: uniform adds up to jitter, normal has jitter as its "
+                             "standard deviation, exponential adds a tail of mean jitter, lognormal has the latency "
+                             "as its median and latency + jitter as its mean")
+    parser.add_argument('--fault-rate', type=float, default=0.0, help="share of requests answered with a fault, 0 to 1")
+    parser.add_argument('--capacity', type=int, default=0, help="requests per second before throttling, 0 for no limit")
+    parser.add_argument('--session-requests', type=int, default=0, help="requests a session serves before it expires")
+    parser.add_argument('--bundles', type=int, default=2, help="bonus bundles of each subscriber")
+    parser.add_argument('--bundles-max', type=int, default=0,
+                        help="give each subscriber between --bundles and this many bundles")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the subscriber data and injected latency")
+    parser.add_argument('port', type=int, nargs='?', default=8080)
+    options = parser.parse_args()
+    server = start_stub(options.port, latency=options.latency_ms / 1000.0, jitter=options.jitter_ms / 1000.0,
+                        fault_rate=options.fault_rate, capacity=options.capacity,
+                        session_requests=options.session_requests, latency_dist=options.latency_dist,
+                        bundles_per_sub=options.bundles, bundles_max=options.bundles_max, seed=options.seed)
+    print("eSM stub listening on port %d" % server.server_address[1])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()